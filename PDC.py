@@ -1,45 +1,84 @@
-from synchrophasor.pdc import Pdc
+from receiver import Receiver
+from aligner import Aligner
+from archive import ArchiveWriter
 import numpy as np
 from datetime import datetime
+import time
 '''
-This file contains a simple implementation of a PDC used for testing the communication protocol. 
+This file contains a simple implementation of a PDC used for testing the communication protocol:
+receives the data streams of the PMUs (receiver.Receiver), combines their frames by timestamp (aligner.Aligner)
+and prints, every second, the last combined frame. The combined frames can be archived too (archive.ArchiveWriter).
 '''
 
-pdc = Pdc(pdc_id=7, pmu_ip="127.0.0.1", pmu_port=1411)
+PMUS = [("127.0.0.1", 1411, 7)] # (ip, port, IDCODE) of every PMU
+WAIT = 0.1 # seconds a timestamp waits for the frames of all the PMUs
+ARCHIVE = None # directory of the archive of the frames received, None to not archive them
 
-pdc.run()  # Connect to PMU
+def get_degrees(angles):
+    return np.round(np.degrees(angles) % 360).astype(int)
 
-header = pdc.get_header()  # Get header message from PMU
-config = pdc.get_config()  # Get configuration from PMU
+def archive_blocks(writer, blocks, fnom):
+    '''
+    Queues the phasors received to the archive, as the channel pmu*nPhasors + phasor (nPhasors of the aligner).
+    fnom = nominal frequency of every PMU (the frames carry the deviation from it)
+    '''
+    for block in blocks:
+        present = ~np.isnan(block['magnitude'])
+        n = block['magnitude'].shape
+        writer.append_records({
+            'time': np.broadcast_to(block['time'][:, None, None], n)[present],
+            'channel': np.broadcast_to(np.arange(n[1]*n[2]).reshape(n[1:]), n)[present],
+            'amplitude': block['magnitude'][present],
+            'phase': block['angle'][present],
+            'freq': np.broadcast_to((block['freq'] + fnom)[:, :, None], n)[present],
+            'rocof': np.broadcast_to(block['rocof'][:, :, None], n)[present]
+        })
 
-pdc.start()  # Request to start sending measurements
+receiver = Receiver(PMUS)
+receiver.start()  # Connect to the PMUs and start their data streams
+configs = receiver.configs()  # CFG-2 of every PMU
+if not configs:
+    raise SystemExit('No PMU configured.')
 
-def get_degrees(phasors):
-    degrees = []
+# frames per second and phasors of the PMUs (a negative DATA_RATE is seconds per frame: a slot per second)
+data_rate = max(max(cfg.get_data_rate(), 1) for cfg in configs.values())
+nPhasors = max(c.format.nPhasors for c in receiver.connections if c.cfg is not None)
+aligner = Aligner(len(PMUS), data_rate, nPhasors, WAIT)
+receiver.set_aligner(aligner)
+print('Aligning {} PMUs ({} configured) at {} frames/s, {} phasors'.format(len(PMUS), len(configs), data_rate, nPhasors))
 
-    for p in phasors:
-        d = p[1]*180/np.pi
-        if d < 0:
-            d += 360
-        degrees.append(round(d))
-    return degrees
+writer = None
+if ARCHIVE:
+    names = []
+    for ip, port, _ in PMUS:
+        cfg = configs.get('{}:{}'.format(ip, port))
+        phasors = cfg.get_channel_names()[:cfg.get_phasor_num()] if cfg else []
+        names += [ '{}:{} {}'.format(ip, port, phasors[k] if k < len(phasors) else k) for k in range(nPhasors) ]
+    writer = ArchiveWriter(ARCHIVE, names)
+    writer.start()
 
-while True:
-    data = pdc.get()  # Keep receiving data
-    phasors = data.get_phasors()
-    degrees = get_degrees(phasors)
+try:
+    while True:
+        time.sleep(1)
+        blocks = aligner.get()  # The frames combined since the last time
+        if not blocks:
+            continue
+        if writer:
+            archive_blocks(writer, blocks, np.array([ c.buffer.fnom if c.buffer else 50 for c in receiver.connections ]))
 
-
-    print('Received: ', datetime.fromtimestamp(data.get_soc()))
-    sph = data.get_phasors()
-    print(degrees)
-    for p in sph:
-        print('RMS: ',p[0]/np.sqrt(2), ', <: ',p[1], '\t(',p[0],')' )
-    meas = data.get_measurements()
-
-    print('Frequency: ', meas['measurements'][0]['frequency'])
-    print('Rocof: ', meas['measurements'][0]['rocof'])
-        
-    if not data:
-        pdc.quit()  # Close connection
-        break
\ No newline at end of file
+        frame = { name: values[-1] for name, values in blocks[-1].items() }
+        print('Received: ', datetime.fromtimestamp(frame['soc']), '({} PMUs of {})'.format(frame['present'].sum(), len(PMUS)))
+        for (ip, port, _), present, m, a, f, r in zip(PMUS, frame['present'], frame['magnitude'], frame['angle'], frame['freq'], frame['rocof']):
+            if not present:
+                print(ip, port, ': late or missing')
+                continue
+            print(ip, port, get_degrees(a[~np.isnan(a)]))
+            for mm, aa in zip(m[~np.isnan(m)], a[~np.isnan(a)]):
+                print('RMS: ', mm/np.sqrt(2), ', <: ', aa, '\t(', mm, ')')
+            print('Frequency deviation: ', f)
+            print('Rocof: ', r)
+        print(aligner.stats())
+except KeyboardInterrupt:
+    receiver.stop()  # Close the connections
+    if writer:
+        writer.stop()
@@ -0,0 +1,234 @@
+from collections import deque
+import time
+import numpy as np
+'''
+This file implements the time alignment of the PDC: the frames of all the PMUs with the same timestamp
+are combined in one frame, emitted as soon as every PMU has sent its own or when the wait window expires.
+The frames waiting are kept in a ring indexed by their time slot (timestamp*data_rate), one row per slot
+and one column per PMU, in numpy arrays: adding the frames of a PMU and emitting the slots ready are vectorized,
+whatever the number of PMUs. A single frame (the usual case) is copied into its row with scalar indexing,
+and the count and the arrival of every slot, checked at every frame, are lists: no numpy temporaries per frame. A frame arriving after its slot was emitted is late: it is counted and dropped.
+'''
+
+class Aligner:
+    '''
+    Combines the frames of nPmus PMUs streaming at data_rate frames per second.
+    The frames are given with add (as the columns of receiver.StreamBuffer), the combined frames are taken with get
+    or given to callback, in blocks of consecutive slots:
+        'time', 'soc', 'fracsec' = timestamp of the slot (n)
+        'present' = the PMUs that sent the frame of the slot (n, nPmus)
+        'magnitude', 'angle' = phasors (n, nPmus, nPhasors), NaN if missing
+        'freq', 'rocof' = (n, nPmus), NaN if missing; 'stat' = (n, nPmus)
+    The slots no PMU sent a frame for are not emitted.
+    '''
+
+    def __init__(self, nPmus, data_rate, nPhasors, wait=0.1, depth=None, callback=None, time_base=1000000, maxsize=1000):
+        '''
+        nPmus = number of PMUs (index of the PMU given to add)
+        data_rate = frames per second of the PMUs
+        nPhasors = phasors kept for every PMU: the others are dropped, the missing ones are NaN
+        wait = seconds a slot waits for the missing PMUs after its first frame arrived
+        depth = number of slots in the ring (default: the slots of 2 seconds, at least 4 wait windows):
+                a frame further in the future than depth slots forces out the oldest ones
+        callback = called with every block emitted, in the thread of add/poll; if None the blocks are queued for get
+        maxsize = blocks queued for get, then the oldest ones are dropped
+        '''
+        self.nPmus = nPmus
+        self.nPhasors = nPhasors
+        self.data_rate = data_rate
+        self.wait = wait
+        self.depth = depth or max(2*data_rate, int(np.ceil(4*wait*data_rate)))
+        self.callback = callback
+        self.time_base = time_base
+        self.output = deque(maxlen=maxsize)
+
+        self.next = None # slot of the first row of the ring, the next one to emit
+        self.present = np.zeros((self.depth, nPmus), bool)
+        self.count = [0]*self.depth # PMUs present in the slot
+        self.arrival = [float('nan')]*self.depth # monotonic time of the first frame of the slot
+        self.stat = np.zeros((self.depth, nPmus), np.uint16)
+        self.magnitude = np.full((self.depth, nPmus, nPhasors), np.nan, np.float32)
+        self.angle = np.full((self.depth, nPmus, nPhasors), np.nan, np.float32)
+        self.freq = np.full((self.depth, nPmus), np.nan, np.float32)
+        self.rocof = np.full((self.depth, nPmus), np.nan, np.float32)
+
+        self.emitted = 0                           # combined frames emitted
+        self.complete = 0                          # of them with the frames of all the PMUs
+        self.forced = 0                            # slots emitted to make room for newer frames
+        self.late = np.zeros(nPmus, np.int64)      # frames arrived after their slot was emitted, by PMU
+        self.missing = np.zeros(nPmus, np.int64)   # frames missing from the combined frames emitted, by PMU
+
+    def add(self, pmu, columns, now=None):
+        '''
+        Adds the frames of the PMU of index pmu (the columns of receiver.StreamBuffer.decode, in time order),
+        then emits the slots ready.
+        now = monotonic time of their arrival (default: now)
+        '''
+        now = time.monotonic() if now is None else now
+        times = columns['time']
+        if len(times) == 1: # one frame, the usual case
+            self.add_frame(pmu, columns, round(float(times[0])*self.data_rate), now)
+            return
+        if not len(times):
+            return
+        first, newest = round(float(times[0])*self.data_rate), round(float(times[-1])*self.data_rate)
+        if self.next is None:
+            self.next = first
+            self.newest = first - 1 # newest slot waiting
+
+        if newest >= self.next + self.depth:
+            self.forced += self.emit(newest - self.depth + 1 - self.next)
+
+        if first < self.next:
+            slots = np.rint(times*self.data_rate).astype(np.int64)
+            keep = slots >= self.next
+            self.late[pmu] += len(slots) - np.count_nonzero(keep)
+            if not keep.any():
+                return
+            slots = slots[keep]
+            columns = { name: values[keep] for name, values in columns.items() }
+        else:
+            slots = np.rint(times*self.data_rate).astype(np.int64)
+
+        rows = self.rows(slots)
+        for row, new in zip((slots % self.depth).tolist(), (~self.present[rows, pmu]).tolist()):
+            self.count[row] += new # a frame sent again doesn't count twice
+        self.present[rows, pmu] = True
+
+        k = min(self.nPhasors, columns['magnitude'].shape[1])
+        self.stat[rows, pmu] = columns['stat']
+        self.magnitude[rows, pmu, :k] = columns['magnitude'][:, :k]
+        self.angle[rows, pmu, :k] = columns['angle'][:, :k]
+        self.freq[rows, pmu] = columns['freq']
+        self.rocof[rows, pmu] = columns['rocof']
+
+        # the slots up to the newest one wait from now, if they weren't already: also the empty ones,
+        # so that a slot no PMU sent doesn't hold the ones after it
+        for slot in range(max(self.next, self.newest + 1), newest + 1):
+            self.arrival[slot % self.depth] = now
+        self.newest = max(self.newest, newest)
+
+        self.poll(now)
+
+    def add_frame(self, pmu, columns, slot, now):
+        '''
+        add of a single frame, of the slot: the row is indexed with scalars and the values copied one by one,
+        without the arrays of slots and rows and the fancy indexing of a block of frames.
+        '''
+        if self.next is None:
+            self.next = slot
+            self.newest = slot - 1
+        if slot < self.next:
+            self.late[pmu] += 1
+            return
+        if slot >= self.next + self.depth:
+            self.forced += self.emit(slot - self.depth + 1 - self.next)
+
+        row = slot % self.depth
+        if not self.present[row, pmu]: # a frame sent again doesn't count twice
+            self.present[row, pmu] = True
+            self.count[row] += 1
+
+        magnitude, angle = columns['magnitude'], columns['angle']
+        if magnitude.shape[1] == self.nPhasors:
+            self.magnitude[row, pmu] = magnitude[0]
+            self.angle[row, pmu] = angle[0]
+        else:
+            k = min(self.nPhasors, magnitude.shape[1])
+            self.magnitude[row, pmu, :k] = magnitude[0, :k]
+            self.angle[row, pmu, :k] = angle[0, :k]
+        self.stat[row, pmu] = columns['stat'][0]
+        self.freq[row, pmu] = columns['freq'][0]
+        self.rocof[row, pmu] = columns['rocof'][0]
+
+        if slot > self.newest: # see add
+            for s in range(max(self.next, self.newest + 1), slot + 1):
+                self.arrival[s % self.depth] = now
+            self.newest = slot
+
+        self.poll(now)
+
+    def rows(self, slots):
+        '''
+        Returns the rows of the ring of slots: a slice if they are consecutive rows (faster to index), otherwise an array.
+        '''
+        rows = slots % self.depth
+        if (np.diff(rows) == 1).all():
+            return slice(int(rows[0]), int(rows[-1]) + 1)
+        return rows
+
+    def poll(self, now=None):
+        '''
+        Emits the slots ready, oldest first: the ones with the frames of all the PMUs and the ones whose wait window expired.
+        Must be called periodically too, for the windows expiring without new frames.
+        '''
+        if self.next is None:
+            return
+        now = time.monotonic() if now is None else now
+        n = 0
+        while n < self.depth:
+            row = (self.next + n) % self.depth
+            if self.count[row] != self.nPmus and not now - self.arrival[row] >= self.wait: # NaN: not waiting
+                break
+            n += 1
+        if n:
+            self.emit(n)
+
+    def emit(self, n):
+        '''
+        Emits the n oldest slots, complete or not, and clears their rows. Returns n.
+        '''
+        slots = self.next + np.arange(min(n, self.depth)) # the slots beyond the ring are empty
+        rows = slots % self.depth
+
+        present = self.present[rows]
+        sent = present.any(axis=1)
+        block = {
+            'time': slots[sent]/self.data_rate,
+            'soc': slots[sent]//self.data_rate,
+            'fracsec': slots[sent] % self.data_rate*self.time_base//self.data_rate,
+            'present': present[sent],
+            'stat': self.stat[rows][sent],
+            'magnitude': self.magnitude[rows][sent],
+            'angle': self.angle[rows][sent],
+            'freq': self.freq[rows][sent],
+            'rocof': self.rocof[rows][sent]
+        }
+
+        self.present[rows] = False
+        for row in rows.tolist():
+            self.count[row] = 0
+            self.arrival[row] = float('nan')
+        self.stat[rows] = 0
+        for values in (self.magnitude, self.angle, self.freq, self.rocof):
+            values[rows] = np.nan
+        self.next += n # slots beyond the old rows now map to the cleared ones
+
+        emitted = len(block['time'])
+        if emitted:
+            self.emitted += emitted
+            self.complete += int(np.count_nonzero(block['present'].all(axis=1)))
+            self.missing += emitted - block['present'].sum(axis=0)
+            if self.callback:
+                self.callback(block)
+            else:
+                self.output.append(block)
+        return n
+
+    def get(self):
+        '''
+        Returns the blocks emitted since the last call (thread safe), oldest first.
+        '''
+        blocks = []
+        while self.output:
+            blocks.append(self.output.popleft())
+        return blocks
+
+    def stats(self):
+        return {
+            'emitted': self.emitted,
+            'complete': self.complete,
+            'forced': self.forced,
+            'late': self.late.tolist(),
+            'missing': self.missing.tolist()
+        }
@@ -0,0 +1,326 @@
+from datetime import datetime, timezone
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+'''
+This file implements the archive of the measurements: one directory per UTC day, one file per column
+(time, channel, amplitude, phase, freq, rocof) of fixed width records, in time order.
+The files are memory-mapped: the writer fills them in place, growing them a chunk at a time,
+and the reader returns numpy views on them, without copying, for any time range (binary search on the time column).
+The number of records written is kept in meta.json, rewritten (atomically) after every batch:
+what the reader sees is always whole records.
+'''
+
+COLUMNS = [('time', '<f8'),       # UNIX time of the measurement, seconds
+           ('channel', '<u2'),    # index of the channel in the names of meta.json
+           ('amplitude', '<f4'),
+           ('phase', '<f4'),      # rad
+           ('freq', '<f4'),       # Hz
+           ('rocof', '<f4')]      # Hz/s
+
+STOP = None # queued to stop the writer thread
+
+def day_of(t):
+    '''
+    Returns the UTC day (YYYY-MM-DD), the name of the directory of the records of time t.
+    '''
+    return datetime.fromtimestamp(t, timezone.utc).strftime('%Y-%m-%d')
+
+def day_start(day):
+    return datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()
+
+class DayFiles:
+    '''
+    The column files of one day, memory-mapped, and the number of records in them.
+    mode = 'r+' to append (the files are created and grown as needed), 'r' to read.
+    '''
+
+    def __init__(self, path, mode='r', channels=None, chunk=1 << 20):
+        '''
+        path = directory of the day
+        channels = names of the channels, saved in meta.json by a new writer
+        chunk = records the files are grown by
+        '''
+        self.path = path
+        self.mode = mode
+        self.chunk = chunk
+        meta_path = os.path.join(path, 'meta.json')
+
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            if mode == 'r':
+                raise FileNotFoundError(meta_path)
+            os.makedirs(path, exist_ok=True)
+            self.meta = { 'count': 0, 'channels': list(channels or []), 'columns': dict(COLUMNS) }
+            self.save_meta()
+
+        self.count = self.meta['count']
+        self.maps = {}
+        self.map(self.count if mode == 'r' else max(self.count, 1))
+
+    def file(self, name):
+        return os.path.join(self.path, name + '.bin')
+
+    def map(self, size):
+        '''
+        Maps the columns with room for size records at least, growing the files a chunk at a time when appending.
+        '''
+        if self.mode != 'r':
+            size = -(-size//self.chunk)*self.chunk
+        for name, dtype in self.meta['columns'].items():
+            itemsize = np.dtype(dtype).itemsize
+            if self.mode != 'r':
+                with open(self.file(name), 'ab') as f:
+                    if f.tell() < size*itemsize:
+                        f.truncate(size*itemsize)
+            if size == 0:
+                self.maps[name] = np.zeros(0, dtype) # mmap can't map an empty file
+            else:
+                self.maps[name] = np.memmap(self.file(name), dtype, self.mode, shape=size)
+
+    def append(self, records):
+        '''
+        Writes the records (dict of arrays, one per column) after the last ones.
+        '''
+        n = len(records['time'])
+        if self.count + n > len(self.maps['time']):
+            self.flush()
+            self.map(self.count + n)
+        for name, column in self.maps.items():
+            column[self.count:self.count + n] = records[name]
+        self.count += n
+
+    def flush(self):
+        '''
+        Writes the mapped pages to the files, then the number of records to meta.json.
+        '''
+        for column in self.maps.values():
+            if isinstance(column, np.memmap):
+                column.flush()
+        self.save_count()
+
+    def save_count(self):
+        self.meta['count'] = self.count
+        self.save_meta()
+
+    def save_meta(self):
+        tmp = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, os.path.join(self.path, 'meta.json'))
+
+    def columns(self, start=0, stop=None):
+        '''
+        Returns the views on the records from start to stop of every column.
+        '''
+        stop = self.count if stop is None else min(stop, self.count)
+        return { name: column[start:stop] for name, column in self.maps.items() }
+
+    def find(self, t):
+        '''
+        Returns the index of the first record with time >= t.
+        '''
+        return int(np.searchsorted(self.maps['time'][:self.count], t))
+
+class ArchiveWriter:
+    '''
+    Appends the measurements to the archive in its own thread: append only queues them (without waiting,
+    dropping them if the queue is full), the thread writes everything queued in one batch.
+    '''
+
+    def __init__(self, root, channels, maxsize=1000, chunk=1 << 20, sync=10):
+        '''
+        root = directory of the archive
+        channels = names of the channels, in the order of their index
+        maxsize = measurements queued, then the new ones are dropped
+        chunk = records the files are grown by
+        sync = seconds between the writes of the mapped pages to disk
+        '''
+        self.root = root
+        self.channels = list(channels)
+        self.chunk = chunk
+        self.sync = sync
+        self.synced = time.monotonic()
+        self.queue = queue.Queue(maxsize)
+        self.days = {}
+
+        self.written = 0  # records
+        self.dropped = 0  # measurements
+        self.batches = 0
+        self.errors = 0
+
+        self.thread = threading.Thread(target=self.run, name='archive', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Writes what is queued, then stops the thread and closes the files.
+        '''
+        self.queue.put(STOP)
+        self.thread.join()
+        for files in self.days.values():
+            files.flush()
+        self.days.clear()
+
+    def append(self, timestamp, synchrophasors):
+        '''
+        Queues the synchrophasors of estimate_phasors (by channel: amplitude, phase, avg_freq, rocof) measured at timestamp
+        (UNIX time, seconds). They are archived by position, as the channels of the names given to the writer
+        (whatever the channel numbers of the redlab): they must be in the same order, as for MyPmu.set_dataframe.
+        Returns False if the queue is full and they are dropped.
+        '''
+        return self.put(('synchrophasors', timestamp, synchrophasors))
+
+    def append_records(self, records):
+        '''
+        Queues the records given as a dict of arrays, one per column (see COLUMNS), in time order.
+        '''
+        return self.put(('records', records))
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def records(self, items):
+        '''
+        Returns the records of the queued items, as a dict of arrays.
+        '''
+        parts = []
+        for item in items:
+            if item[0] == 'records':
+                parts.append(item[1])
+                continue
+            _, timestamp, sph = item
+            chans = list(sph)
+            parts.append({
+                'time': np.full(len(chans), timestamp),
+                'channel': np.arange(len(chans)), # position, index of the name
+                'amplitude': [ sph[c]['amplitude'] for c in chans ],
+                'phase': [ sph[c]['phase'] for c in chans ],
+                'freq': [ sph[c]['avg_freq'] for c in chans ],
+                'rocof': [ sph[c]['rocof'] for c in chans ]
+            })
+        return { name: np.concatenate([ np.asarray(p[name], dtype) for p in parts ]) for name, dtype in COLUMNS }
+
+    def run(self):
+        '''
+        Body of the thread: waits for an item, then takes everything queued and writes it.
+        '''
+        while True:
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = STOP in items
+            items = [ item for item in items if item is not STOP ]
+
+            if items:
+                try:
+                    self.write(self.records(items))
+                except Exception as e:
+                    self.errors += 1
+                    print('Archive: write failed: {}'.format(e))
+            if stop:
+                break
+
+    def write(self, records):
+        '''
+        Appends the records to the files of their days. The number of records is saved every batch,
+        the mapped pages are written to disk every sync seconds (the readers see them before, in the page cache).
+        '''
+        days = np.floor(records['time']/86400)
+        split = days[0] != days[-1]
+        for d in np.unique(days):
+            selected = { name: column[days == d] for name, column in records.items() } if split else records
+            day = day_of(d*86400)
+            if day not in self.days:
+                for files in self.days.values():
+                    files.flush() # a new day: the older ones are complete
+                self.days = { day: DayFiles(os.path.join(self.root, day), 'r+', self.channels, self.chunk) }
+            files = self.days[day]
+            files.append(selected)
+            self.written += len(selected['time'])
+
+        now = time.monotonic()
+        if now - self.synced >= self.sync:
+            files.flush()
+            self.synced = now
+        else:
+            files.save_count()
+        self.batches += 1
+
+    def stats(self):
+        return { 'written': self.written, 'dropped': self.dropped, 'batches': self.batches,
+                 'errors': self.errors, 'queued': self.queue.qsize() }
+
+class ArchiveReader:
+    '''
+    Reads the archive: the records of any time range as numpy views on the mapped files, one block per day.
+    The records written after a day is opened are seen after refresh.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.days = {}
+
+    def day(self, day):
+        if day not in self.days:
+            self.days[day] = DayFiles(os.path.join(self.root, day), 'r')
+        return self.days[day]
+
+    def refresh(self):
+        '''
+        Maps again the days open, to see the records written since.
+        '''
+        self.days.clear()
+
+    def available(self):
+        '''
+        Returns the days in the archive, oldest first.
+        '''
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(d for d in os.listdir(self.root) if os.path.exists(os.path.join(self.root, d, 'meta.json')))
+
+    def channels(self, day):
+        return self.day(day).meta['channels']
+
+    def blocks(self, t0, t1):
+        '''
+        Yields, for every day between t0 and t1 (UNIX times), the views on its records with time in [t0, t1):
+        a dict of arrays, one per column. Nothing is copied.
+        '''
+        for day in self.available():
+            start = day_start(day)
+            if start + 86400 <= t0 or start >= t1:
+                continue
+            files = self.day(day)
+            yield files.columns(files.find(t0), files.find(t1))
+
+    def read(self, t0, t1, channel=None):
+        '''
+        Returns the records with time in [t0, t1) as a dict of arrays, of the given channel index only if not None.
+        Zero copy if they are all in one day and channel is None, otherwise they are copied into new arrays.
+        '''
+        blocks = list(self.blocks(t0, t1))
+        if len(blocks) == 1:
+            block = blocks[0]
+        else:
+            block = { name: np.concatenate([ b[name] for b in blocks ]) if blocks else np.zeros(0, dtype) for name, dtype in COLUMNS }
+        if channel is not None:
+            selected = block['channel'] == channel
+            block = { name: column[selected] for name, column in block.items() }
+        return block
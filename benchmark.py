@@ -0,0 +1,638 @@
+from estimator import *
+from receiver import *
+from aligner import Aligner
+from server import UdpSender
+from pmu import MyPmu
+from simulator import SimulatedUSB201, Table
+from signals import Scenario, three_phase
+from synchrophasor.frame import ConfigFrame2
+from datetime import datetime, timezone
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import numpy as np
+'''
+This file contains the benchmarks of the hot paths of the PMU, the ones that have to fit inside one PPS interval
+(Redlab.read, estimate_phasors with every backend, windowed_fft, the sliding estimator, MyPmu.set_dataframe and
+the serialization of the data frames), and of the PDC (receiver, aligner) and of the UDP output.
+Runs without the hardware and without PMUs: the scans come from a replaying simulated USB-201 and from
+signals.Scenario, the data frames are generated in software.
+Every case is first checked against its reference (the original loops, the FFT backend, the dict of dicts alignment),
+then run many times: its latency distribution (min, p50, p99, max), the memory it allocates (tracemalloc, in a separate
+run: tracing slows it down) and its throughput are collected, for several channel and sample counts, and its speedup
+over the reference is printed.
+    python3 benchmark.py [--out DIRECTORY] [BASELINE]
+saves the results as JSON into a new file of DIRECTORY (nothing is written without --out) and compares them with
+the results in BASELINE, default the previous ones in DIRECTORY, to show the regressions.
+'''
+
+REPEAT = 200 #runs of every case
+CHANNELS = (1, 4, 8) #channel counts
+SAMPLES = (1200, 2400, 6250) #samples per channel of the triggered scans
+S_FREQ = 12500 #sampling frequency of every channel
+NOMINAL = 50 #nominal frequency
+RATES = (10, 50) #reporting rates of the sliding estimator
+REGRESSION = 0.2 #relative increase of the p50 latency (or of the memory allocated) reported as a regression
+
+def volts(value):
+    '''
+    Same conversion as usb_20x.volts.
+    '''
+    return ((value - 2048)*10.)/2048.
+
+def loop_read(raw_data, channels, table_AIn):
+    '''
+    The original Redlab.read implementation: cycles on the scans and fills the dictionary sample by sample.
+    Kept as reference for the benchmark.
+    '''
+    data = {}
+    for c in channels:
+        data[c] = {
+            'rawData': [],
+            'volts': [],
+            'data': []
+        }
+
+    for scan in range(len(raw_data)//len(channels)):
+        for i, chan in enumerate(channels):
+            ii = scan*len(channels) + i
+            data[chan]['rawData'].append(raw_data[ii])
+            data[chan]['data'].append(raw_data[ii]*table_AIn[chan].slope + table_AIn[chan].intercept)
+
+    for c in channels:
+        data[c]['volts'] = [volts(x) for x in data[c]['data']]
+
+    return data
+
+def loop_zero_crossing_indexes(samples):
+    '''
+    The original zero_crossing_indexes implementation, kept as reference for the benchmark.
+    '''
+    last = -1
+    zeroIndexes = []
+
+    for i, current in enumerate(samples):
+        if current < 0 and last >= 0:
+            zeroIndexes.append(i)
+        last = current
+
+    return zeroIndexes
+
+def loop_zero_crossing_times(samples, frequency, zero_indexes):
+    '''
+    The original zero_crossing_times implementation, kept as reference for the benchmark.
+    '''
+    zero_crossing_times = []
+
+    Ts = 1/frequency
+
+    for zi in zero_indexes:
+        a, b = zero_cross_offset(samples[zi-1], samples[zi], Ts)
+        zero_crossing_times.append(zi*Ts-b)
+
+    return zero_crossing_times
+
+def loop_get_periods(zero_crossing_times):
+    '''
+    The original get_periods implementation, kept as reference for the benchmark.
+    '''
+    ps = []
+
+    for i in range(1, len(zero_crossing_times)):
+        ps.append(zero_crossing_times[i] - zero_crossing_times[i-1])
+
+    return ps
+
+class ReplayUSB201(SimulatedUSB201):
+    '''
+    A simulated USB-201 returning the same scan at once, without waiting for its acquisition:
+    Redlab.read costs only what it costs on the host.
+    '''
+
+    def read_scans(self, nScan):
+        if getattr(self, 'replay', None) is None or self.replay.shape != (nScan, self.nChan):
+            self.replay = self.generate(0, nScan)
+        self.running = False
+        self.reads += 1
+        return self.replay
+
+def measure(f, repeat=REPEAT, items=1, warmup=3, resolution=1e-4):
+    '''
+    Runs f repeat times and returns the statistics of its latency in seconds (min, p50, p99, max, mean),
+    the bytes it allocates (peak over one run, and still allocated after it) and its throughput (items per second at p50).
+    The cases faster than resolution are timed in batches of calls lasting resolution at least (as timeit does):
+    their latencies are the averages over every batch.
+    '''
+    for _ in range(warmup):
+        t = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - t
+    number = max(1, int(resolution/max(elapsed, 1e-9)))
+
+    times = np.empty(repeat)
+    for i in range(repeat):
+        t = time.perf_counter()
+        for _ in range(number):
+            f()
+        times[i] = (time.perf_counter() - t)/number
+
+    tracemalloc.start()
+    try:
+        f()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    p50 = float(np.percentile(times, 50))
+    return {
+        'min': float(times.min()),
+        'p50': p50,
+        'p99': float(np.percentile(times, 99)),
+        'max': float(times.max()),
+        'mean': float(times.mean()),
+        'batch': number,
+        'alloc_peak': peak,
+        'alloc_retained': current,
+        'throughput': items/p50
+    }
+
+def test_scan(nChannels, nSamples):
+    '''
+    Returns a triggered scan of nChannels three phase channels slightly off nominal, with harmonics and noise.
+    '''
+    signals = three_phase(frequency=50.05, nChannels=nChannels, harmonics=[(3, 0.05, 0), (5, 0.02, 0)], noise=0.005)
+    return next(Scenario(signals, S_FREQ, seed=0).scans(nSamples))
+
+def bench_read(results, nChannels=8, nSamples=2400, repeat=REPEAT):
+    '''
+    Redlab.read of a scan into new arrays and zero copy, against the original loop (loop_read): checks the volts.
+    '''
+    channels = list(range(nChannels))
+    readers = { zero_copy: Redlab(channels, S_FREQ, nSamples, zero_copy=zero_copy, device=ReplayUSB201(seed=0)) for zero_copy in (False, True) }
+    device = readers[False].device
+    raw_data = device.AInScanRead(nSamples) # the same scan every read
+
+    reference = loop_read(raw_data, channels, device.table_AIn)
+    for zero_copy, redlab in readers.items():
+        scan = redlab.read()
+        for i, c in enumerate(channels):
+            if not np.array_equal(reference[c]['volts'], scan['volts'][i]):
+                raise AssertionError('Redlab.read ({}) differs from the loop on channel {}'.format('zero copy' if zero_copy else 'list', c))
+
+    t_loop = measure(lambda: loop_read(raw_data, channels, device.table_AIn), 5, warmup=1)['p50'] # slow, a few runs
+    print('Redlab.read {} channels x {} samples'.format(nChannels, nSamples))
+    print('\tloop:       {:.3f} ms'.format(t_loop*1000))
+    for zero_copy, redlab in readers.items():
+        name = 'read[{}] {}x{}'.format('zero copy' if zero_copy else 'list', nChannels, nSamples)
+        results[name] = measure(redlab.read, repeat, items=nChannels*nSamples)
+        print('\t{:11} {:.3f} ms ({:.1f}x)'.format('zero copy:' if zero_copy else 'vectorized:', results[name]['p50']*1000, t_loop/results[name]['p50']))
+
+def bench_zero_crossings(results, nSamples=2400, repeat=REPEAT):
+    '''
+    Zero crossing detection, interpolation and periods of one channel, against the loops.
+    '''
+    samples = test_scan(1, nSamples)['volts'][0]
+    volts = list(samples)
+
+    def loop():
+        zc = loop_zero_crossing_indexes(volts)
+        periods = loop_get_periods(loop_zero_crossing_times(volts, S_FREQ, zc))
+        return zc, periods, get_rocof(periods), get_average_frequency(periods)
+
+    def vectorized():
+        zc = zero_crossing_indexes(samples)
+        periods = get_periods(zero_crossing_times(samples, S_FREQ, zc))
+        return zc, periods, get_rocof(periods), get_average_frequency(periods)
+
+    reference, result = loop(), vectorized()
+    if not (np.array_equal(reference[0], result[0]) and np.array_equal(reference[1], result[1])
+            and reference[2] == result[2] and reference[3] == result[3]):
+        raise AssertionError('vectorized zero crossings differ from the loop')
+
+    t_loop = measure(loop, 20, warmup=1)['p50']
+    name = 'zero_crossings 1x{}'.format(nSamples)
+    results[name] = measure(vectorized, repeat, items=nSamples)
+    print('Zero crossings, periods, rocof and frequency on {} samples'.format(nSamples))
+    print('\tloop:       {:.3f} ms'.format(t_loop*1000))
+    print('\tvectorized: {:.3f} ms ({:.1f}x)'.format(results[name]['p50']*1000, t_loop/results[name]['p50']))
+
+def check_backend(scan, backend):
+    '''
+    Checks that the backend gives the same phasors, frequencies and rocof as the FFT on every channel of the scan.
+    '''
+    reference = estimate_phasors(scan, 'fft')
+    result = estimate_phasors(scan, backend)
+    for c in reference:
+        for key in ('phasor', 'avg_freq', 'rocof'):
+            a, b = reference[c][key], result[c][key]
+            if a is None or b is None:
+                raise AssertionError('no {} on channel {} (fft or {})'.format(key, c, backend))
+            a, b = (complex(*v) if isinstance(v, tuple) else v for v in (a, b)) # (0, 0): not estimated
+            if abs(a - b) > 1e-6*max(abs(a), 1e-3):
+                raise AssertionError('backend {} differs from the FFT in {} on channel {}'.format(backend, key, c))
+
+def bench_estimation(results, nChannels=8, nSamples=2400, repeat=REPEAT):
+    '''
+    The estimate_phasors backends, checked against the FFT, also on a scan of a period and a half (1 or 2 zero crossings, no rocof).
+    '''
+    scan = test_scan(nChannels, nSamples)
+    short = test_scan(nChannels, int(1.5*S_FREQ/NOMINAL))
+
+    print('estimate_phasors {} channels x {} samples'.format(nChannels, nSamples))
+    for backend in BACKENDS:
+        check_backend(scan, backend)
+        check_backend(short, backend)
+        name = 'estimate_phasors[{}] {}x{}'.format(backend, nChannels, nSamples)
+        results[name] = measure(lambda: estimate_phasors(scan, backend), repeat, items=nChannels*nSamples)
+        t_fft = results['estimate_phasors[fft] {}x{}'.format(nChannels, nSamples)]['p50']
+        print('\t{:6} {:.3f} ms ({:.1f}x)'.format(backend, results[name]['p50']*1000, t_fft/results[name]['p50']))
+
+def bench_windowed_fft(results, nSamples, repeat=REPEAT):
+    samples = test_scan(1, nSamples)['volts'][0]
+    zc = zero_crossing_indexes(samples)
+    avg_freq = get_average_frequency(get_periods(zero_crossing_times(samples, S_FREQ, zc)))
+    offset_a, offset_b = zero_cross_offset(samples[zc[0]-1], samples[zc[0]], 1/S_FREQ)
+    results['windowed_fft 1x{}'.format(nSamples)] = measure(lambda: windowed_fft(samples, zc, S_FREQ, offset_a, offset_b, avg_freq, nSamples), repeat, items=nSamples)
+
+def bench_sliding(results, nChannels, rate, repeat=REPEAT):
+    '''
+    One report of the sliding estimator: the update with the new samples and the estimate.
+    '''
+    step = S_FREQ//rate
+    estimator = SlidingEstimator(nChannels, S_FREQ)
+    chunks = [ volts for _, volts in Scenario(three_phase(nChannels=nChannels, noise=0.005), S_FREQ, seed=0).chunks(2, step) ]
+    estimator.update(np.concatenate(chunks[:-1], axis=1), 0)
+    volts, start = chunks[-1], step*(len(chunks) - 1)
+    channels = list(range(nChannels))
+
+    def report():
+        estimator.next = start # the same samples again, as if they were the next ones
+        estimator.update(volts, start)
+        estimator.estimate(channels, 1/rate)
+
+    results['sliding[{}/s] {}x{}'.format(rate, nChannels, step)] = measure(report, repeat, items=nChannels*step)
+
+def bench_framing(results, nChannels, repeat=REPEAT):
+    myPmu = MyPmu(['V{}'.format(c) for c in range(nChannels)])
+    sph = estimate_phasors(test_scan(nChannels, 2400))
+    soc = int(time.time())
+    results['set_dataframe {}'.format(nChannels)] = measure(lambda: myPmu.set_dataframe(sph, soc, 0), repeat)
+
+    phasors = [ v for c in sph for v in (sph[c]['amplitude'], sph[c]['phase']) ]
+    fmt = myPmu.frame_format
+    results['encode {}'.format(nChannels)] = measure(lambda: bytes(fmt.encode(soc, 0, 0, phasors, 0.01, 0.1)), repeat)
+
+def fake_pmu_frames(fmt, nFrames, soc, data_rate, time_base=1000000):
+    '''
+    Returns the bytes of nFrames consecutive data frames of the layout fmt (DataFrameFormat, polar float),
+    encoded all at once with its numpy dtype: the load of a fake PMU.
+    '''
+    index = np.arange(nFrames)
+    frames = np.zeros(nFrames, fmt.dtype)
+    frames['sync'] = DATA_SYNC
+    frames['size'] = fmt.size
+    frames['id_code'] = fmt.pmu_id
+    frames['soc'] = soc + index//data_rate
+    frames['fracsec'] = index % data_rate*time_base//data_rate
+    frames['phasors']['a'] = 230
+    frames['phasors']['b'] = (index % 100/100*2*np.pi - np.pi)[:, None]
+    frames['freq'] = 0.01
+    frames['dfreq'] = 0.1
+
+    data = bytearray(frames.tobytes())
+    view = memoryview(data)
+    for start in range(0, len(data), fmt.size):
+        end = start + fmt.size - 2
+        data[end:end + 2] = crc_ccitt(view[start:end]).to_bytes(2, "big")
+    return bytes(data)
+
+async def fake_pmu(cfg_frame, data):
+    '''
+    Starts a fake PMU on a free port: answers the cfg2 command with cfg_frame and the start command with all of data at once.
+    Returns the asyncio server.
+    '''
+    async def serve(reader, writer):
+        try:
+            while True:
+                head = await reader.readexactly(4)
+                command = decode_command(head + await reader.readexactly(frame_size(head) - 4))
+                if command == "cfg2":
+                    writer.write(cfg_frame)
+                elif command == "start":
+                    writer.write(data)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    return await asyncio.start_server(serve, '127.0.0.1', 0)
+
+def bench_receiver(nPmus=20, nFrames=20000, nPhasors=8, data_rate=50):
+    '''
+    Measures the throughput of the Receiver connected to nPmus fake PMUs sending nFrames data frames each, as fast as they can,
+    and compares its batch decoding with the frame by frame one.
+    '''
+    soc = int(time.time())
+    cfg = ConfigFrame2(7, 1000000, 1, "Station A", 7734, 15, nPhasors, 0, 0, ['ch{}'.format(i) for i in range(nPhasors)],
+                       [(100000, "v")]*nPhasors, [], [], 50, 1, data_rate)
+    cfg_frame = cfg.convert2bytes()
+    fmt = DataFrameFormat(cfg)
+    data = fake_pmu_frames(fmt, nFrames, soc, data_rate)
+
+    async def run():
+        servers = [ await fake_pmu(cfg_frame, data) for _ in range(nPmus) ]
+        receiver = Receiver([ ('127.0.0.1', s.sockets[0].getsockname()[1], 7) for s in servers ], capacity=nFrames)
+        task = asyncio.ensure_future(receiver.run())
+
+        t = time.perf_counter()
+        while sum(c.frames + c.errors for c in receiver.connections) < nPmus*nFrames:
+            await asyncio.sleep(0.001)
+        elapsed = time.perf_counter() - t
+        block = receiver.pull(1.0)
+
+        task.cancel()
+        await task
+        for s in servers:
+            s.close()
+        return receiver, elapsed, block
+
+    receiver, elapsed, block = asyncio.run(run())
+    for c in receiver.connections:
+        if c.errors or not np.array_equal(c.buffer.columns['soc'], soc + np.arange(nFrames)//data_rate):
+            raise AssertionError('receiver lost or corrupted the frames of {}'.format(c.name))
+    if any(len(b['time']) != data_rate for b in block.values()):
+        raise AssertionError('a block of 1 s does not hold data_rate frames')
+
+    t_loop = measure(lambda: [ fmt.decode(data[i:i + fmt.size]) for i in range(0, len(data), fmt.size) ], 3, warmup=1)['p50']
+    t_batch = measure(lambda: receiver.connections[0].buffer.append(fmt.decode_many(data)), 3, warmup=1)['p50']
+
+    total = nPmus*nFrames
+    print('Receiver {} PMUs x {} frames of {} phasors ({} bytes)'.format(nPmus, nFrames, nPhasors, fmt.size))
+    print('	throughput:  {:.0f} frames/s, {:.1f} MB/s (connection included)'.format(total/elapsed, total*fmt.size/elapsed/1e6))
+    print('	frame by frame decoding: {:.2f} us/frame'.format(t_loop/nFrames*1e6))
+    print('	batch decoding:          {:.2f} us/frame ({:.1f}x)'.format(t_batch/nFrames*1e6, t_loop/t_batch))
+
+def dict_align(events, nPmus, data_rate, wait, nPhasors):
+    '''
+    Time alignment with a dict of the slots waiting, each one a dict of the frames by PMU, combined in arrays when emitted:
+    the reference for the benchmark of Aligner. Returns the number of combined frames emitted.
+    '''
+    waiting = {}
+    arrival = {}
+    emitted = set()
+    for now, pmu, columns in events:
+        for i, t in enumerate(columns['time']):
+            slot = round(t*data_rate)
+            if slot in emitted:
+                continue
+            waiting.setdefault(slot, {})[pmu] = (columns['magnitude'][i], columns['angle'][i], columns['freq'][i], columns['rocof'][i])
+            arrival.setdefault(slot, now)
+        for slot in sorted(waiting):
+            if len(waiting[slot]) < nPmus and now - arrival[slot] < wait:
+                break
+            magnitude, angle = np.full((2, nPmus, nPhasors), np.nan)
+            freq, rocof = np.full((2, nPmus), np.nan)
+            for p, (m, a, f, r) in waiting.pop(slot).items():
+                magnitude[p], angle[p], freq[p], rocof[p] = m, a, f, r
+            del arrival[slot]
+            emitted.add(slot)
+    return len(emitted)
+
+def fake_pmu_events(nPmus, data_rate, seconds, nPhasors, wait, batch):
+    '''
+    Returns the arrivals (monotonic time, PMU, columns of batch frames) of the frames of nPmus PMUs in time order,
+    with random network delays (1% of the frames later than the wait window).
+    '''
+    rng = np.random.default_rng(0)
+    nFrames = data_rate*seconds
+    times = 1000 + np.arange(nFrames)/data_rate
+    events = []
+    for pmu in range(nPmus):
+        delays = rng.exponential(0.01, nFrames) + (rng.random(nFrames) < 0.01)*2*wait
+        for i in range(0, nFrames, batch):
+            columns = {
+                'time': times[i:i + batch],
+                'stat': np.zeros(batch, np.uint16),
+                'magnitude': np.full((batch, nPhasors), 230, np.float32),
+                'angle': np.zeros((batch, nPhasors), np.float32),
+                'freq': np.zeros(batch, np.float32),
+                'rocof': np.zeros(batch, np.float32)
+            }
+            events.append((times[i + batch - 1] + delays[i], pmu, columns))
+    events.sort(key=lambda e: e[0])
+    return events
+
+def bench_aligner(nPmus=200, data_rate=50, seconds=10, nPhasors=8, wait=0.1, repeat=3):
+    '''
+    Measures Aligner on nPmus PMUs sending their frames one at a time (the Receiver gives every frame as it arrives)
+    and 10 at a time (as read in bursts), and compares it with the dict of dicts alignment.
+    '''
+    nFrames = data_rate*seconds
+    print('Aligner {} PMUs x {} frames, wait {} s'.format(nPmus, nFrames, wait))
+    for batch in (1, 10):
+        events = fake_pmu_events(nPmus, data_rate, seconds, nPhasors, wait, batch)
+
+        def ring():
+            aligner = Aligner(nPmus, data_rate, nPhasors, wait, callback=lambda block: None)
+            for now, pmu, columns in events:
+                aligner.add(pmu, columns, now)
+            aligner.poll(events[-1][0] + wait)
+            return aligner
+
+        aligner, emitted = ring(), dict_align(events, nPmus, data_rate, wait, nPhasors)
+        stats = aligner.stats()
+        if stats['emitted'] != nFrames or emitted != nFrames:
+            raise AssertionError('not all the slots were emitted')
+
+        t_ring = measure(ring, repeat, warmup=1)['p50']
+        t_dict = measure(lambda: dict_align(events, nPmus, data_rate, wait, nPhasors), repeat, warmup=1)['p50']
+
+        print('\t{} frame(s) at a time: {} complete, {} late frames'.format(batch, stats['complete'], sum(stats['late'])))
+        print('\t\tdict of dicts: {:.2f} us/frame'.format(t_dict/nPmus/nFrames*1e6))
+        print('\t\tring:          {:.2f} us/frame ({:.1f}x)'.format(t_ring/nPmus/nFrames*1e6, t_dict/t_ring))
+
+def udp_listener(group=None):
+    '''
+    Returns a UDP socket bound on a free port of the loopback, member of the multicast group if given,
+    and a thread collecting the frames it receives (split by FRAMESIZE) into a list, until the socket is silent for 0.5 s.
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    if group:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', 0))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(group) + socket.inet_aton('127.0.0.1'))
+    else:
+        sock.bind(('127.0.0.1', 0))
+    sock.settimeout(0.5)
+    frames = []
+
+    def receive():
+        try:
+            while True:
+                datagram = sock.recv(65536)
+                while datagram:
+                    size = frame_size(datagram)
+                    frames.append(datagram[:size])
+                    datagram = datagram[size:]
+        except socket.timeout:
+            sock.close()
+
+    thread = threading.Thread(target=receive, daemon=True)
+    thread.start()
+    return sock.getsockname()[1], frames, thread
+
+def bench_udp(nFrames=2000, nPhasors=8, data_rate=50, group='239.1.14.11'):
+    '''
+    Sends nFrames data frames with UdpSender over the loopback to a unicast listener and to a member of a multicast group,
+    at once, queued with a flush deadline, and queued and coalesced; checks that both received all of them, in order.
+    '''
+    cfg = ConfigFrame2(7, 1000000, 1, "Station A", 7734, 15, nPhasors, 0, 0, ['ch{}'.format(i) for i in range(nPhasors)],
+                       [(100000, "v")]*nPhasors, [], [], 50, 1, data_rate)
+    fmt = DataFrameFormat(cfg)
+    data = fake_pmu_frames(fmt, nFrames, int(time.time()), data_rate)
+    frames = [ data[i:i + fmt.size] for i in range(0, len(data), fmt.size) ]
+
+    print('UdpSender {} frames of {} bytes to 127.0.0.1 and {}'.format(nFrames, fmt.size, group))
+    for name, options in (('at once', {}), ('delay 10 ms', { 'delay': 0.01 }), ('delay 10 ms, coalesced', { 'delay': 0.01, 'coalesce': True })):
+        unicast, multicast = udp_listener(), udp_listener(group)
+        sender = UdpSender([('127.0.0.1', unicast[0]), (group, multicast[0])], interface='127.0.0.1', maxsize=nFrames, **options)
+        t = time.perf_counter()
+        for frame in frames:
+            sender.send(frame)
+        sender.close()
+        elapsed = time.perf_counter() - t
+
+        for listener in (unicast, multicast):
+            listener[2].join()
+            if listener[1] != frames:
+                raise AssertionError('{}: {} of {} frames received over UDP, or out of order'.format(name, len(listener[1]), nFrames))
+        stats = sender.stats()
+        print('\t{:24} {:.2f} us/frame, {} datagrams, {} dropped'.format(name, elapsed/nFrames*1e6, stats['datagrams'], stats['dropped']))
+
+def run_suite(channels=CHANNELS, samples=SAMPLES, rates=RATES, repeat=REPEAT):
+    '''
+    Runs every case. Returns the results by case name (the receiver, the aligner and the UDP output are only printed).
+    '''
+    results = {}
+    for nChannels in channels:
+        for nSamples in samples:
+            bench_read(results, nChannels, nSamples, repeat)
+            bench_estimation(results, nChannels, nSamples, repeat)
+        for rate in rates:
+            bench_sliding(results, nChannels, rate, repeat)
+        bench_framing(results, nChannels, repeat)
+    for nSamples in samples:
+        bench_zero_crossings(results, nSamples, repeat)
+        bench_windowed_fft(results, nSamples, repeat)
+    for name, info in cache_info().items():
+        print('{} cache: {} hits, {} misses'.format(name, info['hits'], info['misses']))
+
+    bench_receiver()
+    bench_aligner()
+    bench_udp()
+    return results
+
+def environment(repeat=REPEAT):
+    '''
+    Returns what the results depend on, other than the code: machine, python and numpy.
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.realpath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': commit or None,
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'repeat': repeat
+    }
+
+def save(results, directory, repeat=REPEAT):
+    '''
+    Saves the results with the environment into a new file of directory. Returns its path.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    meta = environment(repeat)
+    path = os.path.join(directory, 'bench-{}.json'.format(meta['time'].replace(':', '').replace('+0000', '')))
+    with open(path, 'w') as f:
+        json.dump({ 'meta': meta, 'results': results }, f, indent=1, sort_keys=True)
+    return path
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def previous(directory, exclude=None):
+    '''
+    Returns the path of the latest results in directory (but exclude), None if there are none.
+    '''
+    if not os.path.isdir(directory):
+        return None
+    paths = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.startswith('bench-') and f.endswith('.json'))
+    paths = [ p for p in paths if p != exclude ]
+    return paths[-1] if paths else None
+
+def compare(old, new, threshold=REGRESSION):
+    '''
+    Compares the results new with old (as saved): prints the change of the p50 latency and of the memory allocated of every
+    case in both. Returns the names of the cases slower (or allocating more) than old by more than threshold:
+    slower at p50 and at best, so that a run disturbed by the other processes doesn't show as a regression.
+    '''
+    if old['meta']['machine'] != new['meta']['machine'] or old['meta']['python'] != new['meta']['python']:
+        print('Warning: the results were measured on another machine or python: {} {} vs {} {}'.format(
+              old['meta']['machine'], old['meta']['python'], new['meta']['machine'], new['meta']['python']))
+
+    regressions = []
+    for name in sorted(set(old['results']) & set(new['results'])):
+        a, b = old['results'][name], new['results'][name]
+        latency = b['p50']/a['p50']
+        best = b['min']/a['min'] if 'min' in a else latency
+        memory = (b['alloc_peak'] + 1024)/(a['alloc_peak'] + 1024) # a few objects more are not a regression
+        flag = ''
+        if min(latency, best) > 1 + threshold or memory > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif latency < 1/(1 + threshold):
+            flag = 'faster'
+        print('{:40} p50 {:9.3f} -> {:9.3f} ms ({:+5.0%})  alloc {:9} -> {:9} B  {}'.format(
+              name, a['p50']*1000, b['p50']*1000, latency - 1, a['alloc_peak'], b['alloc_peak'], flag))
+    return regressions
+
+def report(results):
+    print('{:40} {:>9} {:>9} {:>9} {:>10} {:>14}'.format('case', 'p50 ms', 'p99 ms', 'max ms', 'alloc B', 'items/s'))
+    for name, r in results.items():
+        print('{:40} {:9.3f} {:9.3f} {:9.3f} {:10} {:14.0f}'.format(name, r['p50']*1000, r['p99']*1000, r['max']*1000, r['alloc_peak'], r['throughput']))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks of the PMU and of the PDC.')
+    parser.add_argument('baseline', nargs='?', help='results to compare with (default: the previous ones in --out)')
+    parser.add_argument('--out', help='directory the results are saved into (default: not saved)')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='runs of every case')
+    args = parser.parse_args()
+
+    results = run_suite(repeat=args.repeat)
+    report(results)
+    path = None
+    if args.out:
+        path = save(results, args.out, args.repeat)
+        print('Saved to', path)
+
+    baseline = args.baseline or (args.out and previous(args.out, exclude=path))
+    if baseline:
+        print('Compared with', baseline)
+        regressions = compare(load(baseline), { 'meta': environment(args.repeat), 'results': results })
+        print('{} regression(s)'.format(len(regressions)))
+        sys.exit(1 if regressions else 0)
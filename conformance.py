@@ -0,0 +1,151 @@
+from estimator import *
+from signals import Scenario, three_phase
+import argparse
+import json
+import sys
+import time
+import numpy as np
+'''
+This file implements the conformance harness of the estimator: it runs the test conditions of IEEE C37.118.1
+(off-nominal frequency, harmonics, amplitude and phase modulation, frequency ramps) through every backend
+and measures, against the true synchrophasors of the test signals (signals.Signal.phasor), the errors of
+the estimates, TVE (total vector error), FE (frequency error) and RFE (ROCOF error), together with the CPU time
+of an estimate: a faster backend can be compared with the others on both, in one report.
+The backends are the ones of estimate_phasors on PPS triggered scans, timestamped at their first sample,
+and the sliding estimator, timestamped at the center of its window.
+This is a measurement, not a passing result: the fft, dft and batch backends refer the phase of the window to the
+interpolated time of its first zero crossing instead of to the time of its first sample, and fail the TVE limit
+even in steady state (about 21%).
+    python3 conformance.py [--out PATH]
+prints the report and writes the results as JSON to PATH; to stdout by default, the report going to stderr then.
+'''
+
+NOMINAL = 50 #nominal frequency
+S_FREQ = 10000 #sampling frequency of every channel
+N_SAMPLES = 2400 #samples per channel of the triggered scans
+SECONDS = 10 #seconds of every condition
+SLIDING_RATE = 10 #reports per second of the sliding estimator
+TVE_LIMIT = 0.01 #1%, the TVE limit of C37.118.1
+ESTIMATORS = BACKENDS + ('sliding',) #the backends of estimate_phasors and the sliding estimator
+
+def conditions(nFreq=NOMINAL):
+    '''
+    Returns the test conditions: (name, options of the signals, seconds).
+    '''
+    tests = [ ('steady state', {}, SECONDS) ]
+    tests += [ ('frequency {:+g} Hz'.format(df), { 'frequency': nFreq + df }, SECONDS) for df in (-2, -1, -0.5, 0.5, 1, 2) ]
+    tests += [ ('harmonic {} 10%'.format(order), { 'harmonics': [(order, 0.1, 0)] }, SECONDS) for order in (2, 3, 5, 7, 13, 25, 50) ]
+    tests += [ ('amplitude modulation {:g} Hz'.format(fm), { 'modulation': (0.1, 0, fm) }, SECONDS) for fm in (0.1, 0.5, 1, 2) ]
+    tests += [ ('phase modulation {:g} Hz'.format(fm), { 'modulation': (0, 0.1, fm) }, SECONDS) for fm in (0.1, 0.5, 1, 2) ]
+    # within nFreq +-2 Hz
+    tests += [ ('ramp {:+g} Hz/s'.format(rate), { 'frequency': nFreq - 2*np.sign(rate), 'ramp': rate }, int(4/abs(rate))) for rate in (1, -1) ]
+    return tests
+
+def estimates_triggered(signals, seconds, backend):
+    '''
+    Returns the estimates of the triggered scans of the signals by estimate_phasors, as arrays (estimate, channel)
+    of time, amplitude, phase, frequency and rocof, and the CPU time of an estimate of one channel.
+    '''
+    scenario = Scenario(signals, S_FREQ, seed=0)
+    rows, cpu = [], 0
+    for scan in scenario.scans(N_SAMPLES, seconds):
+        t = time.process_time()
+        sph = estimate_phasors(scan, backend)
+        cpu += time.process_time() - t
+        rows.append([ (scan['timestamp'], sph[c]['amplitude'], sph[c]['phase'], sph[c]['avg_freq'], sph[c]['rocof']) for c in sph ])
+    return np.array(rows, float).transpose(2, 0, 1), cpu/(len(rows)*len(signals))
+
+def estimates_sliding(signals, seconds, rate=SLIDING_RATE, settling=2):
+    '''
+    Same as estimates_triggered, for the sliding estimator reporting rate times per second, once its window is full.
+    The first settling reports are left out: the frequency needs the previous one, the rocof the two previous ones.
+    '''
+    step = S_FREQ//rate
+    estimator = SlidingEstimator(len(signals), S_FREQ, NOMINAL)
+    channels = list(range(len(signals)))
+    rows, cpu, reports = [], 0, 0
+    for start, volts in Scenario(signals, S_FREQ, seed=0).chunks(seconds, step):
+        t = time.process_time()
+        full = estimator.update(volts, start)
+        if full:
+            sph = estimator.estimate(channels, 1/rate)
+        cpu += time.process_time() - t
+        if full:
+            reports += 1
+            if reports > settling:
+                center = (start + volts.shape[1] - estimator.window/2)/S_FREQ
+                rows.append([ (center, sph[c]['amplitude'], sph[c]['phase'], sph[c]['avg_freq'], sph[c]['rocof']) for c in channels ])
+    return np.array(rows, float).transpose(2, 0, 1), cpu/(reports*len(signals))
+
+def errors(signals, estimates):
+    '''
+    Returns the TVE, FE and RFE of the estimates (see estimates_triggered) against the true synchrophasors, (estimate, channel).
+    '''
+    t, amplitude, phase, frequency, rocof = estimates
+    tve, fe, rfe = np.empty_like(t), np.empty_like(t), np.empty_like(t)
+    for c, signal in enumerate(signals):
+        true_amplitude, true_phase, true_frequency, true_rocof = signal.phasor(t[:, c], NOMINAL)
+        true_phasor = true_amplitude*np.exp(1j*true_phase)
+        tve[:, c] = np.abs(amplitude[:, c]*np.exp(1j*phase[:, c]) - true_phasor)/np.abs(true_phasor)
+        fe[:, c] = np.abs(frequency[:, c] - true_frequency)
+        rfe[:, c] = np.abs(rocof[:, c] - true_rocof)
+    return tve, fe, rfe
+
+def run(backends=ESTIMATORS, tests=None, nChannels=3):
+    '''
+    Runs the test conditions through the backends, on nChannels three phase channels.
+    Returns a list of dictionaries: condition, backend, the maximum TVE, FE, RFE, the mean TVE and the CPU time of an estimate.
+    '''
+    results = []
+    for name, options, seconds in tests or conditions():
+        options = dict(options)
+        signals = three_phase(amplitude=3.0, frequency=options.pop('frequency', NOMINAL), nChannels=nChannels, **options)
+        for backend in backends:
+            if backend == 'sliding':
+                estimates, cpu = estimates_sliding(signals, seconds)
+            else:
+                estimates, cpu = estimates_triggered(signals, seconds, backend)
+            tve, fe, rfe = errors(signals, estimates)
+            results.append({
+                'condition': name,
+                'backend': backend,
+                'tve': float(tve.max()),
+                'mean_tve': float(tve.mean()),
+                'fe': float(fe.max()),
+                'rfe': float(rfe.max()),
+                'cpu': cpu,
+                'estimates': tve.size
+            })
+    return results
+
+def report(results, file=None):
+    '''
+    Prints the errors and the CPU time of every condition and backend, and the worst of every backend, to file (default stdout).
+    '''
+    print('{:28} {:8} {:>9} {:>9} {:>10} {:>10}  {}'.format('condition', 'backend', 'TVE %', 'FE Hz', 'RFE Hz/s', 'CPU us', ''), file=file)
+    for r in results:
+        print('{:28} {:8} {:9.3f} {:9.4f} {:10.3f} {:10.1f}  {}'.format(r['condition'], r['backend'], r['tve']*100, r['fe'], r['rfe'],
+              r['cpu']*1e6, 'TVE > {:g}%'.format(TVE_LIMIT*100) if r['tve'] > TVE_LIMIT else ''), file=file)
+
+    print(file=file)
+    print('{:8} {:>14} {:>12} {:>10}'.format('backend', 'worst TVE %', 'conditions', 'CPU us'), file=file)
+    for backend in dict.fromkeys(r['backend'] for r in results):
+        rs = [ r for r in results if r['backend'] == backend ]
+        passed = sum(r['tve'] <= TVE_LIMIT for r in rs)
+        print('{:8} {:14.3f} {:>12} {:10.1f}'.format(backend, max(r['tve'] for r in rs)*100, '{}/{}'.format(passed, len(rs)),
+              np.mean([ r['cpu'] for r in rs ])*1e6), file=file)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Conformance of the estimators to the test conditions of IEEE C37.118.1.')
+    parser.add_argument('--out', default='-', help='path of the JSON results, - for stdout (default)')
+    args = parser.parse_args()
+
+    results = run()
+    if args.out == '-':
+        report(results, sys.stderr)
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    else:
+        report(results)
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
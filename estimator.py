@@ -1,29 +1,30 @@
 import numpy as np
 import math
+import functools
 from random import random
 from pprint import pprint
 from redlab import *
-import RPi.GPIO as gpio
+from signals import Signal, Scenario
+try:
+    import RPi.GPIO as gpio
+except ImportError: #not on a raspberry: only the software PPS (see simulator.SoftPPS)
+    gpio = None
 
 
 NOISE_THRESHOLD = 0.05
 
 def zero_crossing_indexes(samples):
     '''
-    samples = list of samples 
-    returns: list of the samples' indexes after the sign change occurs. 
+    samples = array of samples 
+    returns: array of the samples' indexes after the sign change occurs. 
     Can be set from positive to negative or viceversa.
     '''
-    last = -1
-    zeroIndexes = []
-    
-    for i, current in enumerate(samples):
-        if current < 0 and last >= 0:   #swap this two lines to change 
-        #if current > 0 and last <= 0: 
-            zeroIndexes.append(i)
-        last = current
+    samples = np.asarray(samples)
+
+    crossings = (samples[1:] < 0) & (samples[:-1] >= 0)   #swap the comparisons to change 
+    #crossings = (samples[1:] > 0) & (samples[:-1] <= 0)
 
-    return zeroIndexes
+    return np.flatnonzero(crossings) + 1
 
 def zero_cross_offset(s1, s2, Ts):
     '''
@@ -36,40 +37,33 @@ def zero_cross_offset(s1, s2, Ts):
 
 def zero_crossing_times(samples, frequency, zero_indexes):
     '''
-    Returns the list of times where the zeros(only positive to negative or viceversa) occur.
-    Interpolates the samples before and after the zeros.
+    Returns the array of times where the zeros(only positive to negative or viceversa) occur.
+    Interpolates the samples before and after the zeros, all at once.
     '''
-
-    zero_crossing_times = []
+    samples = np.asarray(samples)
+    zero_indexes = np.asarray(zero_indexes)
 
     Ts = 1/frequency
 
-    for zi in zero_indexes:
-        a, b = zero_cross_offset(samples[zi-1], samples[zi], Ts)
-        zero_crossing_times.append(zi*Ts-b)
+    a, b = zero_cross_offset(samples[zero_indexes-1], samples[zero_indexes], Ts)
 
-    return zero_crossing_times
+    return zero_indexes*Ts-b
 
 def get_periods(zero_crossing_times):
     '''
-    Returns the list of periods found as the difference between two consecutives zero times
+    Returns the array of periods found as the difference between two consecutives zero times
     '''
-    
-    ps = []
 
-    for i in range(1, len(zero_crossing_times)):
-        ps.append(zero_crossing_times[i] - zero_crossing_times[i-1])
-        
-    return ps
+    return np.diff(zero_crossing_times)
 
 def get_rocof(periods):
     '''
     Calculates Rocof index as the difference between the reciprocal of the first period and the last found.
+    0 if less than 2 periods are found, as in zero_crossings_batch (the rocof of the data frame is a number).
     '''
     if len(periods) >= 2:
         return 1/periods[0] - 1/periods[-1]
-    else:
-        print('Impossible to calculate rocof: less then 2 periods found')
+    return 0.0
 
 def get_average_frequency(periods):
     '''
@@ -81,31 +75,144 @@ def get_average_frequency(periods):
     else:
         print('Impossibile frequenza media: nessun periodo trovato')
 
-def windowed_fft(samples, zero_crossing_indexes, s_freq, offset_a, offset_b, a_freq, nSamples):
+def fundamental_window(zero_crossing_indexes, s_freq, a_freq):
+    '''
+    Returns the start and the length of the window made of the maximum number of whole periods 
+    starting at the first zero crossing, and the index of the fondamental phasor in its DFT.
     '''
-    Calculates the DFT of the samples passed using FFT functions from numpy lib.
-    Returns the array of phasors, the array of the frequencies corrisponding to the phasors calculated, and the index of the fondamental phasor.
-    '''    
     Ts = 1/s_freq
     samples_per_period = int(s_freq/a_freq) # for best results s_freq and a_freq should be multiples
     periods_taken = (zero_crossing_indexes[-1] - (zero_crossing_indexes[0]-1))//samples_per_period  #number of periods taken
 
     window_length = periods_taken*samples_per_period #The window length is maximum multiple of the period
     window_start = zero_crossing_indexes[0]-1
-    window_end = window_length + window_start
-    window = samples[ window_start: window_end]
 
-    frequencies = np.fft.fftfreq(len(window), d=Ts)
-    phasors = np.fft.fft(window)
+    imax = int(round(window_length*Ts*a_freq)) #the index of the fondamental phasor is calculated aproximating windowLength*SamplingPeriod*AverageFrequency.
 
-    imax = int(round(len(window)*Ts*a_freq)) #the index of the fondamental phasor is calculated aproximating windowLength*SamplingPeriod*AverageFrequency.
+    return window_start, window_length, imax
+
+def windowed_fft(samples, zero_crossing_indexes, s_freq, offset_a, offset_b, a_freq, nSamples):
+    '''
+    Calculates the DFT of the samples passed using FFT functions from numpy lib.
+    Returns the array of phasors, the array of the frequencies corrisponding to the phasors calculated, and the index of the fondamental phasor.
+    '''    
+    Ts = 1/s_freq
+    window_start, window_length, imax = fundamental_window(zero_crossing_indexes, s_freq, a_freq)
+    window = samples[ window_start: window_start + window_length]
+
+    frequencies = fft_frequencies(len(window), s_freq)
+    phasors = np.fft.fft(window)
 
     phaseShift = 2*np.pi*frequencies[imax]*((zero_crossing_indexes[0])*Ts-offset_b) #the phase shift is calculated interpolating the samples where the window starts.
     phasors = phasors*np.exp(-1j*phaseShift)
     
     return phasors, frequencies, imax
 
-def estimate_phasors(scan):
+CACHE_SIZE = 128 # window lengths and bins recurring across channels and seconds
+
+def read_only(array):
+    '''
+    Marks a cached array as read only, so that no caller can alter the copy shared with the others.
+    '''
+    array.flags.writeable = False
+    return array
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def fft_frequencies(window_length, s_freq):
+    '''
+    Returns the (cached, read only) frequency axis of the FFT of a window of window_length samples, as np.fft.fftfreq.
+    '''
+    return read_only(np.fft.fftfreq(window_length, d=1/s_freq))
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def dft_kernel(window_length, k):
+    '''
+    Returns the (cached, read only) complex exponential that correlated with a window of window_length samples 
+    gives its k-th DFT bin.
+    '''
+    return read_only(np.exp(-2j*np.pi*k/window_length*np.arange(window_length)))
+
+def cache_info():
+    '''
+    Returns the hits, misses and size of the caches of the frequency axes and of the DFT kernels.
+    Once the window lengths of the signal have been seen, every estimation should only hit.
+    '''
+    return { cache.__name__: cache.cache_info()._asdict() for cache in (fft_frequencies, dft_kernel) }
+
+def windowed_dft(samples, zero_crossing_indexes, s_freq, offset_a, offset_b, a_freq, nSamples):
+    '''
+    Single bin alternative to windowed_fft: on the same window, calculates only the fondamental phasor, 
+    correlating the window with the complex exponential of its bin instead of computing the full FFT.
+    Returns the fondamental phasor (already phase shifted), its frequency and the window length.
+    '''
+    Ts = 1/s_freq
+    window_start, window_length, imax = fundamental_window(zero_crossing_indexes, s_freq, a_freq)
+    window = np.asarray(samples[ window_start: window_start + window_length])
+
+    kernel = dft_kernel(window_length, imax)
+    phasor = window @ kernel.real + 1j*(window @ kernel.imag)
+    frequency = imax*(1.0/(window_length*Ts)) # as np.fft.fftfreq
+
+    phaseShift = 2*np.pi*frequency*((zero_crossing_indexes[0])*Ts-offset_b)
+    
+    return phasor*np.exp(-1j*phaseShift), frequency, window_length
+
+def single_bin_dft(samples, window_starts, window_lengths, bins):
+    '''
+    Calculates at once, for every row of the (channels, samples) matrix, the single DFT bin of the row's window.
+    window_starts, window_lengths, bins: one element per row.
+    Rows sharing the same window length and bin (usually all of them) share one complex exponential kernel:
+    their windows are gathered in a matrix and multiplied by the kernel in a single product.
+    Returns the array of the (unshifted) phasors, equal to np.fft.fft(window)[bin] of every row.
+    '''
+    phasors = np.empty(len(bins), dtype=complex)
+    groups = {}
+    for row, key in enumerate(zip(window_lengths, bins)):
+        groups.setdefault(key, []).append(row)
+
+    for (length, k), rows in groups.items():
+        kernel = dft_kernel(length, k)
+        windows = samples[np.array(rows)[:, np.newaxis], window_starts[rows][:, np.newaxis] + np.arange(length)]
+        phasors[rows] = windows @ kernel.real + 1j*(windows @ kernel.imag)
+
+    return phasors
+
+def empty_phasor():
+    '''
+    Result of a channel where the phasor can't be estimated (not enough zero crossings or under the noise threshold).
+    '''
+    return {
+        'rocof': 0,
+        'avg_freq': 0,
+        'amplitude': 0,
+        'phase_deg' : 0,
+        'phase' : 0,
+        'fft_freq' : 0,
+        'phasor' : (0,0)
+    }
+
+def make_phasor(p, window_length, fft_freq, avg_freq, rocof):
+    '''
+    Fills the result dictionary of a channel from its fondamental phasor p, applying the noise threshold.
+    '''
+    amplitude = 2*np.abs(p)/window_length
+
+    if amplitude < NOISE_THRESHOLD: #Noise treshold
+        return empty_phasor()
+
+    return {
+        'rocof': rocof,
+        'avg_freq': avg_freq,
+        'amplitude': amplitude,
+        'phase_deg' : (np.angle(p, True) + 360) % 360,
+        'phase' : np.angle(p, False),
+        'fft_freq' : fft_freq,
+        'phasor' : p
+    }
+
+BACKENDS = ('fft', 'dft', 'batch')
+
+def estimate_phasors(scan, backend='fft'):
     '''
     Returns a dictionary containing all the channels' estimated fondamental phasors
 
@@ -118,8 +225,18 @@ def estimate_phasors(scan):
         + rocof )
                                                                 
     Size: Channels*phasor
+
+    backend: how the fondamental phasor is calculated
+        'fft'   = full FFT of the window of every channel (windowed_fft)
+        'dft'   = single bin correlation on the same window of every channel (windowed_dft)
+        'batch' = all the channels at once (estimate_phasors_batch)
     '''
 
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend {}, must be one of {}".format(backend, BACKENDS))
+    if backend == 'batch':
+        return estimate_phasors_batch(scan)
+
     result = {}
 
     for chan in scan['channels']: #cycles on channels
@@ -128,16 +245,7 @@ def estimate_phasors(scan):
 
         if len(zc_indexes) < 2:
             # Not enough zero crossings found
-
-            result[chan] = {  
-                'rocof': 0,
-                'avg_freq': 0,
-                'amplitude': 0,
-                'phase_deg' : 0,
-                'phase' : 0,
-                'fft_freq' : 0,
-                'phasor' : (0,0)
-            }
+            result[chan] = empty_phasor()
             continue
 
         zc_times = zero_crossing_times(samples['volts'], scan['frequency'], zc_indexes) #Step 2: times
@@ -151,95 +259,249 @@ def estimate_phasors(scan):
         Ts = 1/scan['frequency']
         offset_a, offset_b = zero_cross_offset(s1, s2, Ts) #Step 5: interpolation
 
-        phasors, frequencies, imax = windowed_fft(  samples['volts'], #Step 6: FFT
-                                                    zc_indexes, 
-                                                    scan['frequency'], 
-                                                    offset_a,
-                                                    offset_b,
-                                                    avg_freq, 
-                                                    scan['samples'])
-
-        p = phasors[imax]
-
-        if 2*np.abs(p)/len(phasors) < NOISE_THRESHOLD: #Noise treshold
-            result[chan] = {    #Step 6: Dictionary filling
-                'rocof': 0,
-                'avg_freq': 0,
-                'amplitude': 0,
-                'phase_deg' : 0,
-                'phase' : 0,
-                'fft_freq' : 0,
-                'phasor' : (0,0)
-            }
+        if backend == 'fft':
+            phasors, frequencies, imax = windowed_fft(  samples['volts'], #Step 6: FFT
+                                                        zc_indexes, 
+                                                        scan['frequency'], 
+                                                        offset_a,
+                                                        offset_b,
+                                                        avg_freq, 
+                                                        scan['samples'])
+            p, fft_freq, window_length = phasors[imax], frequencies[imax], len(phasors)
         else:
-            result[chan] = {    #Step 6: Dictionary filling
-                'rocof': rocof,
-                'avg_freq': avg_freq,
-                'amplitude': 2*np.abs(p)/len(phasors),
-                'phase_deg' : (np.angle(p, True) + 360) % 360,
-                'phase' : np.angle(p, False),
-                'fft_freq' : frequencies[imax],
-                'phasor' : p
-            }
+            p, fft_freq, window_length = windowed_dft(samples['volts'], zc_indexes, scan['frequency'], offset_a, offset_b, avg_freq, scan['samples'])
+
+        result[chan] = make_phasor(p, window_length, fft_freq, avg_freq, rocof) #Step 7: Dictionary filling
         
     return result
 
+def zero_crossings_batch(volts, s_freq):
+    '''
+    Zero crossings of all the rows of the (channels, samples) matrix at once.
+    Returns, one element per row: the number of zero crossings, the index of the first and of the last one,
+    the interpolation offset_b of the first one, the average frequency and the rocof 
+    (all 0 where less than 2 zero crossings are found).
+    '''
+    nChannels = volts.shape[0]
+    Ts = 1/s_freq
 
+    rows, indexes = np.nonzero((volts[:, 1:] < 0) & (volts[:, :-1] >= 0)) # row major, as zero_crossing_indexes
+    indexes += 1
+    counts = np.bincount(rows, minlength=nChannels)
 
+    first, last = np.zeros(nChannels, dtype=int), np.zeros(nChannels, dtype=int)
+    offset_b, avg_freq, rocof = np.zeros(nChannels), np.zeros(nChannels), np.zeros(nChannels)
 
+    valid = np.flatnonzero(counts >= 2)
+    if len(valid) == 0:
+        return counts, first, last, offset_b, avg_freq, rocof
 
-def fake_cos(frequency, phase, sampleFrequency=10000, nSamples=1600, A=3):
+    s1, s2 = volts[rows, indexes-1], volts[rows, indexes]
+    offsets_b = s2*Ts/(s2-s1)
+    times = indexes*Ts - offsets_b
+
+    end = np.cumsum(counts)
+    start = end - counts
+    first[valid], last[valid], offset_b[valid] = indexes[start[valid]], indexes[end[valid]-1], offsets_b[start[valid]]
+
+    with np.errstate(divide='ignore'):
+        frequencies = 1/np.diff(times)     # the differences across two rows are discarded below
+    same_row = rows[1:] == rows[:-1]
+    avg_freq[valid] = np.bincount(rows[1:][same_row], frequencies[same_row], minlength=nChannels)[valid]/(counts[valid]-1)
+    rocof[valid] = frequencies[start[valid]] - frequencies[end[valid]-2]
+
+    return counts, first, last, offset_b, avg_freq, rocof
+
+def estimate_phasors_batch(scan):
     '''
-    Simulates the sampling of a Cos signal. Use: for tests. Returns a volt type array of fake samples
+    Same as estimate_phasors, but all the channels are processed at once from the (channels, samples) matrix 
+    of the scan: the zero crossings with zero_crossings_batch and the fondamental phasors with 
+    a targeted single bin DFT (see single_bin_dft) instead of one full FFT per channel.
     '''
+    chans = list(scan['channels'])
+    if 'volts' in scan:
+        volts = scan['volts']
+    else:
+        volts = np.array([scan['channels'][c]['volts'] for c in chans])
 
-    volts = []
+    s_freq = scan['frequency']
+    Ts = 1/s_freq
+    counts, first, last, offset_b, avg_freq, rocof = zero_crossings_batch(volts, s_freq)
 
-    for i in range(nSamples):
-        t = i/sampleFrequency
-        volts.append( A*math.cos( 2*np.pi*frequency*t + phase))
-    
-    return volts
+    valid = counts >= 2
+    samples_per_period = (s_freq/np.where(valid, avg_freq, 1)).astype(int)
+    lengths = (last - (first-1))//np.maximum(samples_per_period, 1)*samples_per_period
+    valid &= lengths > 0
+    rows = np.flatnonzero(valid)
+
+    result = { c: empty_phasor() for c in chans }
+    if len(rows) == 0:
+        return result
+
+    lengths = lengths[rows]
+    bins = np.round(lengths*Ts*avg_freq[rows]).astype(int)
+    phasors = single_bin_dft(volts[rows], first[rows]-1, lengths, bins)
+
+    frequencies = bins*(1.0/(lengths*Ts)) # as np.fft.fftfreq
+    phasors = phasors*np.exp(-2j*np.pi*frequencies*(first[rows]*Ts - offset_b[rows]))
+
+    for i, row in enumerate(rows):
+        result[chans[row]] = make_phasor(phasors[i], lengths[i], frequencies[i], avg_freq[row], rocof[row])
+
+    return result
+
+
+class SlidingEstimator:
+    '''
+    Estimates the phasors of a continuous stream of samples at any reporting rate, 
+    with a recursive sliding DFT at the nominal frequency over a window of a whole number of nominal cycles.
+    The DFT kernel is indexed by the absolute sample index of the stream (sample 0 = PPS trigger of the scan),
+    so that the phases are referred to the nominal cosine synchronized with the PPS.
+    Every new sample only adds its own term and removes the one of the sample leaving the window:
+    the cost of an update is proportional to the new samples, not to the window.
+    This pays off only when the reports are closer than a window (rate > nFreq/cycles, 12.5 reports per second
+    with 4 cycles at 50 Hz): with fewer reports the update gets a whole window, or more, and recomputes the DFT from it.
+    '''
+
+    def __init__(self, nChannels, s_freq, nFreq=50, cycles=4, refresh=1):
+        '''
+        nChannels = number of channels (rows of the volts matrices given to update)
+        s_freq = sampling frequency of every channel, must be a multiple of nFreq
+        cycles = nominal cycles in the window
+        refresh = every how many seconds the DFT is recomputed from scratch, to drop the rounding errors of the recursion
+        '''
+        if s_freq % nFreq:
+            raise ValueError("The sampling frequency must be a multiple of the nominal frequency.")
+
+        self.s_freq = s_freq
+        self.nFreq = nFreq
+        self.window = int(s_freq//nFreq*cycles)
+        self.refresh = int(refresh*s_freq)
+
+        self.kernel = dft_kernel(self.window, cycles)
+        self.history = np.zeros((nChannels, self.window)) # sample n is kept in the column n % window
+        self.reset()
+
+    def reset(self):
+        '''
+        Forgets the samples: the next update must contain at least a whole window.
+        '''
+        self.X = np.zeros(self.history.shape[0], dtype=complex)
+        self.next = None                # absolute index of the next expected sample
+        self.last_refresh = 0
+        self.last_phase = None
+        self.last_freq = None
+
+    def update(self, volts, start):
+        '''
+        Adds the (channels, samples) matrix of volts, whose first sample has absolute index start.
+        A whole window (or more) replaces the previous samples, the DFT is recomputed from it.
+        Otherwise, if the samples don't follow the previous ones the estimator restarts from them.
+        Returns False if the window is not full yet.
+        '''
+        n = volts.shape[1]
+        columns = (start + np.arange(min(n, self.window)) + max(0, n - self.window)) % self.window
+
+        if start != self.next or n >= self.window:
+            if n < self.window:
+                self.reset()
+                return False
+            self.history[:, columns] = volts[:, -self.window:]
+            self.X = self.history @ self.kernel
+            self.last_refresh = start + n
+        else:
+            self.X += (volts - self.history[:, columns]) @ self.kernel[columns]
+            self.history[:, columns] = volts
+            if start + n - self.last_refresh >= self.refresh:
+                self.X = self.history @ self.kernel
+                self.last_refresh = start + n
+
+        self.next = start + n
+        return True
+
+    def estimate(self, channels, interval):
+        '''
+        Returns the phasors of the current window as estimate_phasors does, one per channel name.
+        The frequency is the nominal one plus the phase rotation since the estimate of interval seconds before,
+        the rocof is the frequency change over the same interval.
+        '''
+        phase = np.angle(self.X)
+        freq = np.full(len(phase), float(self.nFreq))
+        rocof = np.zeros(len(phase))
+
+        if self.last_phase is not None:
+            rotation = (phase - self.last_phase + np.pi) % (2*np.pi) - np.pi
+            freq += rotation/(2*np.pi*interval)
+            if self.last_freq is not None:
+                rocof = (freq - self.last_freq)/interval
+            self.last_freq = freq
+        self.last_phase = phase
+
+        result = {}
+        for i, chan in enumerate(channels):
+            result[chan] = make_phasor(self.X[i], self.window, self.nFreq, freq[i], rocof[i])
+        return result
+
+def sliding_loop(redlab, estimator, rate, callback, histogram=None):
+    '''
+    Feeds the estimator with the stream of a continuous mode redlab and calls callback(phasors, scan) 
+    rate times per second, until the stream is stopped.
+    The reports are on a grid of s_freq/rate samples from the start of the stream (the PPS), 
+    every one from the window centered on it; scan['index'] is the absolute index of the report.
+    When the reports are a window apart or more, only the window of every report is read (see SlidingEstimator).
+    histogram = metrics.Histogram observing the time of every update and estimate, if any
+    '''
+    step = int(round(estimator.s_freq/rate))
+    half = estimator.window//2
+    index = None
+
+    while redlab.streaming:
+        if index is None: # (re)synchronize on the next report of the grid
+            with redlab.stream_cond:
+                count = redlab.stream_count
+            index = max(count//step + 1, math.ceil((half + estimator.window)/step))*step
+            start = index - half - estimator.window
+
+        start = max(start, index + half - estimator.window) # the samples before the window are not needed
+        scan = redlab.read_window(start, index + half)
+        if scan is None:
+            index = None
+            estimator.reset()
+            continue
+
+        t = time.perf_counter()
+        if estimator.update(scan['volts'], start):
+            sph = estimator.estimate(list(scan['channels']), step/estimator.s_freq)
+            if histogram:
+                histogram.observe(time.perf_counter() - t)
+            scan['index'] = index
+            callback(sph, scan)
+
+        start, index = index + half, index + step
+
+
+def fake_cos(frequency, phase, sampleFrequency=10000, nSamples=1600, A=3):
+    '''
+    Simulates the sampling of a Cos signal. Use: for tests. Returns a numpy array of volts (see signals.Signal)
+    '''
+    return Signal(A, frequency, phase).volts(np.arange(nSamples)/sampleFrequency)
+
+FAKE_PHASES = [0, np.pi/4, np.pi/3, np.pi/2, np.pi/5, np.pi/6, np.pi/12, np.pi/18]
 
-def fake_scan(sFreq, samples, nFreq):
+def fake_scan(sFreq, samples, nFreq, nChannels=8, **options):
     '''
-    Returns a fake scan of 8 channels
+    Returns a fake scan of nChannels channels (numbered from 1), like the ones of Redlab.read
     sFreq = sampling frequency
     samples = number of samples for each channel
     nFreq = nominal Frequency
+    options = the other parameters of the signals (see signals.Signal), e.g. harmonics or noise
+    The channel c is at nFreq + (c - 6)/100 Hz.
     '''
-    fake_scan = {
-            'frequency': sFreq, 
-            'samples': samples, 
-            'nFreq': nFreq,
-            'channels': {
-                1: {
-                    'volts': fake_cos(nFreq-0.05, 0, sFreq, samples)
-                },
-                2: {
-                    'volts': fake_cos(nFreq-0.04, np.pi/4, sFreq, samples)
-                },
-                3: {
-                    'volts': fake_cos(nFreq-0.03, np.pi/3, sFreq, samples)
-                },
-                4: {
-                    'volts': fake_cos(nFreq-0.02, np.pi/2, sFreq, samples)
-                },
-                5: {
-                    'volts': fake_cos(nFreq-0.01, np.pi/5, sFreq, samples)
-                },
-                6: {
-                    'volts': fake_cos(nFreq, np.pi/6, sFreq, samples)
-                },
-                7: {
-                    'volts': fake_cos(nFreq+0.01, np.pi/12, sFreq, samples)
-                },
-                8: {
-                    'volts': fake_cos(nFreq+0.02, np.pi/18, sFreq, samples)
-                }
-            }
-        }
-    return fake_scan
+    signals = [ Signal(3, nFreq + (c - 5)/100, FAKE_PHASES[c % len(FAKE_PHASES)], **options) for c in range(nChannels) ]
+    scan = next(Scenario(signals, sFreq).scans(samples))
+    scan['channels'] = { c + 1: channel for c, channel in scan['channels'].items() }
+    scan['nFreq'] = nFreq
+    return scan
 
 
 def main1():
@@ -275,8 +537,9 @@ def main2():
     callback = make_callback(r)
     gpio.add_event_callback(18, callback)
 
-    while True:
-        pass
+    wait_for_signals()
+    gpio.cleanup()
+    r.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,265 @@
+from struct import Struct
+import binascii
+import numpy as np
+'''
+This file implements the binary layout of the IEEE C37.118 frames, without the frame objects of pypmu.
+The layout of the data frames is fixed by the configuration frame, so it is compiled once in a struct
+and every frame is only packed into (or unpacked from) a reused buffer; on the PDC side it is compiled
+in a numpy dtype too, to decode at once all the frames received together.
+The command frames of the PDCs are only decoded to their command, the configuration frames to a Config.
+'''
+
+DATA_SYNC = 0xAA01 # SYNC word of the data frames: 0xAA, frame type 0 (data), version 1 (IEEE C37.118-2011)
+FRAME_TYPES = { "data": 0, "header": 1, "cfg1": 2, "cfg2": 3, "cmd": 4, "cfg3": 5 }
+COMMANDS = { 1: "stop", 2: "start", 3: "header", 4: "cfg1", 5: "cfg2", 6: "cfg3", 8: "extended" }
+FRAME_NAMES = { code: name for name, code in FRAME_TYPES.items() }
+COMMAND_CODES = { name: code for code, name in COMMANDS.items() }
+
+def crc_ccitt(data):
+    '''
+    CRC-CCITT of the frame (polynomial 0x1021, initial value 0xFFFF), as the CHK word of C37.118.
+    '''
+    return binascii.crc_hqx(data, 0xffff)
+
+def frame_size(data):
+    '''
+    Returns the FRAMESIZE of the frame starting at the beginning of data (at least 4 bytes), None if it doesn't start with a SYNC word.
+    '''
+    if data[0] != 0xAA:
+        return None
+    return int.from_bytes(data[2:4], "big")
+
+def set_frame_type(frame, frame_type):
+    '''
+    Returns a copy of the bytes of frame with the frame type of its SYNC word changed and the CHK recomputed,
+    e.g. a CFG-1 frame from a CFG-2 one (they have the same layout).
+    '''
+    frame = bytearray(frame)
+    frame[1] = FRAME_TYPES[frame_type] << 4 | frame[1] & 0x0f
+    frame[-2:] = crc_ccitt(frame[:-2]).to_bytes(2, "big")
+    return bytes(frame)
+
+def decode_command(frame):
+    '''
+    Returns the command ("start", "stop", "header", "cfg1", ...) of a command frame,
+    None if frame is not a valid command frame.
+    '''
+    if (len(frame) < 18 or frame[0] != 0xAA or frame[1] >> 4 & 0x7 != FRAME_TYPES["cmd"] 
+            or crc_ccitt(frame[:-2]) != int.from_bytes(frame[-2:], "big")):
+        return None
+    return COMMANDS.get(int.from_bytes(frame[14:16], "big"))
+
+def command_frame(command, id_code):
+    '''
+    Returns the bytes of the command frame ("start", "stop", "header", "cfg2", ...) sent by a PDC to the stream id_code.
+    SOC and FRACSEC are left 0: the PMUs don't use them.
+    '''
+    frame = Struct('>HHHIIH').pack(0xAA00 | FRAME_TYPES["cmd"] << 4 | 1, 18, id_code, 0, 0, COMMAND_CODES[command])
+    return frame + crc_ccitt(frame).to_bytes(2, "big")
+
+def frame_type(frame):
+    '''
+    Returns the type of the frame ("data", "cfg2", ...), None if it doesn't start with a SYNC word.
+    '''
+    if frame[0] != 0xAA:
+        return None
+    return FRAME_NAMES.get(frame[1] >> 4 & 0x7)
+
+def fracsec_word(fracsec, time_quality=0):
+    '''
+    Returns the FRACSEC word: the fraction of second in the lower 24 bits and the time quality code
+    (see CommonFrame.set_frasec of pypmu) in the message time quality bits.
+    '''
+    return time_quality << 24 | fracsec
+
+class Config:
+    '''
+    A CFG-1/CFG-2 frame decoded from its bytes (pypmu can't decode them on recent pythons),
+    with the getters of pypmu's ConfigFrame2 that DataFrameFormat and the PDC use.
+    As in pypmu the getters of the PMU fields return a list only if the stream has more than one PMU.
+    '''
+
+    HEAD = Struct('>HHHIIIH')     # SYNC, FRAMESIZE, IDCODE, SOC, FRACSEC, TIME_BASE, NUM_PMU
+    PMU = Struct('>16sHHHHH')     # STN, IDCODE, FORMAT, PHNMR, ANNMR, DGNMR
+
+    def __init__(self, frame):
+        '''
+        frame = bytes of the whole configuration frame (CHK already checked, see decode_config)
+        '''
+        _, _, self.id_code, self.soc, self.fracsec, time_base, num_pmu = self.HEAD.unpack_from(frame)
+        self.time_base = time_base & 0xffffff
+        self.pmus = []
+
+        offset = self.HEAD.size
+        for _ in range(num_pmu):
+            station, id_code, data_format, phnmr, annmr, dgnmr = self.PMU.unpack_from(frame, offset)
+            offset += self.PMU.size
+
+            nNames = phnmr + annmr + 16*dgnmr
+            names = [ frame[offset + 16*i:offset + 16*(i + 1)].decode('ascii', 'replace').strip() for i in range(nNames) ]
+            offset += 16*nNames
+            units = Struct('>' + 'I'*(phnmr + annmr + dgnmr)).unpack_from(frame, offset)
+            offset += 4*len(units)
+            fnom, cfg_count = Struct('>HH').unpack_from(frame, offset)
+            offset += 4
+
+            self.pmus.append({
+                'station': station.decode('ascii', 'replace').strip(),
+                'id_code': id_code,
+                'format': (bool(data_format & 1), bool(data_format & 2), bool(data_format & 4), bool(data_format & 8)),
+                'phasors': phnmr,
+                'analogs': annmr,
+                'digitals': dgnmr,
+                'channel_names': names,
+                'ph_units': [ (u & 0xffffff, "i" if u >> 24 else "v") for u in units[:phnmr] ], # (factor in 10^-5 V or A, type)
+                'an_units': [ u for u in units[phnmr:phnmr + annmr] ],
+                'dig_units': [ (u >> 16, u & 0xffff) for u in units[phnmr + annmr:] ],
+                'fnom': 50 if fnom & 1 else 60,
+                'cfg_count': cfg_count
+            })
+
+        self.data_rate = Struct('>h').unpack_from(frame, offset)[0]
+
+    def pmu_field(self, name):
+        values = [ pmu[name] for pmu in self.pmus ]
+        return values[0] if len(values) == 1 else values
+
+    def get_id_code(self):
+        return self.id_code
+
+    def get_time_base(self):
+        return self.time_base
+
+    def get_num_pmu(self):
+        return len(self.pmus)
+
+    def get_data_rate(self):
+        return self.data_rate
+
+    def get_station_name(self):
+        return self.pmu_field('station')
+
+    def get_stream_id_code(self):
+        return self.pmu_field('id_code')
+
+    def get_data_format(self):
+        return self.pmu_field('format')
+
+    def get_phasor_num(self):
+        return self.pmu_field('phasors')
+
+    def get_analog_num(self):
+        return self.pmu_field('analogs')
+
+    def get_digital_num(self):
+        return self.pmu_field('digitals')
+
+    def get_channel_names(self):
+        return self.pmu_field('channel_names')
+
+    def get_ph_units(self):
+        return self.pmu_field('ph_units')
+
+    def get_fnom(self):
+        return self.pmu_field('fnom')
+
+def decode_config(frame):
+    '''
+    Returns the Config of a CFG-1 or CFG-2 frame, None if frame is not one or its CHK is wrong.
+    '''
+    if (len(frame) < 24 or frame_type(frame) not in ("cfg1", "cfg2")
+            or crc_ccitt(frame[:-2]) != int.from_bytes(frame[-2:], "big")):
+        return None
+    return Config(bytes(frame))
+
+class DataFrameFormat:
+    '''
+    Byte layout of the data frames of a ConfigFrame2 with one PMU:
+        SYNC, FRAMESIZE, IDCODE, SOC, FRACSEC, STAT, PHASORS, FREQ, DFREQ, ANALOG, DIGITAL, CHK
+    The values are given and returned as pypmu's DataFrame takes them:
+    the phasors (magnitude, angle) or (real, imaginary) flattened in one sequence,
+    integers in the 16 bit formats, floats in the floating point ones.
+    dtype is the same layout as a numpy structured type: decode_many decodes a run of frames at once,
+    without a python object per value.
+    '''
+
+    def __init__(self, cfg, pmu_id=None):
+        '''
+        cfg = ConfigFrame2 (or Config) describing the data stream
+        pmu_id = IDCODE of the data frames, by default the one of cfg
+        '''
+        if cfg.get_num_pmu() != 1:
+            raise ValueError("Only data streams of one PMU are supported.")
+
+        polar, phasor_float, analog_float, freq_float = cfg.get_data_format()
+        self.nPhasors = cfg.get_phasor_num()
+        self.nAnalogs = cfg.get_analog_num()
+        self.nDigitals = cfg.get_digital_num()
+
+        if phasor_float:
+            phasor = 'ff'
+        elif polar:
+            phasor = 'Hh'
+        else:
+            phasor = 'hh'
+        freq = 'f' if freq_float else 'h'
+        analog = 'f' if analog_float else 'h'
+        self.polar = polar
+
+        self.body = Struct('>HHHIIH' + phasor*self.nPhasors + freq*2 + analog*self.nAnalogs + 'H'*self.nDigitals)
+        self.chk = Struct('>H')
+        self.size = self.body.size + self.chk.size
+        self.pmu_id = cfg.get_id_code() if pmu_id is None else pmu_id
+
+        self.buffer = bytearray(self.size)
+        self.view = memoryview(self.buffer)
+
+        fields = [('sync', '>u2'), ('size', '>u2'), ('id_code', '>u2'), ('soc', '>u4'), ('fracsec', '>u4'), ('stat', '>u2'),
+                  ('phasors', [('a', '>' + phasor[0]), ('b', '>' + phasor[1])], (self.nPhasors,)),
+                  ('freq', '>' + freq), ('dfreq', '>' + freq),
+                  ('analog', '>' + analog, (self.nAnalogs,)), ('digital', '>u2', (self.nDigitals,)), ('chk', '>u2')]
+        self.dtype = np.dtype(fields)
+        assert self.dtype.itemsize == self.size
+
+    def encode(self, soc, fracsec, stat, phasors, freq, dfreq, analog=(), digital=()):
+        '''
+        Packs the frame into the buffer and computes its CHK.
+        fracsec = FRACSEC word (see fracsec_word), stat = STAT word as integer
+        Returns the buffer, overwritten by the next frame: copy it to keep it.
+        '''
+        self.body.pack_into(self.buffer, 0, DATA_SYNC, self.size, self.pmu_id, soc, fracsec, stat,
+                            *phasors, freq, dfreq, *analog, *digital)
+        self.chk.pack_into(self.buffer, self.body.size, crc_ccitt(self.view[:self.body.size]))
+        return self.buffer
+
+    def decode(self, data):
+        '''
+        Unpacks a frame of this layout. Returns None if its size or its CHK is wrong, otherwise
+        (soc, fracsec word, stat, phasors, freq, dfreq, analog, digital) where phasors is the flat tuple of the phasor values.
+        '''
+        if len(data) != self.size or crc_ccitt(data[:self.body.size]) != self.chk.unpack_from(data, self.body.size)[0]:
+            return None
+
+        values = self.body.unpack_from(data)
+        end = 6 + 2*self.nPhasors
+        return (values[3], values[4], values[5], values[6:end], values[end], values[end + 1],
+                values[end + 2:end + 2 + self.nAnalogs], values[end + 2 + self.nAnalogs:])
+
+    def decode_many(self, data, check=True):
+        '''
+        Decodes at once the whole frames of this layout at the beginning of data (bytes-like),
+        up to the first one with a wrong SYNC, FRAMESIZE, IDCODE or (if check) CHK.
+        Returns the structured array of the frames (a view on data: copy what has to outlive it).
+        '''
+        frames = np.frombuffer(data, self.dtype, len(data)//self.size)
+        valid = (frames['sync'] == DATA_SYNC) & (frames['size'] == self.size) & (frames['id_code'] == self.pmu_id)
+        n = len(frames) if valid.all() else int(np.argmin(valid))
+
+        if check:
+            view = memoryview(data)
+            for i, chk in enumerate(frames['chk'][:n].tolist()):
+                start = i*self.size
+                if crc_ccitt(view[start:start + self.body.size]) != chk:
+                    n = i
+                    break
+        return frames[:n]
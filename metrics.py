@@ -0,0 +1,223 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import bisect
+import json
+import os
+import socketserver
+import threading
+'''
+This file implements the metrics of the PMU daemon: counters and histograms updated on the hot path
+(PPS to send latency, USB read time, estimation time, ...) and gauges read only when the metrics are asked for
+(clients connected, queue depths, counters the other objects already keep).
+Updating a counter or a histogram costs an addition or a bisection and an addition, no lock and no allocation:
+every one is updated by a single thread, and the server thread reading them may see a histogram one observation behind.
+The counters the hot path updates itself (overruns, lost scans, dropped frames) are Counters owned by the objects
+updating them, registered here.
+MetricsServer serves them over HTTP, on a local TCP port or on a Unix socket, in its own thread:
+    /metrics        Prometheus text format
+    /metrics.json   JSON
+'''
+
+LATENCY_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2) #seconds
+
+class Counter:
+    '''
+    A count only going up, e.g. of the overruns.
+    '''
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+class Histogram:
+    '''
+    The distribution of a value, e.g. a latency in seconds: the count of the observations in every bucket,
+    their number and their sum.
+    '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        '''
+        buckets = upper bounds of the buckets, increasing; one more bucket holds the observations above the last one
+        '''
+        self.buckets = tuple(buckets)
+        self.counts = [0]*(len(self.buckets) + 1)
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        '''
+        Returns the buckets as (upper bound, cumulative count), the last one with an infinite bound, the count, the sum and the maximum.
+        '''
+        counts, total = list(self.counts), self.sum
+        cumulative, n = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            n += count
+            cumulative.append((bound, n))
+        return { 'buckets': cumulative, 'count': n, 'sum': total, 'max': self.max }
+
+class Metrics:
+    '''
+    The registry of the metrics, by name. Every metric has a help text;
+    a gauge (or a counter kept by another object) is a function called when the metrics are read, returning
+    a number or a dictionary of numbers by the value of its label.
+    '''
+
+    def __init__(self, prefix='pmu_'):
+        '''
+        prefix = of the names of every metric
+        '''
+        self.prefix = prefix
+        self.metrics = {} # name -> (type, help, metric, label)
+        self.lock = threading.Lock() # the registry, not the values
+
+    def add(self, name, kind, help, metric, label=None):
+        with self.lock:
+            self.metrics[self.prefix + name] = (kind, help, metric, label)
+        return metric
+
+    def counter(self, name, help, counter=None):
+        '''
+        Returns counter (a new Counter if None) registered as name.
+        '''
+        return self.add(name, 'counter', help, counter or Counter())
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        '''
+        Returns a new Histogram registered as name.
+        '''
+        return self.add(name, 'histogram', help, Histogram(buckets))
+
+    def gauge(self, name, help, function, label=None, kind='gauge'):
+        '''
+        Registers function, called when the metrics are read, as name.
+        label = name of the label if function returns a dictionary
+        kind = 'counter' if the value only goes up
+        '''
+        self.add(name, kind, help, function, label)
+
+    def collect(self):
+        '''
+        Returns (name, type, help, value, label) of every metric; value is a number, a dictionary of numbers by label
+        or the snapshot of a histogram. The gauges failing are left out.
+        '''
+        with self.lock:
+            metrics = list(self.metrics.items())
+
+        values = []
+        for name, (kind, help, metric, label) in metrics:
+            if isinstance(metric, Counter):
+                value = metric.value
+            elif isinstance(metric, Histogram):
+                value = metric.snapshot()
+            else:
+                try:
+                    value = metric()
+                except Exception:
+                    continue
+            values.append((name, kind, help, value, label))
+        return values
+
+    def render(self):
+        '''
+        Returns the metrics in the Prometheus text format.
+        '''
+        lines = []
+        for name, kind, help, value, label in self.collect():
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            if kind == 'histogram':
+                for bound, count in value['buckets']:
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(name, '+Inf' if bound == float('inf') else repr(float(bound)), count))
+                lines.append('{}_sum {}'.format(name, repr(float(value['sum']))))
+                lines.append('{}_count {}'.format(name, value['count']))
+            elif isinstance(value, dict):
+                for key, v in value.items():
+                    lines.append('{}{{{}="{}"}} {}'.format(name, label, key, v))
+            else:
+                lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        '''
+        Returns the metrics as a dictionary by name, for JSON.
+        '''
+        result = {}
+        for name, kind, help, value, label in self.collect():
+            if kind == 'histogram':
+                value = dict(value, buckets=[ [None if bound == float('inf') else bound, count] for bound, count in value['buckets'] ])
+            result[name] = value
+        return result
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''
+    Answers GET /metrics and GET /metrics.json with the metrics of the server.
+    '''
+
+    def do_GET(self):
+        metrics = self.server.metrics
+        if self.path in ('/', '/metrics'):
+            body, content_type = metrics.render().encode(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(metrics.snapshot()).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # no output for every scrape
+
+    def address_string(self):
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class MetricsServer:
+    '''
+    Serves the metrics over HTTP in its own thread: the real time threads never wait for it.
+    '''
+
+    def __init__(self, metrics, address=("127.0.0.1", 9411)):
+        '''
+        metrics = Metrics to serve
+        address = (ip, port) to listen on, local by default, or the path of a Unix socket
+        '''
+        self.metrics = metrics
+        self.address = address
+        self.httpd = None
+
+    def start(self):
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.unlink(self.address) # left by a previous run
+            self.httpd = UnixHTTPServer(self.address, MetricsHandler)
+        else:
+            self.httpd = ThreadingHTTPServer(self.address, MetricsHandler)
+            self.httpd.daemon_threads = True
+            self.address = self.httpd.server_address[:2] # if the port 0 was given
+        self.httpd.metrics = self.metrics
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True)
+        self.thread.start()
+        print('Metrics: serving on {}'.format(self.address if isinstance(self.address, str) else 'http://{}:{}/metrics'.format(*self.address)))
+
+    def stop(self):
+        if self.httpd is None:
+            return
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+        self.httpd = None
@@ -0,0 +1,204 @@
+from estimator import *
+from timing import PPSClock
+from metrics import Counter
+import queue
+import threading
+import time
+'''
+This file decouples the PMU work done at every PPS in three stages, each one running in its own thread:
+    1- acquisition: reads the scan from the redlab
+    2- estimation: estimates the synchrophasors of the scan
+    3- sending: builds the data frame and sends it to the PDC
+The stages are connected by bounded queues: if a stage can't keep up, the new items are dropped (and counted)
+instead of piling up, and the PPS handler only records the edge and enqueues it.
+The latencies and the queues are published in the metrics of the PMU (see metrics.py), nothing is printed per frame.
+'''
+
+STOP = None # queued to stop a stage
+
+class Stage:
+    '''
+    A worker thread taking the items from its bounded input queue and giving the results of function
+    to the next stage. Keeps the statistics of the latency of function and of the queue.
+    '''
+
+    def __init__(self, name, function, maxsize=2, output=None, histogram=None):
+        '''
+        name = name of the stage in the statistics
+        function = called on every item, returns the item for the next stage (None to give nothing)
+        maxsize = size of the input queue
+        output = next stage
+        histogram = metrics.Histogram observing the latency of function, if any
+        '''
+        self.name = name
+        self.function = function
+        self.output = output
+        self.histogram = histogram
+        self.queue = queue.Queue(maxsize)
+
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latency = 0        # of the last item, seconds
+        self.max_latency = 0
+        self.total_latency = 0
+        self.max_depth = 0
+
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Stops the thread after the items already queued.
+        '''
+        self.queue.put(STOP)
+        self.thread.join()
+
+    def put(self, item):
+        '''
+        Queues the item without waiting. Returns False if the queue is full and the item is dropped.
+        '''
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def run(self):
+        '''
+        Body of the thread.
+        '''
+        while True:
+            item = self.queue.get()
+            if item is STOP:
+                break
+
+            t = time.perf_counter()
+            try:
+                result = self.function(item)
+            except Exception as e:
+                self.errors += 1
+                print('Pipeline: stage {} failed: {}'.format(self.name, e))
+                continue
+
+            self.latency = time.perf_counter() - t
+            self.max_latency = max(self.max_latency, self.latency)
+            self.total_latency += self.latency
+            self.processed += 1
+            if self.histogram:
+                self.histogram.observe(self.latency)
+
+            if self.output and result is not None:
+                self.output.put(result)
+
+    def stats(self):
+        '''
+        Returns the statistics of the stage: items processed, dropped and failed,
+        the current and the maximum depth of the queue, the last, maximum and average latency in seconds
+        (of the items processed, not of the failed ones).
+        '''
+        return {
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'depth': self.queue.qsize(),
+            'max_depth': self.max_depth,
+            'latency': self.latency,
+            'max_latency': self.max_latency,
+            'avg_latency': self.total_latency/self.processed if self.processed else 0
+        }
+
+class Pipeline:
+    '''
+    The acquisition, estimation and sending stages of the PMU.
+    trigger is the PPS handler: it only records the edge and queues it for the acquisition.
+    '''
+
+    def __init__(self, redlab, myPmu, maxsize=2, backend='fft', clock=None):
+        '''
+        redlab = Redlab to read the scans from
+        myPmu = MyPmu sending the data frames, its metrics get the ones of the pipeline
+        maxsize = size of the queue of every stage
+        backend = backend of estimate_phasors
+        clock = PPSClock recording the edges, a new one if None
+        In zero copy mode the scans are views on the ring of the redlab: up to maxsize scans queued to the estimation
+        and to the sending, one in each of them and the one being read must fit in the ring before it wraps around.
+        '''
+        if redlab.zero_copy and not redlab.continuous and len(redlab.ring) <= 2*maxsize + 2:
+            raise ValueError('The zero copy ring of the redlab needs more than {} buffers (nBuffers) for the pipeline.'.format(2*maxsize + 2))
+        self.redlab = redlab
+        self.myPmu = myPmu
+        self.backend = backend
+        self.clock = clock or PPSClock()
+        metrics = myPmu.metrics
+
+        self.sending = Stage('sending', self.send, maxsize)
+        self.estimation = Stage('estimation', self.estimate, maxsize, self.sending,
+                                metrics.histogram('estimation_seconds', 'Time of the estimation of the synchrophasors of a scan'))
+        self.acquisition = Stage('acquisition', self.acquire, maxsize, self.estimation)
+        self.stages = [self.acquisition, self.estimation, self.sending]
+        self.lost = Counter() # scans lost by the redlab
+
+        redlab.instrument(metrics)
+        metrics.counter('lost_scans_total', 'Scans lost by the pipeline (nothing sent for their second)', self.lost)
+        metrics.gauge('pipeline_queue_depth', 'Items queued to every stage of the pipeline',
+                      lambda: { stage.name: stage.queue.qsize() for stage in self.stages }, 'stage')
+        metrics.gauge('pipeline_dropped_total', 'Items dropped by every stage of the pipeline, its queue being full',
+                      lambda: { stage.name: stage.dropped for stage in self.stages }, 'stage', 'counter')
+        metrics.gauge('pipeline_errors_total', 'Items failed in every stage of the pipeline',
+                      lambda: { stage.name: stage.errors for stage in self.stages }, 'stage', 'counter')
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        '''
+        Stops the stages in order, after the items already queued.
+        '''
+        for stage in self.stages:
+            stage.stop()
+
+    def trigger(self, arg=None):
+        '''
+        PPS handler (GPIO callback): records the edge and queues its second.
+        '''
+        self.acquisition.put(self.clock.edge())
+
+    def acquire(self, second):
+        '''
+        Acquisition stage: reads the scan triggered by the PPS and timestamps it with the second of the edge
+        that started it (not necessarily the queued one, if the stage is late): 
+        its first sample is acquired on the edge, so its FRACSEC is 0.
+        The scans lost (e.g. on an overrun) are counted.
+        '''
+        scan = self.redlab.read(self.clock.edge_time(second))
+        if scan is None: # lost, nothing to send for this second
+            self.lost.inc()
+            return None
+        scan['timestamp'] = self.clock.scan_second(scan)
+        scan['fracsec'] = 0
+        return scan
+
+    def estimate(self, scan):
+        '''
+        Estimation stage.
+        '''
+        return scan, estimate_phasors(scan, self.backend)
+
+    def send(self, item):
+        '''
+        Sending stage: sets the data frame and sends it if the PDC is connected.
+        '''
+        scan, sph = item
+        self.myPmu.send(self.redlab, sph, scan['timestamp'], scan['fracsec'])
+
+    def stats(self):
+        '''
+        Returns the statistics of every stage (see Stage.stats).
+        '''
+        return { stage.name: stage.stats() for stage in self.stages }
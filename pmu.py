@@ -1,27 +1,46 @@
 from synchrophasor.frame import *
-from synchrophasor.pmu import Pmu
 from estimator import *
 from redlab import *
+from pipeline import Pipeline
+from timing import PPSClock, sample_timestamp
+from frames import DataFrameFormat, fracsec_word
+from server import FanOutServer, UdpSender
+from archive import ArchiveWriter
+from simulator import SimulatedUSB201, SoftPPS
+from metrics import Metrics, MetricsServer
 from datetime import datetime
 import time
-import RPi.GPIO as gpio
+import threading
+try:
+    import RPi.GPIO as gpio
+except ImportError: #not on a raspberry: only the software PPS (see simulator.SoftPPS)
+    gpio = None
 
 class MyPmu:
     '''
     Implements the communication protocol of the IEEE C37.118 synchrofphasor standard (IEC 61850) 
-    using "pypmu" lib (synchrophasor in the imports).
-    This class acts like a wrapper interfacing the lib. 
+    using "pypmu" lib (synchrophasor in the imports) for the configuration and header frames,
+    frames.DataFrameFormat for the data frames and server.FanOutServer to send them to the PDCs.
+    Its metrics (see metrics.py) are the ones of the frames sent, the PDCs and, when given to them, of the redlab and the pipeline.
     Uses a callback function to handle the PPS as a trigger event on the GPIO 18 of the raspberry.
     '''
 
-    def __init__(self, channelNames, nFreq = 50):
+    UNLOCKED = [(10, "<10"), (100, "<100"), (1000, "<1000"), (float('inf'), ">1000")] # unlocked time field of the STAT word
+
+    def __init__(self, channelNames, nFreq = 50, dataRate = 1, clock = None, udp = None, udpDelay = 0, archive = None):
         '''
         channelNames = list of the Channels' Names
         nFreq = Nominal Frequency is needed for the configuration frame!
+        dataRate = frames per second, advertised in the configuration frame
+        clock = PPSClock giving the lock state of the time source, for the time quality of the data frames.
+                If None the time source is assumed locked.
+        udp = list of (ip, port) the data frames are sent to over UDP too, unicast or multicast (see UdpSender)
+        udpDelay = maximum time in seconds a data frame is kept to be sent over UDP with the next ones (0: sent at once)
+        archive = directory where the synchrophasors sent are archived too (see archive.ArchiveWriter), None to not archive them
         '''
-        self.pmu = Pmu(ip="127.0.0.1", port=1411)
-        self.pmu.logger.setLevel("DEBUG")
         self.nFreq = nFreq
+        self.dataRate = dataRate
+        self.clock = clock
 
         ph_v_conversion = [(100000, "v")]*len(channelNames)  # Voltage phasor conversion factor
 
@@ -40,37 +59,120 @@ class MyPmu:
                        [],  # Mask words for digital status words
                        nFreq,  # Nominal frequency
                        1,  # Configuration change count
-                       1)  # Rate of phasor data transmission)
+                       dataRate)  # Rate of phasor data transmission)
 
         self.hf = HeaderFrame(7,  # PMU_ID
                         "Hello I'm MyPMU!")  # Header Message
         
-        self.current_dataframe = None
+        self.frame_format = DataFrameFormat(self.cfg, 7) #binary layout of the data frames
+        self.current_frame = None
+        self.sent = 0 #data frames built
+        self.stopped = threading.Event()
+        self.set_time_status()
 
-        self.pmu.set_configuration(self.cfg)
-        self.pmu.set_header(self.hf)
+        self.server = FanOutServer(self.cfg, self.hf, ip="127.0.0.1", port=1411)
+        self.udp = UdpSender(udp, udpDelay) if udp else None
+        self.archive = ArchiveWriter(archive, channelNames) if archive else None
+        if self.archive:
+            self.archive.start()
+        self.set_metrics()
+
+    def set_metrics(self):
+        '''
+        Creates the metrics of the PMU: the latency from the timestamp of every frame to its sending (with a clock only):
+        from the PPS edge that triggered the scan in triggered mode, from the centre of the window of the report in sliding mode
+        (so it includes half a window, e.g. 40 ms with 4 cycles at 50 Hz, besides the wait for the samples and the processing),
+        the frames sent and dropped, the PDCs connected and their queues. 
+        Only the latency is measured when a frame is sent, the rest is read from the counters when the metrics are.
+        '''
+        self.metrics = Metrics()
+        self.timestamp_to_send = self.metrics.histogram('timestamp_to_send_seconds',
+                                                        'Time from the timestamp of a frame (the PPS edge in triggered mode, the centre of the window in sliding mode) to its sending')
+        self.metrics.gauge('frames_sent_total', 'Data frames built and sent', lambda: self.sent, kind='counter')
+        self.metrics.gauge('clients', 'PDCs connected over TCP', lambda: len(self.server.clients))
+        self.metrics.gauge('client_queue_depth', 'Frames queued to every PDC connected',
+                           lambda: { '{}:{}'.format(*c.address[:2]): len(c.queue) for c in list(self.server.clients) }, 'client')
+        self.metrics.counter('tcp_dropped_frames_total', 'Data frames dropped for a PDC too slow, over TCP', self.server.dropped)
+        if self.udp:
+            self.metrics.counter('udp_dropped_frames_total', 'Data frames dropped for a full socket buffer, over UDP', self.udp.dropped)
+        self.metrics.gauge('evicted_clients_total', 'PDCs disconnected for being too slow', lambda: self.server.evicted, kind='counter')
+        if self.archive:
+            self.metrics.gauge('archive_queue_depth', 'Measurements queued to the archive', lambda: self.archive.queue.qsize())
 
     def run(self):
         '''
-        Create TCP socket, bind port and listen for incoming connections
+        Create TCP socket, bind port and listen for incoming connections.
+        Then blocks, idle, until stop is called or SIGTERM/SIGINT arrives.
         '''
 
-        self.pmu.run()
-        while True:
-            pass    
-        self.pmu.join()
+        self.server.start()
+        wait_for_signals(self.stopped)
 
+    def stop(self):
+        '''
+        Makes run return.
+        '''
+        self.stopped.set()
 
-    def set_dataframe(self, synchrophasors, soc):
+    def close(self):
         '''
-        Sets the new dataframe to be sent.
+        Closes the server: the connections with the PDCs and the listening socket.
         '''
+        self.server.stop()
+        if self.udp:
+            self.udp.close()
+        if self.archive:
+            self.archive.stop() #writes the measurements still queued
+
+
+    def set_time_status(self):
+        '''
+        Precomputes, for every lock state of the time source, the STAT word and the FRACSEC time quality bits 
+        of the data frames, so that framing doesn't convert them every time:
+            locked                  -> in sync, unlocked time "<10", time quality 0 (clock locked to UTC)
+            unlocked for t seconds  -> sync error, unlocked time "<10" ... ">1000", 
+                                       time quality 10 (within 1 s of UTC, the timestamps rely on the wall clock)
+        '''
+        self.locked_status = (DataFrame._stat2int("ok", True, "timestamp", False, False, False, 0, "<10", 0), fracsec_word(0, 0))
+        self.unlocked_status = [ (limit, (DataFrame._stat2int("ok", False, "timestamp", False, False, False, 0, unlocked, 0), fracsec_word(0, 10)))
+                                 for limit, unlocked in self.UNLOCKED ]
+
+    def time_status(self):
+        '''
+        Returns the precomputed STAT word and time quality bits for the current lock state (see set_time_status).
+        '''
+        if self.clock is None:
+            return self.locked_status
+        t = self.clock.unlocked_time()
+        if t == 0:
+            return self.locked_status
+        for limit, status in self.unlocked_status:
+            if t < limit:
+                return status
+        return status # never locked
+
+    def set_dataframe(self, synchrophasors, timestamp, frasec=None):
+        '''
+        Sets the new dataframe to be sent: packs its values in the bytes of the frame (see frames.DataFrameFormat).
+        Synchrophasors must be given in the order of the channels of the configuration.
+        timestamp = soc if frasec is given, otherwise the full UNIX time in seconds (float)
+        frasec = fraction of second in TIME_BASE units
+        '''
+        if frasec is None:
+            soc = int(timestamp)
+            frasec = int(round((timestamp - soc)*self.cfg.get_time_base()))
+            if frasec == self.cfg.get_time_base():
+                soc, frasec = soc + 1, 0
+        else:
+            soc = timestamp
+        stat, time_quality = self.time_status()
 
         sph = []
         rocof = []
         freq_dev = []
         for chan in synchrophasors: #for every chan is given a synchrophasor
-            sph.append((synchrophasors[chan]['amplitude'], synchrophasors[chan]['phase']))
+            sph.append(synchrophasors[chan]['amplitude'])
+            sph.append(synchrophasors[chan]['phase'])
 
             if abs(self.nFreq-synchrophasors[chan]['avg_freq']) > 32.767:
                 rocof.append(0)
@@ -81,25 +183,52 @@ class MyPmu:
         if len(freq_dev) == 0:
             freq_dev.append(0)
         
-        self.current_dataframe = DataFrame(7,  # PMU_ID
-            ("ok", True, "timestamp", False, False, False, 0, "<10", 0),  # STAT WORD - Check DataFrame set_stat()
-            sph,  # PHASORS
-            np.average(freq_dev),  # Frequency deviation from nominal in mHz
-            np.average(rocof),  # Rate of Change of Frequency
-            [],  # Analog Values
-            [],  # Digital status word
-            self.cfg,  # Data Stream Configuration
-            soc=soc)  
+        self.current_frame = self.frame_format.encode(soc,
+            frasec | time_quality,  # FRACSEC word
+            stat,  # STAT WORD
+            sph,  # PHASORS: amplitude, phase of every channel
+            sum(freq_dev)/len(freq_dev),  # Frequency deviation from nominal in mHz
+            sum(rocof)/len(rocof))  # Rate of Change of Frequency
             
     
-    def send(self, redlab, sph, timestamp):
+    def print_dataframe(self):
+        '''
+        Prints the timestamp, the phasors, the frequency and the rocof of the current dataframe, decoded from its bytes.
+        '''
+        soc, frasec, stat, sph, freq, rocof, analog, digital = self.frame_format.decode(self.current_frame)
+        print('Sent: ', datetime.fromtimestamp(soc + (frasec & 0xffffff)/self.cfg.get_time_base()))
+        for i in range(0, len(sph), 2):
+            print('RMS: ',sph[i]/np.sqrt(2), ', <: ',sph[i+1])
+
+        print('Frequency: ', self.cfg.get_fnom() + freq/1000)
+        print('Rocof: ', rocof)
+        print()
+
+    def send(self, redlab, sph, timestamp, frasec=None):
         '''
         This interface function for the lib sets the dataframe with the given arguments and if the PDC is connected start the communication.
+        timestamp, frasec: see set_dataframe.
+        The frame is serialized once and queued to every PDC (see FanOutServer.send), without waiting for the sockets.
+        The synchrophasors are queued to the archive too, if any.
+        The latency from the timestamp is observed in the metrics (from the PPS edge of its second, if the clock has recorded it).
         '''
         
-        myPmu.set_dataframe(sph, timestamp)
-        if myPmu.pmu.clients: #if PDC asked for frame / is connected
-            myPmu.pmu.send(myPmu.current_dataframe)
+        self.set_dataframe(sph, timestamp, frasec)
+        self.sent += 1
+        if self.archive:
+            self.archive.append(timestamp if frasec is None else timestamp + frasec/self.cfg.get_time_base(), sph)
+        if self.server.clients or self.udp: #if PDC asked for frame / is connected
+            frame = bytes(self.current_frame)
+            self.server.send(frame)
+            if self.udp:
+                self.udp.send(frame)
+
+        if self.clock:
+            soc = int(timestamp)
+            edge = self.clock.edge_time(soc)
+            if edge is not None:
+                offset = timestamp - soc if frasec is None else frasec/self.cfg.get_time_base()
+                self.timestamp_to_send.observe(time.monotonic() - edge - offset)
 
 def get_degrees(phasors):
     '''
@@ -114,10 +243,13 @@ def get_degrees(phasors):
         degrees.append(round(d)) #unround for full digits
     return degrees
 
-def make_callback(redlab, myPmu):
+def make_callback(redlab, myPmu, clock):
     '''
     Wraps the Callback method that accepts only 1 parameter.
+    clock = PPSClock recording the edges
     '''
+    lost = myPmu.metrics.counter('lost_scans_total', 'Scans lost (nothing sent for their second)')
+
     def callback(arg):
         '''
         The PPS is connected to the chosen general purpose I/O pin of the raspberry; 
@@ -127,39 +259,97 @@ def make_callback(redlab, myPmu):
             3- estimates synchrophasors
             4- sends the data Frame to the PDC if connected 
         '''
-        time.sleep(0.1)
-        T = time.time()
+        second = clock.edge()
 
-        scan = redlab.read()
+        scan = redlab.read(clock.edge_time(second))
+        if scan is None: # lost (e.g. overrun), nothing to send for this second
+            lost.inc()
+            return
 
-        scan['timestamp'] = round(T)
+        scan['timestamp'] = clock.scan_second(scan)
         sph = estimate_phasors(scan)
-        myPmu.send(redlab, sph, scan['timestamp'])
-        data = myPmu.current_dataframe
-        print('Sent: ', datetime.fromtimestamp(round(T)))
-        sph = myPmu.current_dataframe.get_phasors()
-        for p in sph:
-            print('RMS: ',p[0]/np.sqrt(2), ', <: ',p[1])
-        meas = data.get_measurements()
-
-        print('Frequency: ', meas['measurements'][0]['frequency'])
-        print('Rocof: ', meas['measurements'][0]['rocof'])
-        print()
+        myPmu.send(redlab, sph, scan['timestamp'], 0)
 
     return callback
 
+def make_sliding_callback(myPmu, clock):
+    '''
+    Wraps the callback of sliding_loop, called dataRate times per second with the phasors of the report
+    and the scan of the new samples.
+    clock = PPSClock recording the edges
+    '''
+    def callback(sph, scan):
+        '''
+        Timestamps the report from its sample index and the PPS edges (see PPSClock.stream_timestamp)
+        and sends the data Frame to the PDC if connected.
+        '''
+        soc, fracsec = clock.stream_timestamp(scan, scan['index'], myPmu.cfg.get_time_base())
+        myPmu.send(None, sph, soc, fracsec)
+
+    return callback
 
 
+RATE = 1 #frames per second: 1 = one estimate per PPS, more = continuous scan and sliding estimation
+UDP = [] #(ip, port) of the PDCs (or multicast groups) receiving the data frames over UDP, e.g. [("239.1.14.11", 4713)]
+UDP_DELAY = 0 #maximum seconds a data frame waits to be sent over UDP with the next ones (see UdpSender), 0 to send every frame at once
+ARCHIVE = None #directory of the archive of the synchrophasors sent, e.g. "/var/lib/pmu/archive"; None to not archive them
+RECORD = None #directory of the recordings of the raw samples, e.g. "/var/lib/pmu/raw"; None to not record them
+SIMULATE = False #True to run without the hardware: simulated USB-201 and software PPS (see simulator.py)
+METRICS = ("127.0.0.1", 9411) #address of the metrics endpoint (see metrics.py): (ip, port), or the path of a Unix socket; None for no endpoint
+
 if __name__ == "__main__": 
     
-    r = Redlab([0,1,2,3,4,5,6,7],nSamples=2400) #init redlab
-    myPmu = MyPmu(["VA","VB","VC","VD","VE","VF","VG","VH"]) #ìnit pmu
+    clock = PPSClock() #records the PPS edges
+    myPmu = MyPmu(["VA","VB","VC","VD","VE","VF","VG","VH"], dataRate=RATE, clock=clock, udp=UDP, udpDelay=UDP_DELAY, archive=ARCHIVE) #ìnit pmu
+    metrics_server = MetricsServer(myPmu.metrics, METRICS) if METRICS else None
+    if metrics_server:
+        metrics_server.start() #scraped in its own thread
+
+    if SIMULATE:
+        pps = SoftPPS() #edges on the seconds of the wall clock
+        device = SimulatedUSB201(pps=pps)
+        add_event_callback = pps.add_event_callback
+        pps.start()
+    else:
+        #GPIO lib is used to attach the 18th pin of the raspberry
+        gpio.setmode(gpio.BCM)
+        gpio.setup(18, gpio.IN, pull_up_down=gpio.PUD_DOWN)
+        gpio.add_event_detect(18, gpio.RISING)
+        device = None
+        add_event_callback = lambda callback: gpio.add_event_callback(18, callback)
+
+    if RATE > 1:
+        add_event_callback(clock.edge)
+        r = Redlab([0,1,2,3,4,5,6,7], continuous=True, device=device) #init redlab, streaming
+        r.instrument(myPmu.metrics)
+        clock.follow_stream(r, r.frequency/len(r.channels)) #sample index of every edge
+        if RECORD:
+            r.record(RECORD, clock) #raw samples, in their own thread
+        estimator = SlidingEstimator(len(r.channels), r.frequency/len(r.channels), myPmu.nFreq)
+        estimation_time = myPmu.metrics.histogram('estimation_seconds', 'Time of the update and estimate of a report of the sliding estimator')
+        worker = threading.Thread(target=sliding_loop, args=(r, estimator, RATE, make_sliding_callback(myPmu, clock), estimation_time))
+        worker.start()
+
+        myPmu.run() #start, until SIGTERM
+        r.close() #stops the stream and so the sliding loop
+        worker.join()
+    else:
+        r = Redlab([0,1,2,3,4,5,6,7],nSamples=2400, device=device) #init redlab
+        if RECORD:
+            r.record(RECORD, clock) #raw samples, in their own thread
+        pipeline = Pipeline(r, myPmu, clock=clock) #acquisition, estimation and sending threads
+        pipeline.start()
+        add_event_callback(pipeline.trigger) #the handler only records and queues the PPS
 
-    #GPIO lib is used to attach the 18th pin of the raspberry
-    gpio.setmode(gpio.BCM)
-    gpio.setup(18, gpio.IN, pull_up_down=gpio.PUD_DOWN)
-    gpio.add_event_detect(18, gpio.RISING)
-    callback = make_callback(r, myPmu)
-    gpio.add_event_callback(18, callback)
+        myPmu.run() #start, until SIGTERM
+        pipeline.stop()
+        r.close()
 
-    myPmu.run() #start
\ No newline at end of file
+    if SIMULATE:
+        pps.stop()
+    else:
+        gpio.cleanup()
+    if metrics_server:
+        metrics_server.stop()
+    myPmu.close()
+    print('PMU stopped.')
@@ -0,0 +1,385 @@
+from frames import *
+import asyncio
+import threading
+import time
+import numpy as np
+'''
+This file implements the ingest side of the PDC: a single asyncio thread connected to many PMUs at once.
+For every PMU it asks the CFG-2 frame, compiles the layout of its data frames (frames.DataFrameFormat)
+and sends the start command; then every run of data frames read from the socket is decoded at once with numpy
+and appended to the columns of the PMU (StreamBuffer): no python object is made per frame or per value.
+The consumers pull blocks of all the PMUs by time (Receiver.block, Receiver.pull), not frames one by one,
+or take the frames combined by timestamp from an aligner.Aligner.
+'''
+
+class StreamBuffer:
+    '''
+    Columnar ring buffer of the data frames of one PMU: the last capacity frames,
+    one numpy array per field (soc, fracsec, stat, time, magnitude, angle, freq, rocof).
+    Frames are numbered from 0 in the order they are received: count is the number of the next one.
+    The phasors are stored as magnitude (V or A) and angle (rad), whatever their format in the frames;
+    freq is the deviation from the nominal frequency (fnom) in Hz, rocof in Hz/s.
+    '''
+
+    def __init__(self, cfg, capacity=3000):
+        '''
+        cfg = Config (or ConfigFrame2) of the PMU
+        capacity = number of frames kept
+        '''
+        self.cfg = cfg
+        self.format = DataFrameFormat(cfg)
+        self.capacity = capacity
+        self.count = 0
+        self.time_base = cfg.get_time_base()
+        self.fnom = cfg.get_fnom()
+        self.names = cfg.get_channel_names()[:self.format.nPhasors]
+        self.lock = threading.Lock()
+
+        polar, phasor_float, analog_float, freq_float = cfg.get_data_format()
+        self.polar = polar
+        # 16 bit phasors: magnitude (or real and imaginary) in PHUNIT*10^-5 units, angle in 10^-4 rad
+        self.scale = 1 if phasor_float else np.array([ factor for factor, _ in cfg.get_ph_units() ])*1e-5
+        self.angle_scale = 1 if phasor_float else 1e-4
+        # 16 bit FREQ in mHz, DFREQ in 10^-2 Hz/s
+        self.freq_scale = 1 if freq_float else 1e-3
+        self.rocof_scale = 1 if freq_float else 1e-2
+
+        nPhasors = self.format.nPhasors
+        self.columns = {
+            'soc': np.zeros(capacity, np.uint32),
+            'fracsec': np.zeros(capacity, np.uint32), # fraction of second, time_base units
+            'stat': np.zeros(capacity, np.uint16),
+            'time': np.zeros(capacity),               # soc + fracsec/time_base
+            'magnitude': np.zeros((capacity, nPhasors), np.float32),
+            'angle': np.zeros((capacity, nPhasors), np.float32),
+            'freq': np.zeros(capacity, np.float32),
+            'rocof': np.zeros(capacity, np.float32)
+        }
+
+    def decode(self, frames):
+        '''
+        Returns the columns of the structured array of frames (see DataFrameFormat.decode_many).
+        '''
+        fracsec = frames['fracsec'] & 0xffffff
+        a = frames['phasors']['a']*self.scale
+        if self.polar:
+            magnitude, angle = a, frames['phasors']['b']*self.angle_scale
+        else:
+            b = frames['phasors']['b']*self.scale
+            magnitude, angle = np.hypot(a, b), np.arctan2(b, a)
+
+        return {
+            'soc': frames['soc'],
+            'fracsec': fracsec,
+            'stat': frames['stat'],
+            'time': frames['soc'] + fracsec/self.time_base,
+            'magnitude': magnitude,
+            'angle': angle,
+            'freq': frames['freq']*self.freq_scale,
+            'rocof': frames['dfreq']*self.rocof_scale
+        }
+
+    def append(self, frames):
+        '''
+        Appends the structured array of frames, overwriting the oldest ones. Returns their columns (see decode).
+        '''
+        values = self.decode(frames)
+        n = len(frames)
+        if n > self.capacity:
+            n, values = self.capacity, { name: v[-self.capacity:] for name, v in values.items() }
+
+        with self.lock:
+            start = self.count % self.capacity
+            first = min(n, self.capacity - start) # up to the end of the ring, the rest from its beginning
+            for name, column in self.columns.items():
+                column[start:start + first] = values[name][:first]
+                column[:n - first] = values[name][first:]
+            self.count += n
+        return values
+
+    def oldest(self):
+        '''
+        Number of the oldest frame still in the buffer.
+        '''
+        return max(0, self.count - self.capacity)
+
+    def read(self, start, stop):
+        '''
+        Returns the columns (copies) of the frames from number start to stop (excluded), limited to the ones still in the buffer,
+        and 'index' with their numbers.
+        '''
+        with self.lock:
+            start = max(start, self.oldest())
+            stop = min(stop, self.count)
+            index = np.arange(start, max(start, stop))
+            block = { name: column[index % self.capacity] for name, column in self.columns.items() }
+        block['index'] = index
+        return block
+
+    def find(self, t):
+        '''
+        Returns the number of the first frame in the buffer with time >= t (count if none):
+        the frames are assumed to be received in time order.
+        '''
+        with self.lock:
+            start, n = self.oldest(), self.count - self.oldest()
+            first = start % self.capacity
+            times = self.columns['time']
+            # the ring is sorted from first to its end, then from its beginning
+            if first + n <= self.capacity:
+                return start + int(np.searchsorted(times[first:first + n], t))
+            tail = self.capacity - first
+            if times[-1] >= t:
+                return start + int(np.searchsorted(times[first:], t))
+            return start + tail + int(np.searchsorted(times[:n - tail], t))
+
+    def between(self, t0, t1):
+        '''
+        Returns the columns of the frames with time in [t0, t1) (see read).
+        '''
+        return self.read(self.find(t0), self.find(t1))
+
+    def latest_time(self):
+        '''
+        Time of the last frame received, None if none.
+        '''
+        with self.lock:
+            if not self.count:
+                return None
+            return float(self.columns['time'][(self.count - 1) % self.capacity])
+
+class PmuConnection:
+    '''
+    The connection to a PMU: asks its configuration, starts its data stream and appends its data frames to buffer
+    (and to aligner, if given, as its PMU of index index).
+    '''
+
+    def __init__(self, ip, port, id_code, capacity=3000, check=True, aligner=None, index=0):
+        '''
+        ip, port = address of the PMU (its TCP server)
+        id_code = IDCODE of its data stream
+        capacity = frames kept in the buffer
+        check = checks the CHK of every data frame
+        '''
+        self.ip = ip
+        self.aligner = aligner
+        self.index = index
+        self.port = port
+        self.id_code = id_code
+        self.capacity = capacity
+        self.check = check
+        self.name = '{}:{}'.format(ip, port)
+
+        self.cfg = None
+        self.buffer = None
+        self.connected = False
+        self.last_frame = None # monotonic time the last data frames were received
+        self.frames = 0
+        self.bytes = 0
+        self.errors = 0  # frames with a wrong CHK or lost framing
+        self.other = 0   # frames other than data received while streaming
+
+    async def run(self):
+        '''
+        Connects, starts the data stream and reads it until the connection is closed or the task is cancelled.
+        '''
+        reader, writer = await asyncio.open_connection(self.ip, self.port)
+        try:
+            writer.write(command_frame("cfg2", self.id_code))
+            cfg = None
+            while cfg is None:
+                frame = await self.read_frame(reader)
+                if frame_type(frame) == "cfg2":
+                    cfg = decode_config(frame)
+            if self.buffer is None or self.buffer.format.dtype != DataFrameFormat(cfg).dtype:
+                self.buffer = StreamBuffer(cfg, self.capacity) # new layout, the old frames are dropped
+            self.format = self.buffer.format
+            self.cfg = cfg # last: configured (see Receiver.configs)
+
+            writer.write(command_frame("start", self.id_code))
+            await writer.drain()
+            self.connected = True
+            print('Receiver: {} streaming {} phasors at {} frames/s'.format(self.name, self.format.nPhasors, self.cfg.get_data_rate()))
+            if self.aligner and (self.format.nPhasors > self.aligner.nPhasors or self.cfg.get_data_rate() > self.aligner.data_rate):
+                print('Receiver: {} configured for more than the aligner ({} phasors at {} frames/s): frames or phasors are lost.'.format(
+                      self.name, self.aligner.nPhasors, self.aligner.data_rate))
+
+            rest = b''
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                self.bytes += len(data)
+                rest = self.receive(rest + data if rest else data)
+        finally:
+            self.connected = False
+            writer.close()
+
+    async def read_frame(self, reader):
+        head = await reader.readexactly(4)
+        size = frame_size(head)
+        if size is None or size < 4:
+            raise ConnectionError('{}: lost the frame boundaries'.format(self.name))
+        return head + await reader.readexactly(size - 4)
+
+    def receive(self, data):
+        '''
+        Decodes the data frames in data and appends them to the buffer. Returns the bytes of the last frame, not complete yet.
+        '''
+        view = memoryview(data)
+        offset = 0
+        while len(data) - offset >= 4:
+            frames = self.format.decode_many(view[offset:], self.check)
+            if len(frames):
+                columns = self.buffer.append(frames)
+                if self.aligner:
+                    self.aligner.add(self.index, columns)
+                self.frames += len(frames)
+                self.last_frame = time.monotonic()
+                offset += len(frames)*self.format.size
+                continue
+
+            size = frame_size(data[offset:offset + 4])
+            if size is None or size < 4:
+                self.errors += 1 # lost the framing: skip to the next SYNC
+                next_sync = data.find(b'\xaa', offset + 1)
+                offset = len(data) if next_sync < 0 else next_sync
+                continue
+            if len(data) - offset < size:
+                break
+            if frame_type(data[offset:offset + 4]) == "data":
+                self.errors += 1 # wrong CHK or layout
+            else:
+                self.other += 1
+            offset += size
+        return data[offset:]
+
+    def stats(self):
+        return {
+            'connected': self.connected,
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'errors': self.errors,
+            'other': self.other
+        }
+
+class Receiver:
+    '''
+    Receives the data streams of many PMUs in an asyncio event loop, in its own thread (start/stop)
+    or in the caller's one (run). A PMU whose connection fails is connected again after retry seconds.
+    With an aligner.Aligner the frames are combined by timestamp too: the PMUs are its PMUs in the order of pmus.
+    '''
+
+    def __init__(self, pmus, capacity=3000, check=True, retry=1, aligner=None, stale=2):
+        '''
+        pmus = list of (ip, port, id_code) of the PMUs
+        capacity = frames kept for every PMU
+        check = checks the CHK of every data frame
+        retry = seconds between the connection attempts
+        aligner = Aligner fed with the frames of all the PMUs, its wait windows are checked in the event loop
+        stale = seconds without data frames after which a connected PMU is not waited for by pull
+        '''
+        self.connections = [ PmuConnection(ip, port, id_code, capacity, check, aligner, i) for i, (ip, port, id_code) in enumerate(pmus) ]
+        self.retry = retry
+        self.stale = stale
+        self.aligner = aligner
+        self.loop = None
+        self.cursor = None # end of the last block pulled
+
+    async def keep_connected(self, connection):
+        while True:
+            try:
+                await connection.run()
+                print('Receiver: {} disconnected.'.format(connection.name))
+            except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                print('Receiver: {} {}'.format(connection.name, e))
+            await asyncio.sleep(self.retry)
+
+    async def expire(self):
+        '''
+        Emits the slots of the aligner whose wait window expired without new frames.
+        '''
+        while True:
+            await asyncio.sleep(self.aligner.wait/4)
+            self.aligner.poll()
+
+    async def run(self):
+        '''
+        Receives from all the PMUs until cancelled.
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.tasks = [ asyncio.ensure_future(self.keep_connected(c)) for c in self.connections ]
+        if self.aligner:
+            self.tasks.append(asyncio.ensure_future(self.expire()))
+        try:
+            await asyncio.gather(*self.tasks)
+        except asyncio.CancelledError:
+            pass
+
+    def start(self):
+        '''
+        Runs the event loop in a new thread.
+        '''
+        self.thread = threading.Thread(target=asyncio.run, args=(self.run(),), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Stops the thread started by start, closing all the connections.
+        '''
+        if self.loop:
+            for task in self.tasks:
+                self.loop.call_soon_threadsafe(task.cancel)
+        self.thread.join()
+
+    def configs(self, timeout=10):
+        '''
+        Waits up to timeout seconds for the configuration of every PMU. Returns the Config of every PMU configured, by name.
+        '''
+        end = time.monotonic() + timeout
+        while time.monotonic() < end and any(c.cfg is None for c in self.connections):
+            time.sleep(0.05)
+        return { c.name: c.cfg for c in self.connections if c.cfg is not None }
+
+    def set_aligner(self, aligner):
+        '''
+        Feeds aligner with the frames received from now on, e.g. once it is sized from the configurations (see configs).
+        '''
+        for connection in self.connections:
+            connection.aligner = aligner
+        self.aligner = aligner
+        if self.loop:
+            self.loop.call_soon_threadsafe(lambda: self.tasks.append(asyncio.ensure_future(self.expire())))
+
+    def buffers(self):
+        '''
+        Returns the StreamBuffer of every PMU configured so far, by name ("ip:port").
+        '''
+        return { c.name: c.buffer for c in self.connections if c.buffer is not None }
+
+    def block(self, t0, t1):
+        '''
+        Returns the columns (see StreamBuffer.read) of the frames of every PMU with time in [t0, t1), by name.
+        '''
+        return { name: buffer.between(t0, t1) for name, buffer in self.buffers().items() }
+
+    def pull(self, duration):
+        '''
+        Returns the next block of duration seconds (see block) once every PMU streaming has sent a frame past its end,
+        None before. The first block starts at the oldest frame received.
+        The PMUs connected but silent for stale seconds are not waited for: their frames missing from the block are lost.
+        '''
+        now = time.monotonic()
+        buffers = [ c.buffer for c in self.connections if c.connected and c.buffer.count and now - c.last_frame < self.stale ]
+        if not buffers:
+            return None
+        if self.cursor is None:
+            self.cursor = min(float(b.read(b.oldest(), b.oldest() + 1)['time'][0]) for b in buffers)
+        if min(b.latest_time() for b in buffers) < self.cursor + duration:
+            return None
+
+        t0, self.cursor = self.cursor, self.cursor + duration
+        return self.block(t0, self.cursor)
+
+    def stats(self):
+        return { c.name: c.stats() for c in self.connections }
@@ -1,61 +1,320 @@
-from usb_20x import *
+from recorder import RawRecorder
+from metrics import Counter
 import numpy as np
 import math
 from random import random
 from pprint import pprint
-import RPi.GPIO as gpio
+try:
+    import RPi.GPIO as gpio
+except ImportError: #not on a raspberry: only the software PPS (see simulator.SoftPPS)
+    gpio = None
 import subprocess
+import threading
+import signal
+import time
 import os
 
 class Redlab:
     '''
     This class implements all the methods for scanning the signals in input to the channels of the PMU.
-    Uses the library usb_20x, part of the redlab drivers.
+    Uses the library usb_20x, part of the redlab drivers, imported only to open the USB-201:
+    with another device (e.g. simulator.SimulatedUSB201) libusb is not needed.
     '''
     
     STALL_ON_OVERRUN        = 0x0
     INHIBIT_STALL           = 0x1 << 7
     
-    def __init__(self, channels=1, frequency=10000, nSamples=2000, options=0b10000000, trigger = 1):
+    def __init__(self, channels=1, frequency=10000, nSamples=2000, options=0b10000000, trigger = 1, zero_copy = False, nBuffers = 2,
+                 continuous = False, buffer_seconds = 4, transfers = 0, device = None, reset = True):
         '''
         channels: number of channels or list of channels
         frequency: sampling frequency per channel
         nSamples: number of samples for channel to read
         trigger: if set to 1 synchronizes the measurements with the PPS given by the GPS module
         options: first bit sets the stall options. Many other options are available(see USB_20x)
+        zero_copy: if True the scans are read into a ring of nBuffers preallocated buffers instead of new lists
+        continuous: if True the scan is started once and a background thread drains the device into a ring buffer
+                    of buffer_seconds seconds; read returns the most recent nSamples without restarting the scan
+        transfers: number of asynchronous bulk transfers in flight in continuous mode (0 for a blocking reader thread)
+        device: the device to scan, with the interface of usb_20x (e.g. simulator.SimulatedUSB201): if None the USB-201 is opened
+        reset: if True the USB-201 is reset before being opened
         '''
-        self.reset()
-
-
         if frequency < 1 or frequency > 12500*len(channels):
             raise ValueError("The frequency must be in range 1 < f <= 12500 ") #100Ks/s is the maximum, but has to be split by the 8 channels
 
-        try:
-            self.device = usb_201() #Add control on the model here for future changes in the architecture.
-            print("USB-201 device found.")
-
-        except:
-            print("USB-201 device not found.")
+        if device is not None:
+            self.device = device
+        else:
+            if reset:
+                self.reset()
+            from usb_20x import usb_201 #libusb, only for the real device
+            try:
+                self.device = usb_201() #Add control on the model here for future changes in the architecture.
+                print("USB-201 device found.")
 
+            except:
+                print("USB-201 device not found.")
 
             
         self.nSamples = nSamples
         self.frequency = len(channels)*frequency
         self.options = options
         self.trigger = trigger
+        self.zero_copy = zero_copy
+        self.continuous = continuous
+        self.recorder = None
+        self.overruns = Counter() #scans lost, or stream restarts
+        self.read_time = None #Histograms of the USB reads (see instrument)
+        self.scan_wait = None
 
         self.set_num_channels(channels)
-        self.setup_scan()
+        self.set_calibration()
+        if zero_copy:
+            self.set_ring(nBuffers)
+
+        if continuous:
+            self.start_stream(buffer_seconds, transfers=transfers)
+        else:
+            self.setup_scan()
         
     def setup_scan(self):
         '''
         Setup the RedLab Continuous Analog Input Scan. Uses methods from the lib.
         '''
-        if self.device.Status() == 2:
+        if self.device.Status() & (self.device.AIN_SCAN_RUNNING | self.device.AIN_SCAN_OVERRUN):
             self.device.AInScanStop()
             self.device.AInScanClearFIFO()
         self.device.AInScanStart(self.nSamples, self.frequency, self.channel_mask, self.options, self.trigger, 0)
     
+    def start_stream(self, buffer_seconds=4, chunks_per_second=10, transfers=0):
+        '''
+        Starts the continuous scan (count = 0) and the reader draining the bulk endpoint into the stream ring buffer.
+        The ring holds buffer_seconds of scans and is filled chunks_per_second times per second;
+        the completion time of every chunk is recorded (monotonic clock), so that every scan can be timestamped.
+        transfers: if 0 the reader is a thread doing blocking reads straight into the ring,
+                   otherwise the asynchronous BulkInStream with that many bulk transfers in flight.
+        '''
+        nChannels = len(self.channels)
+        frequency = self.frequency/nChannels
+
+        step = 32//math.gcd(nChannels, 32) # chunks are a multiple of the 64 bytes packets
+        self.stream_chunk = max(step, int(frequency/chunks_per_second)//step*step)
+        nChunks = max(2, math.ceil(buffer_seconds*frequency/self.stream_chunk))
+
+        self.stream_buffer = np.zeros((nChunks*self.stream_chunk, nChannels), dtype='<u2')
+        self.stream_times = np.zeros(nChunks)   # completion time of every chunk
+        self.stream_count = 0                   # scans written since the start of the stream
+        self.stream_restarts = 0
+        self.stream_partial = b''              # bytes of an incomplete scan at the end of the last chunk
+        self.stream_cond = threading.Condition()
+
+        if self.device.Status() & self.device.AIN_SCAN_RUNNING:
+            self.device.AInScanStop()
+            self.device.AInScanClearFIFO()
+        self.device.AInScanStart(0, self.frequency, self.channel_mask, self.options, self.trigger, 0)
+
+        self.streaming = True
+        if transfers:
+            from usb_20x import BulkInStream
+            self.stream_engine = BulkInStream(self.device, 2*self.stream_chunk*nChannels, transfers,
+                                              callback=self.stream_store, error_callback=self.stream_restart)
+            self.stream_engine.start()
+        else:
+            self.stream_engine = None
+            self.stream_thread = threading.Thread(target=self.stream_loop, daemon=True)
+            self.stream_thread.start()
+
+    def stop_stream(self):
+        '''
+        Stops the stream reader and the continuous scan.
+        '''
+        self.streaming = False
+        if self.stream_engine:
+            self.stream_engine.stop()
+        else:
+            self.stream_thread.join()
+        self.device.AInScanStop()
+        self.device.AInScanClearFIFO()
+
+    def stream_loop(self):
+        '''
+        Body of the stream thread: reads chunk after chunk straight into the ring buffer.
+        A short read can end in the middle of a scan: its samples are kept in stream_partial, as in stream_store,
+        and the next chunks are read into a scratch buffer and completed by stream_store until the scans are aligned again.
+        '''
+        capacity = len(self.stream_buffer)
+        nChannels = len(self.channels)
+        scratch = bytearray(2*self.stream_chunk*nChannels)
+        last = None # completion time of the previous chunk
+
+        while self.streaming:
+            start = self.stream_count % capacity
+            nScan = min(self.stream_chunk, capacity - start)
+            t = time.monotonic()
+            if self.stream_partial:
+                n = self.device.AInScanReadInto(scratch, nScan)
+            else:
+                n = self.device.AInScanReadInto(self.stream_buffer[start:start+nScan], nScan)
+            if last is not None:
+                self.observe_read(t, last + nScan/(self.frequency/nChannels)) # acquired a chunk after the previous one
+
+            if n is None:
+                self.stream_restart()
+                last = None
+                continue
+            last = time.monotonic()
+            if self.stream_partial:
+                self.stream_store(memoryview(scratch)[:2*n], last)
+                continue
+            whole = n//nChannels
+            if n % nChannels:
+                self.stream_partial = self.stream_buffer[start+whole, :n % nChannels].tobytes()
+            if whole:
+                self.stream_commit(whole, last)
+
+    def stream_store(self, data, t):
+        '''
+        BulkInStream callback: copies the chunk of interleaved samples acquired at time t into the ring buffer.
+        A short transfer can end in the middle of a scan: its bytes are kept and completed by the next chunk.
+        '''
+        if self.stream_partial:
+            data = self.stream_partial + data
+        whole = len(data) - len(data) % (2*len(self.channels))
+        self.stream_partial = bytes(data[whole:])
+        if whole == 0:
+            return
+        raw = np.frombuffer(data, dtype='<u2', count=whole//2).reshape(-1, len(self.channels))
+        capacity = len(self.stream_buffer)
+
+        start = self.stream_count % capacity
+        n = min(len(raw), capacity - start)
+        self.stream_buffer[start:start+n] = raw[:n]
+        self.stream_buffer[:len(raw)-n] = raw[n:]
+        self.stream_commit(len(raw), t)
+
+    def stream_commit(self, n, t):
+        '''
+        Publishes n new scans of the ring buffer, the last of them acquired at time t, and wakes up the readers.
+        '''
+        if self.recorder:
+            capacity = len(self.stream_buffer)
+            i = self.stream_count % capacity
+            raw = self.stream_buffer[i:i+n] if i + n <= capacity else np.concatenate((self.stream_buffer[i:], self.stream_buffer[:i+n-capacity]))
+            self.recorder.record(raw, self.stream_count, t - (n - 1)/(self.frequency/len(self.channels)))
+
+        with self.stream_cond:
+            self.stream_count += n
+            self.stream_times[(self.stream_count - 1)//self.stream_chunk % len(self.stream_times)] = t
+            self.stream_cond.notify_all()
+
+    def stream_restart(self, status=None):
+        '''
+        After an error (e.g. overrun) the scan is restarted and the stream counter starts again from 0,
+        since the next scan is synchronized to a new trigger.
+        '''
+        with self.stream_cond:
+            print('Redlab: stream interrupted, restarting the scan.')
+            self.stream_count = 0
+            self.stream_partial = b''
+            self.stream_restarts += 1
+            self.overruns.inc()
+            self.device.AInScanStop()
+            self.device.AInScanClearFIFO()
+            self.device.AInScanStart(0, self.frequency, self.channel_mask, self.options, self.trigger, 0)
+            self.stream_cond.notify_all()
+
+    def read_window(self, start, stop, timeout=2):
+        '''
+        Returns the scan (see read) made of the stream samples from start to stop (absolute scan indexes),
+        waiting for them if they are not acquired yet. 
+        The scan contains also 'start', the index of its first sample, 'time', the estimated acquisition time
+        of the first sample (monotonic clock, see timing.PPSClock), and 'restarts', the restarts of the stream before it.
+        Returns None if the samples are not available anymore or the stream was restarted.
+        The oldest chunk of the ring is not available: the reader is writing the next one over it.
+        The samples are copied out of the ring, so the scan stays valid after the ring wraps around.
+        '''
+        capacity = len(self.stream_buffer)
+
+        with self.stream_cond:
+            restarts = self.stream_restarts
+            if not self.stream_cond.wait_for(lambda: self.stream_count >= stop or self.stream_restarts != restarts, timeout):
+                return None
+            if self.stream_restarts != restarts or not self.stream_available(start):
+                return None
+            last_chunk = (self.stream_count - 1)//self.stream_chunk % len(self.stream_times)
+            t = self.stream_times[last_chunk] - (self.stream_count - start)/(self.frequency/len(self.channels))
+
+        i, j = start % capacity, stop % capacity
+        if i < j or start == stop:
+            raw = self.stream_buffer[i:i+stop-start].copy()
+        else:
+            raw = np.concatenate((self.stream_buffer[i:], self.stream_buffer[:j]))
+
+        with self.stream_cond:
+            if self.stream_restarts != restarts or not self.stream_available(start): # overwritten while copying
+                return None
+
+        raw, data, volts = deinterleave(raw, len(self.channels), self.slopes, self.intercepts)
+        scan = self.make_scan(raw, data, volts)
+        scan['samples'] = stop - start
+        scan['start'] = start
+        scan['time'] = t
+        scan['restarts'] = restarts
+        return scan
+
+    def stream_index_at(self, mono):
+        '''
+        Returns the (fractional) index of the stream sample acquired at the monotonic time mono, estimated from the
+        completion time of the last chunk (late by the latency of the USB transfer), and the restarts of the stream.
+        None if no sample was acquired yet.
+        '''
+        with self.stream_cond:
+            if self.stream_count == 0:
+                return None
+            last = self.stream_times[(self.stream_count - 1)//self.stream_chunk % len(self.stream_times)]
+            return self.stream_count - 1 + (mono - last)*self.frequency/len(self.channels), self.stream_restarts
+
+    def stream_available(self, start):
+        '''
+        True if the samples of the stream from start are still in the ring buffer and not being overwritten
+        (the chunk after the last one acquired is being written over the oldest one). Called holding stream_cond.
+        '''
+        return 0 <= start and start >= self.stream_count - len(self.stream_buffer) + self.stream_chunk
+
+    def close(self):
+        '''
+        Stops the scan (and the stream reader in continuous mode).
+        '''
+        if self.continuous:
+            self.stop_stream()
+        else:
+            self.device.AInScanStop()
+            self.device.AInScanClearFIFO()
+        if self.recorder:
+            self.recorder.stop()
+
+    def instrument(self, metrics):
+        '''
+        Registers the metrics of the redlab in metrics (see metrics.Metrics): the time of the USB reads, split into the
+        wait for the samples to be acquired and the rest (see observe_read), the overruns and, in continuous mode,
+        the scans in the stream ring buffer.
+        '''
+        self.scan_wait = metrics.histogram('scan_wait_seconds', 'Time of the USB reads spent waiting for the samples to be acquired')
+        self.read_time = metrics.histogram('usb_read_seconds', 'Time of the USB reads after the last sample was acquired')
+        metrics.counter('overruns_total', 'Scans lost or stream restarts of the USB-201', self.overruns)
+        if self.continuous:
+            metrics.gauge('stream_buffered_scans', 'Scans in the stream ring buffer', lambda: min(self.stream_count, len(self.stream_buffer)))
+
+    def record(self, directory, clock=None, **options):
+        '''
+        Starts recording the raw scans read (or streamed) into directory (see recorder.RawRecorder, for clock and the options).
+        Returns the recorder.
+        '''
+        recorder = RawRecorder(directory, self.channels, self.frequency/len(self.channels), (self.slopes, self.intercepts), clock, **options)
+        recorder.start()
+        self.recorder = recorder
+        return recorder
+
     def reset(self, t=5):
         path = os.path.dirname(os.path.realpath(__file__)) + '/reset'
         subprocess.run(path)
@@ -85,57 +344,175 @@ class Redlab:
             self.channel_mask |= (0x1 << i)
             
         
-    def read(self):
+    def set_calibration(self):
+        '''
+        Builds the per-channel slope and intercept vectors of the scanned channels,
+        so that a whole scan can be calibrated with a single broadcast operation.
+        '''
+        self.slopes = np.array([self.device.table_AIn[c].slope for c in self.channels])
+        self.intercepts = np.array([self.device.table_AIn[c].intercept for c in self.channels])
+
+    def observe_read(self, t, end):
+        '''
+        Observes the USB read started at the monotonic time t, ending now, in the metrics (if any): the samples read
+        come in while they are acquired (the FIFO doesn't hold a whole scan), so the time until the acquisition
+        of the last one, end, is the wait for the scan and only the rest is the cost of the read.
+        '''
+        if self.read_time is None:
+            return
+        now = time.monotonic()
+        acquired = max(t, min(end, now))
+        self.scan_wait.observe(acquired - t)
+        self.read_time.observe(now - acquired)
+
+    def read(self, edge=None):
         '''
         Returns: a dictionary containing the sampled data in three different formats:
         raw_data, data and volts. data = rawdata*slope + intercept. volts = volts(data)
-        The size of the dictionary is nSamples*channels. 
+        Every format is a numpy array of nSamples elements for each channel.
+        The (channels, samples) matrix of the volts is also returned under 'volts'.
+        In zero copy mode the arrays are views on the ring buffers, valid until the ring wraps around (nBuffers reads):
+        the dictionary is a new one every read, the arrays are not.
+        In continuous mode returns the most recent nSamples of the stream.
+        Returns None if the scan is lost (e.g. overrun): the next one starts on the next PPS;
+        in continuous mode, also if the stream doesn't give the scan within its duration and a second.
+        edge = monotonic time of the PPS edge that triggered the scan, to split the time of the read in the metrics
+               (see observe_read): not observed if None.
         '''
 
+        if self.continuous:
+            timeout = self.nSamples/(self.frequency/len(self.channels)) + 1 # a scan and a margin
+            with self.stream_cond:
+                if not self.stream_cond.wait_for(lambda: self.stream_count >= self.nSamples, timeout):
+                    print('Redlab: no scan from the stream in {:.1f} s.'.format(timeout))
+                    return None # stalled (or unplugged)
+                stop = self.stream_count
+            return self.read_window(stop - self.nSamples, stop, timeout)
+
+        if self.zero_copy:
+            scan = self.ring[self.ring_index]
+            self.ring_index = (self.ring_index + 1) % len(self.ring)
+
+            t = time.monotonic()
+            n = self.device.AInScanReadInto(scan['buffer'], self.nSamples)
+            if edge is not None:
+                self.observe_read(t, edge + self.nSamples/(self.frequency/len(self.channels)))
+            if n is None:
+                self.overruns.inc()
+                self.setup_scan() #lost, wait for the next PPS
+                return None
+            deinterleave(scan['buffer'], len(self.channels), self.slopes, self.intercepts, out=(scan['data'], scan['volts']))
+            if self.recorder:
+                self.recorder.record(scan['raw'], 0, time.monotonic() - self.nSamples/(self.frequency/len(self.channels)))
+
+            self.setup_scan()
+            return self.make_scan(scan['raw'], scan['data'], scan['volts'])
+
+        t = time.monotonic()
         raw_data = self.device.AInScanRead(self.nSamples)
+        if edge is not None:
+            self.observe_read(t, edge + self.nSamples/(self.frequency/len(self.channels)))
+        if raw_data is None:
+            self.overruns.inc()
+            self.setup_scan() #lost, wait for the next PPS
+            return None
 
-        data = {}
-
-        for c in self.channels: # init dict
-            data[c] = {
-                'rawData': [],
-                'volts': [],
-                'data': []
-            }
-            
-
-
+        raw, data, volts = deinterleave(raw_data, len(self.channels), self.slopes, self.intercepts)
+        if self.recorder:
+            self.recorder.record(raw, 0, time.monotonic() - self.nSamples/(self.frequency/len(self.channels))) #the scan started on the PPS
 
+        self.setup_scan()
+        return self.make_scan(raw, data, volts)
 
+    def make_scan(self, raw, data, volts):
+        '''
+        Wraps the decoded arrays in the scan dictionary returned by read.
+        '''
+        channels = {}
+        for i, chan in enumerate(self.channels):
+            channels[chan] = {
+                'rawData': raw[:, i],
+                'data': data[i],
+                'volts': volts[i]
+            }
 
+        return { 'channels': channels, 'frequency': self.frequency/len(self.channels), 'samples': self.nSamples, 'volts': volts}
 
+    def set_ring(self, nBuffers):
+        '''
+        Preallocates nBuffers slots for the zero copy reads. Every slot holds the bytearray the bulk endpoint is read into,
+        its uint16 view and the calibrated data and volts arrays, so that reading a scan allocates only the small
+        dictionaries wrapping them (see make_scan).
+        '''
+        self.ring = []
+        self.ring_index = 0
+        nChannels = len(self.channels)
 
+        for _ in range(nBuffers):
+            buffer = bytearray(2*self.nSamples*nChannels)
+            raw = np.frombuffer(buffer, dtype='<u2').reshape(self.nSamples, nChannels)
+            data = np.empty((nChannels, self.nSamples))
+            volts = np.empty((nChannels, self.nSamples))
 
+            self.ring.append({
+                'buffer': buffer,
+                'raw': raw,
+                'data': data,
+                'volts': volts
+            })
 
 
+def deinterleave(raw_data, nChannels, slopes, intercepts, out=None):
+    '''
+    Reshapes the interleaved buffer returned by AInScanRead into a (nSamples, nChannels) array
+    and applies the calibration and the volts conversion to all the samples at once.
+    raw_data: interleaved samples (ch0 s0, ch1 s0, ..., ch0 s1, ...), a list or a buffer of uint16
+    slopes, intercepts: calibration vectors, one element per channel
+    out: optional (data, volts) arrays to fill in place
+    Returns: raw (nSamples, nChannels), data and volts (nChannels, nSamples) arrays.
+    '''
+    if isinstance(raw_data, (bytes, bytearray, memoryview)):
+        raw = np.frombuffer(raw_data, dtype='<u2').reshape(-1, nChannels)
+    else:
+        raw = np.asarray(raw_data, dtype=np.uint16).reshape(-1, nChannels)
 
+    if out is None:
+        out = (np.empty((nChannels, raw.shape[0])), np.empty((nChannels, raw.shape[0]))) # channel major, so that every channel is contiguous
+    data, volts = out
 
+    np.multiply(raw.T, slopes[:, np.newaxis], out=data)
+    data += intercepts[:, np.newaxis]
 
+    np.subtract(data, 2048, out=volts)  # same conversion as usb_20x.volts
+    volts *= 10.
+    volts /= 2048.
 
-        for scan in range(self.nSamples):
-            '''
-            Cycles on the scans, and fills the dictionary.
-            '''
-            for i, chan in enumerate(self.channels):
-                
-                ii = scan*len(self.channels) + i
-                
-                data[chan]['rawData'].append(raw_data[ii])
-                data[chan]['data'].append(raw_data[ii]*self.device.table_AIn[chan].slope + self.device.table_AIn[chan].intercept)
+    return raw, data, volts
 
 
-        for c in self.channels:
-            data[c]['volts'] = [self.device.volts(x) for x in data[c]['data']]
+def wait_for_signals(event=None, signals=(signal.SIGTERM, signal.SIGINT)):
+    '''
+    Blocks the calling (main) thread without using the CPU until event is set 
+    or one of the signals arrives (SIGTERM from systemd stopping pmu.service, SIGINT from Ctrl+C).
+    The previous handlers of the signals are restored before returning.
+    Returns the signal received, or None if the event was set.
+    '''
+    if event is None:
+        event = threading.Event()
+    received = []
 
+    def handler(signum, frame):
+        received.append(signum)
+        event.set()
 
-        self.setup_scan()
-        return { 'channels': data, 'frequency': self.frequency/len(self.channels), 'samples': self.nSamples}
+    previous = { s: signal.signal(s, handler) for s in signals }
+    try:
+        event.wait()
+    finally:
+        for s in previous:
+            signal.signal(s, previous[s])
 
+    return received[0] if received else None
 
 def main1():
     from pprint import pprint
@@ -177,8 +554,9 @@ def main2():
     callback = make_callback(r)
     gpio.add_event_callback(18, callback)
 
-    while True:
-        pass
+    wait_for_signals()
+    gpio.cleanup()
+    r.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,429 @@
+from frames import *
+from metrics import Counter
+from collections import deque
+import ipaddress
+import selectors
+import socket
+import threading
+import time
+'''
+This file implements the TCP server of the PMU (IEEE C37.118 over TCP), in place of the one of pypmu:
+a single thread serves all the PDCs with non-blocking sockets and a selector.
+Every data frame is serialized once and the same bytes are queued to all the PDCs that sent the start command,
+each one in its own bounded queue: a slow or stalled PDC only loses its own frames,
+and is disconnected when it falls too far behind, without delaying the others nor the PMU.
+The data frames can also be sent over UDP, unicast or multicast (UdpSender).
+'''
+
+class Client:
+    '''
+    A connected PDC: its socket, the frames to send and its counters.
+    '''
+
+    def __init__(self, sock, address, maxsize):
+        self.sock = sock
+        self.address = address
+        self.maxsize = maxsize
+        self.queue = deque()     # data frames to send (bytes)
+        self.replies = deque()   # answers to the commands, sent before the data frames
+        self.out = None          # memoryview on the rest of the frame being sent
+        self.out_data = False    # the frame being sent is a data frame
+        self.inbuf = bytearray() # bytes received, not yet a whole frame
+        self.streaming = False   # start command received
+        self.events = selectors.EVENT_READ
+
+        self.sent = 0            # data frames
+        self.dropped = 0
+        self.lag = 0             # data frames dropped since the last one sent
+        self.invalid = 0         # frames received that are not valid commands
+
+    def stats(self):
+        return {
+            'address': '{}:{}'.format(*self.address[:2]),
+            'streaming': self.streaming,
+            'queued': len(self.queue),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'lag': self.lag,
+            'invalid': self.invalid
+        }
+
+class FanOutServer:
+    '''
+    TCP server sending the data frames to all the connected PDCs and answering their commands
+    (start, stop, header, cfg1, cfg2).
+    send can be called from any thread: it only queues the frame and wakes the server thread up.
+    '''
+
+    def __init__(self, cfg, header, ip="127.0.0.1", port=4712, maxsize=10, max_lag=None):
+        '''
+        cfg = ConfigFrame2 of the data stream, sent on the cfg1/cfg2 commands
+        header = HeaderFrame, sent on the header command
+        maxsize = maximum number of frames queued to a PDC, then the new frames are dropped
+        max_lag = number of frames dropped in a row after which the PDC is disconnected (default 2*maxsize)
+        '''
+        self.cfg = cfg
+        self.header = header
+        self.ip = ip
+        self.port = port
+        self.maxsize = maxsize
+        self.max_lag = 2*maxsize if max_lag is None else max_lag
+
+        self.clients = []
+        self.evicted = 0
+        self.dropped = Counter() # frames dropped for all the PDCs, also the ones gone
+        self.running = False
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        self.lock = threading.Lock() # clients list
+
+    def start(self):
+        '''
+        Binds the port and starts the server thread.
+        '''
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.ip, self.port))
+        self.sock.listen(5)
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1] # if 0 was given
+
+        self.selector.register(self.sock, selectors.EVENT_READ, self.accept)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, self.wakeup)
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        print('Server: waiting for connections on {}:{}'.format(self.ip, self.port))
+
+    def stop(self):
+        '''
+        Stops the server thread and closes all the connections.
+        '''
+        self.running = False
+        self.wake()
+        self.thread.join()
+
+        for client in list(self.clients):
+            self.close(client)
+        self.selector.close()
+        self.sock.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+    def send(self, frame):
+        '''
+        Queues the frame (bytes, shared by all the queues) to every PDC that sent the start command.
+        If the queue of a PDC is full the frame is dropped for it.
+        '''
+        with self.lock:
+            clients = list(self.clients)
+
+        for client in clients:
+            if not client.streaming:
+                continue
+            if len(client.queue) >= client.maxsize:
+                client.dropped += 1
+                client.lag += 1
+                self.dropped.inc()
+            else:
+                client.queue.append(frame)
+        self.wake()
+
+    def wake(self):
+        '''
+        Wakes the server thread up.
+        '''
+        try:
+            self.wakeup_w.send(b'\0')
+        except BlockingIOError:
+            pass # already awake
+
+    def run(self):
+        '''
+        Body of the server thread.
+        '''
+        while self.running:
+            for key, events in self.selector.select():
+                if callable(key.data): # listening or wake up socket
+                    key.data()
+                    continue
+                client = key.data
+                if events & selectors.EVENT_READ and client in self.clients:
+                    self.receive(client)
+                if events & selectors.EVENT_WRITE and client in self.clients:
+                    self.write(client)
+
+    def accept(self):
+        try:
+            sock, address = self.sock.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = Client(sock, address, self.maxsize)
+        with self.lock:
+            self.clients.append(client)
+        self.selector.register(sock, selectors.EVENT_READ, client)
+        print('Server: connection from {}:{}'.format(*address[:2]))
+
+    def wakeup(self):
+        '''
+        Drains the wake up socket, evicts the PDCs too far behind and starts writing to the ones with frames queued.
+        '''
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        for client in list(self.clients):
+            if client.lag > self.max_lag:
+                print('Server: {}:{} too slow, disconnected.'.format(*client.address[:2]))
+                self.evicted += 1
+                self.close(client)
+            elif (client.queue or client.replies) and client.out is None:
+                self.write(client)
+
+    def close(self, client):
+        with self.lock:
+            if client not in self.clients:
+                return
+            self.clients.remove(client)
+        self.selector.unregister(client.sock)
+        client.sock.close()
+
+    def watch(self, client, events):
+        '''
+        Sets the events of the client socket the selector waits for.
+        '''
+        if client.events != events:
+            client.events = events
+            self.selector.modify(client.sock, events, client)
+
+    def receive(self, client):
+        '''
+        Reads the commands of the PDC and answers them.
+        '''
+        try:
+            data = client.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            print('Server: {}:{} disconnected.'.format(*client.address[:2]))
+            self.close(client)
+            return
+
+        client.inbuf += data
+        while len(client.inbuf) >= 4:
+            size = frame_size(client.inbuf)
+            if size is None or size < 18:
+                client.inbuf.clear() # lost the frame boundaries
+                break
+            if len(client.inbuf) < size:
+                break
+            frame = bytes(client.inbuf[:size])
+            del client.inbuf[:size]
+            self.command(client, decode_command(frame))
+
+    def command(self, client, command):
+        '''
+        Executes the command of the PDC. The frames that are not valid commands (bad CRC, not a command frame,
+        unknown command) are counted and ignored.
+        '''
+        if command is None:
+            client.invalid += 1
+            print('Server: {}:{} invalid command frame, ignored.'.format(*client.address[:2]))
+            return
+        if command == "start":
+            client.streaming = True
+            client.lag = 0
+        elif command == "stop":
+            client.streaming = False
+            client.queue.clear()
+        elif command == "header":
+            self.header.set_time()
+            self.reply(client, self.header.convert2bytes())
+        elif command in ("cfg1", "cfg2"):
+            self.cfg.set_time()
+            cfg = self.cfg.convert2bytes()
+            self.reply(client, cfg if command == "cfg2" else set_frame_type(cfg, "cfg1"))
+        print('Server: {}:{} command {}'.format(*client.address[:2], command))
+
+    def reply(self, client, frame):
+        '''
+        Queues the answer to a command, ahead of the data frames.
+        '''
+        client.replies.append(frame)
+        if client.out is None:
+            self.write(client)
+
+    def write(self, client):
+        '''
+        Sends as much as the socket takes without blocking; waits for the socket to be writable for the rest.
+        Only the data frames count as sent (and end the lag), not the answers to the commands.
+        '''
+        while True:
+            if client.out is None:
+                if client.replies:
+                    client.out, client.out_data = memoryview(client.replies.popleft()), False
+                elif client.queue:
+                    client.out, client.out_data = memoryview(client.queue.popleft()), True
+                else:
+                    self.watch(client, selectors.EVENT_READ)
+                    return
+            try:
+                n = client.sock.send(client.out)
+            except (BlockingIOError, InterruptedError):
+                n = 0
+            except OSError:
+                print('Server: {}:{} connection lost.'.format(*client.address[:2]))
+                self.close(client)
+                return
+
+            client.out = client.out[n:]
+            if len(client.out):
+                self.watch(client, selectors.EVENT_READ | selectors.EVENT_WRITE)
+                return
+            client.out = None
+            if client.out_data:
+                client.sent += 1
+                client.lag = 0
+
+    def stats(self):
+        '''
+        Returns the counters of every PDC connected, the number of PDCs disconnected for being too slow
+        and of the frames dropped.
+        '''
+        with self.lock:
+            clients = list(self.clients)
+        return { 'clients': [ c.stats() for c in clients ], 'evicted': self.evicted, 'dropped': self.dropped.value }
+
+class UdpSender:
+    '''
+    Sends the data frames in UDP datagrams (C37.118 spontaneous mode: no start command, the PDCs just listen)
+    to a list of destinations, unicast or multicast: a multicast group reaches all its PDCs with one datagram.
+    The commands (configuration, header) are still served on TCP by FanOutServer.
+    Every destination has its own connected socket, so that sending doesn't resolve the address every time.
+    With delay = 0 every frame is sent as soon as it is given, from the calling thread.
+    With delay > 0 the frames are queued and a thread of the sender flushes them, at the latest delay seconds after
+    the oldest one was given: to every destination in turn, back to back, and with coalesce in as few datagrams as
+    fit in max_datagram bytes (one sendmsg of all their frames: Python has no sendmmsg). The PDC has to split such
+    a datagram by the FRAMESIZE of the frames, not every PDC does: without coalesce one frame per datagram.
+    '''
+
+    def __init__(self, destinations, delay=0, coalesce=False, max_datagram=1472, maxsize=100, ttl=1, interface=None):
+        '''
+        destinations = list of (ip, port), also multicast groups (224.0.0.0/4)
+        delay = maximum time in seconds a frame is kept before being sent (0: not kept)
+        coalesce = if True the frames flushed together are sent in datagrams of max_datagram bytes at most
+        max_datagram = maximum size of a datagram of coalesced frames (1472: an ethernet frame); a full one is flushed at once
+        maxsize = maximum number of frames kept, the oldest are dropped beyond
+        ttl = time to live of the multicast datagrams (1: local network only)
+        interface = ip of the interface for the multicast datagrams, the default one if None
+        '''
+        self.destinations = destinations
+        self.delay = delay
+        self.coalesce = coalesce
+        self.max_datagram = max_datagram
+        self.sent = 0       # frames, per destination
+        self.datagrams = 0
+        self.dropped = Counter()
+
+        self.socks = []
+        for ip, port in destinations:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if ipaddress.ip_address(ip).is_multicast:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1) # PDCs on this host too
+                if interface:
+                    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+            sock.connect((ip, port))
+            sock.setblocking(False)
+            self.socks.append(sock)
+
+        self.pending = deque(maxlen=maxsize) # (monotonic time given, frame)
+        self.pending_bytes = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = None
+        if delay > 0:
+            self.thread = threading.Thread(target=self.run, name='udp', daemon=True)
+            self.thread.start()
+
+    def send(self, frame):
+        '''
+        Sends the frame (bytes) to all the destinations, or queues it for the thread of the sender if delay > 0.
+        '''
+        if self.thread is None:
+            self.flush([frame])
+            return
+        with self.cond:
+            if len(self.pending) == self.pending.maxlen:
+                self.pending_bytes -= len(self.pending[0][1])
+                self.dropped.inc(len(self.socks)) # the oldest, pushed out
+            self.pending.append((time.monotonic(), frame))
+            self.pending_bytes += len(frame)
+            if len(self.pending) == 1 or self.pending_bytes >= self.max_datagram:
+                self.cond.notify()
+
+    def run(self):
+        '''
+        Body of the thread of the sender: waits for the first frame, then until it is delay seconds old
+        (or a datagram is full), and flushes all the frames queued.
+        '''
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.closed)
+                if not self.pending:
+                    return # closed
+                deadline = self.pending[0][0] + self.delay
+                self.cond.wait_for(lambda: self.closed or self.pending_bytes >= self.max_datagram, deadline - time.monotonic())
+                frames = [ frame for _, frame in self.pending ]
+                self.pending.clear()
+                self.pending_bytes = 0
+            self.flush(frames)
+
+    def flush(self, frames):
+        '''
+        Sends the frames to every destination. A datagram that doesn't fit in the socket buffer is dropped.
+        '''
+        if self.coalesce:
+            datagrams, size = [[]], 0
+            for frame in frames:
+                if size + len(frame) > self.max_datagram and datagrams[-1]:
+                    datagrams.append([])
+                    size = 0
+                datagrams[-1].append(frame)
+                size += len(frame)
+        else:
+            datagrams = [ [frame] for frame in frames ]
+
+        for sock in self.socks:
+            for datagram in datagrams:
+                try:
+                    sock.sendmsg(datagram)
+                    self.sent += len(datagram)
+                    self.datagrams += 1
+                except (BlockingIOError, ConnectionRefusedError):
+                    self.dropped.inc(len(datagram)) # buffer full, or ICMP port unreachable from a unicast PDC not listening
+
+    def close(self):
+        '''
+        Sends the frames queued and closes the sockets.
+        '''
+        if self.thread:
+            with self.cond:
+                self.closed = True
+                self.cond.notify()
+            self.thread.join()
+        for sock in self.socks:
+            sock.close()
+
+    def stats(self):
+        return { 'destinations': ['{}:{}'.format(*d) for d in self.destinations], 'sent': self.sent, 'datagrams': self.datagrams,
+                 'dropped': self.dropped.value }
@@ -0,0 +1,226 @@
+import math
+import time
+import numpy as np
+'''
+This file implements the synthetic signals used to test the PMU without the hardware: the test scans of the estimator,
+the channels of the simulated USB-201 (see simulator.py) and long test sets.
+A Signal is the model of the voltage at the input of a channel (steps, ramps, harmonics, interharmonics, modulation, noise),
+computed with numpy for any array of times; a Scenario samples the signals of any number of channels lazily,
+chunk by chunk or scan by scan, so that hours of samples can be streamed into the estimator without keeping them in memory.
+'''
+
+class Signal:
+    '''
+    The signal of a channel as a function of t, seconds from the start of the scenario:
+        A(t)*(1 + kx*cos(2pi*fm*t))*cos(2pi*cycles(t) + phase(t) + ka*cos(2pi*fm*t - pi))
+        + harmonics + interharmonics + offset + noise
+    where:
+        A(t) = amplitude, multiplied by the factor of every amplitude step (time, factor) past
+        cycles(t) = integral of the frequency: frequency, changing by ramp Hz/s from ramp_start for ramp_time seconds,
+                    plus the change of every frequency step (time, Hz) past
+        phase(t) = phase, plus the change of every phase step (time, rad) past
+        kx, ka, fm = modulation: amplitude modulation index, phase modulation index (rad), modulation frequency (Hz)
+        harmonics = list of (order, amplitude relative to the fundamental, phase), following the fundamental frequency
+        interharmonics = list of (frequency, amplitude relative to the fundamental, phase)
+        noise = standard deviation of the gaussian noise, volts
+    '''
+
+    def __init__(self, amplitude=3.0, frequency=50.0, phase=0.0, ramp=0.0, ramp_start=0.0, ramp_time=float('inf'),
+                 harmonics=(), interharmonics=(), modulation=None, amplitude_steps=(), phase_steps=(), frequency_steps=(),
+                 noise=0.0, offset=0.0):
+        self.amplitude = amplitude
+        self.frequency = frequency
+        self.phase = phase
+        self.ramp = ramp
+        self.ramp_start = ramp_start
+        self.ramp_time = ramp_time
+        self.harmonics = list(harmonics)
+        self.interharmonics = list(interharmonics)
+        self.modulation = modulation
+        self.amplitude_steps = sorted(amplitude_steps)
+        self.phase_steps = sorted(phase_steps)
+        self.frequency_steps = sorted(frequency_steps)
+        self.noise = noise
+        self.offset = offset
+
+    def cycles(self, t):
+        '''
+        Returns the cycles of the fundamental from t = 0 to the times t (array).
+        '''
+        cycles = self.frequency*t
+        if self.ramp:
+            u = np.clip(t - self.ramp_start, 0, self.ramp_time) # time into the ramp
+            cycles = cycles + self.ramp*u*u/2
+            if math.isfinite(self.ramp_time):
+                cycles += self.ramp*self.ramp_time*np.maximum(t - self.ramp_start - self.ramp_time, 0)
+        for ts, df in self.frequency_steps:
+            cycles = cycles + df*np.maximum(t - ts, 0)
+        return cycles
+
+    def frequency_at(self, t):
+        '''
+        Returns the frequency of the fundamental (without the phase modulation) at the times t (array).
+        '''
+        f = np.full(len(t), float(self.frequency))
+        if self.ramp:
+            f += self.ramp*np.clip(t - self.ramp_start, 0, self.ramp_time)
+        for ts, df in self.frequency_steps:
+            f[t >= ts] += df
+        return f
+
+    def phasor(self, t, nFreq=50):
+        '''
+        Returns the true synchrophasor of the fundamental at the times t (array), as C37.118.1 defines it:
+        amplitude (peak), phase (rad, relative to a cosine at nFreq with phase 0 at t = 0), frequency and rocof.
+        The harmonics, the interharmonics, the offset and the noise are not part of it.
+        '''
+        t = np.asarray(t, float)
+        amplitude = np.full(len(t), float(self.amplitude))
+        phase = 2*np.pi*(self.cycles(t) - nFreq*t) + self.phase
+        frequency = self.frequency_at(t)
+        rocof = np.zeros(len(t))
+        if self.ramp:
+            rocof[(t >= self.ramp_start) & (t < self.ramp_start + self.ramp_time)] = self.ramp
+        if self.amplitude_steps:
+            amplitude *= steps(t, self.amplitude_steps, 1.0, np.multiply)
+        if self.phase_steps:
+            phase += steps(t, self.phase_steps, 0.0, np.add)
+        if self.modulation:
+            kx, ka, fm = self.modulation
+            wm = 2*np.pi*fm*t
+            amplitude *= 1 + kx*np.cos(wm)
+            phase += ka*np.cos(wm - np.pi)
+            frequency -= ka*fm*np.sin(wm - np.pi)
+            rocof -= ka*fm*2*np.pi*fm*np.cos(wm - np.pi)
+        return amplitude, np.angle(np.exp(1j*phase)), frequency, rocof
+
+    def volts(self, t, rng=None):
+        '''
+        Returns the samples at the times t (array). The noise is drawn from rng, none if it is None.
+        '''
+        theta = 2*np.pi*self.cycles(t)
+        angle = theta + self.phase
+        if self.phase_steps:
+            angle += steps(t, self.phase_steps, 0.0, np.add)
+        amplitude = self.amplitude
+        if self.amplitude_steps:
+            amplitude = amplitude*steps(t, self.amplitude_steps, 1.0, np.multiply)
+        if self.modulation:
+            kx, ka, fm = self.modulation
+            wm = 2*np.pi*fm*t
+            amplitude = amplitude*(1 + kx*np.cos(wm))
+            angle += ka*np.cos(wm - np.pi)
+
+        v = amplitude*np.cos(angle)
+        for order, relative, phase in self.harmonics:
+            v += self.amplitude*relative*np.cos(order*theta + phase)
+        for frequency, relative, phase in self.interharmonics:
+            v += self.amplitude*relative*np.cos(2*np.pi*frequency*t + phase)
+        if self.offset:
+            v += self.offset
+        if self.noise and rng is not None:
+            v += rng.normal(0, self.noise, len(t))
+        return v
+
+def steps(t, changes, initial, op):
+    '''
+    Returns, at the times t, the value starting from initial and changed by op with the value of every (time, value) past.
+    '''
+    times = np.array([ ts for ts, _ in changes ])
+    values = op.accumulate(np.concatenate(([initial], [ v for _, v in changes ])))
+    return values[np.searchsorted(times, t, 'right')]
+
+def three_phase(amplitude=3.0, frequency=50.0, nChannels=8, **options):
+    '''
+    Returns the signals of nChannels channels: the phases of a three phase system, again and again.
+    options = the other parameters of every Signal
+    '''
+    return [ Signal(amplitude, frequency, -2*np.pi/3*(c % 3), **options) for c in range(nChannels) ]
+
+class Scenario:
+    '''
+    The signals of the channels sampled at s_freq from t = 0 (sample 0), generated only when asked for.
+    The noise of every channel is drawn in the order its samples are generated: generating them chunk after chunk
+    or all at once gives the same samples, with the same seed.
+    '''
+
+    def __init__(self, signals, s_freq, seed=None):
+        '''
+        signals = Signal of every channel
+        s_freq = sampling frequency of every channel
+        seed = of the noise
+        '''
+        self.signals = list(signals)
+        self.s_freq = s_freq
+        self.rngs = [ np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(len(self.signals)) ] # one per channel
+
+    def samples(self, start, n, out=None):
+        '''
+        Returns the (channels, n) volts of the samples from the index start, filling out if given.
+        '''
+        if out is None:
+            out = np.empty((len(self.signals), n))
+        t = (start + np.arange(n))/self.s_freq
+        for i, signal in enumerate(self.signals):
+            out[i] = signal.volts(t, self.rngs[i])
+        return out
+
+    def chunks(self, duration=None, chunk=None, start=0):
+        '''
+        Yields (index of the first sample, (channels, samples) volts) chunk after chunk, for duration seconds
+        (forever if None). chunk = samples per chunk, a tenth of a second by default.
+        The chunks are new arrays: they can be kept.
+        '''
+        chunk = chunk or max(1, int(self.s_freq//10))
+        end = None if duration is None else start + int(round(duration*self.s_freq))
+        while end is None or start < end:
+            n = chunk if end is None else min(chunk, end - start)
+            yield start, self.samples(start, n)
+            start += n
+
+    def scans(self, nSamples, seconds=None, first=0):
+        '''
+        Yields the scans a PPS triggered Redlab would read (see Redlab.read), the first nSamples of every second
+        from the second first, for seconds seconds (forever if None). Every scan also has 'timestamp', its second.
+        The samples of the rest of the second are not generated.
+        '''
+        second = first
+        while seconds is None or second < first + seconds:
+            volts = self.samples(int(round(second*self.s_freq)), nSamples)
+            scan = {
+                'frequency': self.s_freq,
+                'samples': nSamples,
+                'timestamp': second,
+                'channels': { c: { 'volts': volts[c] } for c in range(len(self.signals)) },
+                'volts': volts
+            }
+            yield scan
+            second += 1
+
+def main(duration=3600, s_freq=12500, rate=10):
+    '''
+    Streams duration seconds of a 8 channels scenario (ramp, harmonics, interharmonics, modulation, steps and noise)
+    into the sliding estimator, reporting rate times per second, and prints the throughput.
+    '''
+    from estimator import SlidingEstimator
+
+    signals = three_phase(noise=0.01, harmonics=[(3, 0.05, 0), (5, 0.03, 0)], interharmonics=[(137.5, 0.01, 0)],
+                          modulation=(0.1, 0.1, 2), ramp=0.0005, ramp_start=600, ramp_time=600,
+                          amplitude_steps=[(1800, 1.1)], phase_steps=[(2400, np.pi/18)])
+    scenario = Scenario(signals, s_freq, seed=1)
+    estimator = SlidingEstimator(len(signals), s_freq)
+    step = s_freq//rate
+
+    t, estimating, estimates = time.perf_counter(), 0, 0
+    for start, volts in scenario.chunks(duration, step):
+        t0 = time.perf_counter()
+        if estimator.update(volts, start):
+            sph = estimator.estimate(range(len(signals)), 1/rate)
+            estimates += 1
+        estimating += time.perf_counter() - t0
+    t = time.perf_counter() - t
+    print('{} s of {} channels at {} Hz in {:.1f} s ({:.0f}x real time, {:.1f} s estimating), {} estimates, last frequency {:.3f} Hz'.format(
+          duration, len(signals), s_freq, t, duration/t, estimating, estimates, sph[0]['avg_freq']))
+
+if __name__ == "__main__":
+    main()
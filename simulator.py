@@ -0,0 +1,333 @@
+from signals import Signal, three_phase
+from struct import pack, unpack
+import math
+import threading
+import time
+import numpy as np
+'''
+This file implements a simulated USB-201 and a software PPS, to run the PMU without the hardware:
+on any Linux box, the whole Redlab -> estimate_phasors -> MyPmu path can be soak-tested at the full
+8 channels x 12.5 kS/s (100 kS/s, the maximum of the USB-201), in real time or faster.
+The simulated device implements the part of the usb_20x interface used by Redlab (AInScanStart, AInScanRead,
+AInScanReadInto, AInScanStop, AInScanClearFIFO, Status, CalMemoryR and table_AIn):
+the samples are computed, not acquired, at the times they would be acquired, and a read returns only when the
+real device would have acquired them. The clock of both is the one of the software PPS (SoftPPS.now): speed > 1
+runs it faster than the wall clock, for the accelerated tests (the timestamps are meaningless then, the
+throughput is not). Not simulated: the asynchronous bulk transfers (the continuous mode needs transfers = 0).
+'''
+
+class SoftPPS:
+    '''
+    A software PPS: a thread calling its callbacks on every edge, at the start of every second of its clock,
+    like the GPIO callbacks of the PPS pin (the argument is the pin, 18).
+    Its clock (now) is the wall clock at speed 1, running speed times faster otherwise.
+    '''
+
+    def __init__(self, speed=1.0, jitter=0.0, channel=18):
+        '''
+        speed = seconds of the clock per second of the wall clock
+        jitter = maximum random delay of the callbacks after the edge, wall clock seconds
+        channel = argument of the callbacks
+        '''
+        self.speed = speed
+        self.jitter = jitter
+        self.channel = channel
+        self.callbacks = []
+        self.origin = time.monotonic()
+        self.epoch = time.time() # clock at origin
+        self.rng = np.random.default_rng()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.edges = 0
+        self.missed = 0 # edges skipped because the callbacks were late
+
+    def now(self):
+        return self.epoch + (time.monotonic() - self.origin)*self.speed
+
+    def next_edge(self, t=None):
+        '''
+        Returns the time of the first edge after t (default: now).
+        '''
+        return math.floor(self.now() if t is None else t) + 1
+
+    def wait_until(self, t):
+        '''
+        Sleeps until the clock reaches t.
+        '''
+        delay = (t - self.now())/self.speed
+        if delay > 0:
+            time.sleep(delay)
+
+    def add_event_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='pps', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        '''
+        Body of the thread.
+        '''
+        edge = self.next_edge()
+        while True:
+            delay = (edge - self.now())/self.speed + self.jitter*self.rng.random()
+            if self.stopped.wait(max(0, delay)):
+                break
+            self.edges += 1
+            for callback in list(self.callbacks):
+                callback(self.channel)
+
+            edge += 1
+            if edge <= self.now(): # the callbacks took more than a second
+                self.missed += self.next_edge() - edge
+                edge = self.next_edge()
+
+class Table:
+    '''
+    A calibration coefficient (same as mccUSB.table).
+    '''
+
+    def __init__(self):
+        self.slope = 0.0
+        self.intercept = 0.0
+
+class SimulatedUSB201:
+    '''
+    A USB-201 whose channels sample the given signals (see signals.Signal), on the clock of the pps (a SoftPPS, not necessarily running).
+    A triggered scan starts on the next edge of the pps. An overrun occurs, as on the device, when the scans
+    acquired and not read yet exceed the FIFO; it can be injected too, at random reads (overrun_rate).
+    The scan stops on an overrun, until it is started again.
+    '''
+
+    AIN_SCAN_RUNNING   = 0x1 << 1
+    AIN_SCAN_OVERRUN   = 0x1 << 2
+    NCHAN              = 8
+    FIFO_SIZE          = 12288 # samples
+    MAX_FREQUENCY      = 100000 # samples per second, all the channels
+
+    def __init__(self, signals=None, pps=None, overrun_rate=0.0, calibration_error=0.002, seed=None, drift=0.0):
+        '''
+        signals = Signal of every channel (default: signals.three_phase()), of t = seconds from the creation of the device
+        pps = SoftPPS giving the clock and the trigger (default: a new one, not started, at speed 1)
+        overrun_rate = probability of an overrun injected at every read
+        calibration_error = relative error of the simulated ADC, corrected by the calibration table
+        seed = of the noise, the calibration and the overruns injected
+        drift = relative error of the sampling clock of the device (e.g. 50e-6): it samples at frequency*(1 + drift)
+        '''
+        self.signals = list(signals or three_phase())
+        if len(self.signals) < self.NCHAN:
+            self.signals += [ Signal(0) for _ in range(self.NCHAN - len(self.signals)) ]
+        self.pps = pps or SoftPPS()
+        self.overrun_rate = overrun_rate
+        self.drift = drift
+        self.rng = np.random.default_rng(seed)
+        self.epoch = math.floor(self.pps.now()) # t = 0 of the signals
+        self.wMaxPacketSize = 64
+
+        # calibrated code = code*slope + intercept, as stored in the FLASH memory of the device
+        slopes = 1 + self.rng.normal(0, calibration_error, self.NCHAN)
+        intercepts = self.rng.normal(0, 2048*calibration_error, self.NCHAN)
+        self.cal_memory = b''.join(pack('ff', s, i) for s, i in zip(slopes, intercepts))
+        self.table_AIn = [ Table() for _ in range(self.NCHAN) ]
+        self.BuildGainTable()
+        self.slopes = np.array([ t.slope for t in self.table_AIn ])
+        self.intercepts = np.array([ t.intercept for t in self.table_AIn ])
+
+        self.running = False
+        self.overrun = False
+        self.frequency = 0
+        self.nChan = 0
+        self.continuous_mode = False
+
+        self.reads = 0
+        self.scans = 0       # scans generated
+        self.overruns = 0
+        self.injected = 0    # of them
+
+    def BuildGainTable(self):
+        '''
+        Same as usb_20x.BuildGainTable.
+        '''
+        address = 0x000
+        for chan in range(self.NCHAN):
+            self.table_AIn[chan].slope, = unpack('f', self.CalMemoryR(address, 4))
+            address += 4
+            self.table_AIn[chan].intercept, = unpack('f', self.CalMemoryR(address, 4))
+            address += 4
+
+    def CalMemoryR(self, address, count):
+        return self.cal_memory[address:address + count]
+
+    def Status(self):
+        status = 0
+        if self.running:
+            status |= self.AIN_SCAN_RUNNING
+        if self.overrun:
+            status |= self.AIN_SCAN_OVERRUN
+        return status
+
+    def AInScanStart(self, count, frequency, channels, options, trigger_source, trigger_mode):
+        '''
+        Same arguments as usb_20x.AInScanStart: count = scans (0 for continuous), frequency = samples per second
+        of all the channels, channels = mask of the channels, trigger_source = 1 to start on the next PPS.
+        '''
+        if frequency > self.MAX_FREQUENCY:
+            frequency = self.MAX_FREQUENCY
+        self.channels = [ c for c in range(self.NCHAN) if channels & (0x1 << c) ]
+        self.nChan = len(self.channels)
+        self.frequency = frequency
+        self.scan_rate = frequency/self.nChan*(1 + self.drift)
+        self.count = count
+        self.continuous_mode = count == 0
+        self.options = options
+
+        now = self.pps.now()
+        self.start = self.pps.next_edge(now) if trigger_source else now
+        self.position = 0 # scans read
+        self.running = True
+        self.overrun = False
+
+    def AInScanStop(self):
+        self.running = False
+
+    def AInScanClearFIFO(self):
+        self.overrun = False
+
+    def AInScanRead(self, nScan):
+        '''
+        Returns the list of the nScan*nChan interleaved samples, None on overrun.
+        '''
+        raw = self.read_scans(nScan)
+        if raw is None:
+            return
+        return raw.ravel().tolist()
+
+    def AInScanReadInto(self, buffer, nScan):
+        '''
+        Writes the nScan*nChan interleaved samples into buffer (see usb_20x.AInScanReadInto).
+        Returns the number of samples, None on overrun.
+        '''
+        out = np.frombuffer(memoryview(buffer).cast('B'), '<u2')
+        if len(out) < nScan*self.nChan:
+            raise ValueError('AInScanReadInto: buffer too small for the scan.')
+        raw = self.read_scans(nScan)
+        if raw is None:
+            return
+        out[:raw.size] = raw.ravel()
+        return raw.size
+
+    def read_scans(self, nScan):
+        '''
+        Waits until the next nScan scans are acquired and returns them, (nScan, nChan) uint16.
+        Returns None on overrun, or if the scan is not running.
+        '''
+        if not self.running:
+            print('AInScanRead: error in bulk transfer!', nScan*self.nChan)
+            return
+        if not self.continuous_mode:
+            nScan = min(nScan, self.count - self.position)
+        self.reads += 1
+
+        backlog = (self.pps.now() - self.start)*self.scan_rate - self.position # scans acquired and not read
+        injected = self.overrun_rate and self.rng.random() < self.overrun_rate
+        if backlog*self.nChan > self.FIFO_SIZE or injected:
+            self.overruns += 1
+            self.injected += bool(injected)
+            self.overrun = True
+            self.running = False
+            print('AInScanRead: Overrun Error')
+            return
+
+        self.pps.wait_until(self.start + (self.position + nScan)/self.scan_rate)
+        raw = self.generate(self.position, nScan)
+        self.position += nScan
+        self.scans += nScan
+        if not self.continuous_mode and self.position >= self.count:
+            self.running = False
+        return raw
+
+    def generate(self, first, nScan):
+        '''
+        Returns the scans from first (index from the start of the scan), (nScan, nChan) uint16:
+        the codes the ADC gives for the signals, so that the calibration of table_AIn gives them back.
+        '''
+        t = self.start - self.epoch + (first + np.arange(nScan))/self.scan_rate
+        raw = np.empty((nScan, self.nChan), np.uint16)
+        for i, c in enumerate(self.channels):
+            code = (self.signals[c].volts(t, self.rng)*2048/10 + 2048 - self.intercepts[c])/self.slopes[c]
+            raw[:, i] = np.clip(np.rint(code), 0, 4095)
+        return raw
+
+    def volts(self, value):
+        return ((value - 2048)*10.)/2048.
+
+    def stats(self):
+        return { 'reads': self.reads, 'scans': self.scans, 'overruns': self.overruns, 'injected': self.injected }
+
+RATE = 1 #frames per second: 1 = triggered scans (Pipeline), more = continuous scan and sliding estimation
+DURATION = 60 #seconds of the soak test, of the clock of the PPS
+SPEED = 1 #speed of the clock of the PPS
+OVERRUN_RATE = 0 #probability of an overrun injected at every read
+
+def soak(duration=DURATION, rate=RATE, speed=SPEED, overrun_rate=OVERRUN_RATE, frequency=12500, nSamples=2400, report=10):
+    '''
+    Runs the PMU on the simulated USB-201 for duration seconds: Redlab -> estimate_phasors -> MyPmu,
+    8 channels sampled at frequency (12.5 kHz = the 100 kS/s of the device), and prints the statistics every report seconds.
+    Returns the final statistics.
+    '''
+    from redlab import Redlab
+    from pmu import MyPmu, make_sliding_callback
+    from pipeline import Pipeline
+    from estimator import SlidingEstimator, sliding_loop
+    from timing import PPSClock
+
+    pps = SoftPPS(speed)
+    device = SimulatedUSB201(three_phase(noise=0.005, harmonics=[(3, 0.05, 0), (5, 0.02, 0)]), pps, overrun_rate)
+    clock = PPSClock()
+    myPmu = MyPmu(["VA","VB","VC","VD","VE","VF","VG","VH"], dataRate=rate, clock=clock)
+    myPmu.server.start() #a PDC can connect, on port 1411
+
+    channels = list(range(8))
+    if rate > 1:
+        r = Redlab(channels, frequency, continuous=True, device=device)
+        clock.follow_stream(r, frequency)
+        pps.add_event_callback(clock.edge)
+        estimator = SlidingEstimator(len(channels), frequency, myPmu.nFreq)
+        worker = threading.Thread(target=sliding_loop, args=(r, estimator, rate, make_sliding_callback(myPmu, clock)))
+        worker.start()
+        stats = lambda: { 'restarts': r.stream_restarts }
+    else:
+        r = Redlab(channels, frequency, nSamples, device=device)
+        pipeline = Pipeline(r, myPmu, clock=clock)
+        pipeline.start()
+        pps.add_event_callback(pipeline.trigger)
+        stats = lambda: dict(pipeline.stats(), lost=pipeline.lost.value)
+    pps.start()
+
+    end = pps.now() + duration
+    try:
+        while pps.now() < end:
+            pps.wait_until(min(end, pps.now() + report))
+            print('{:.0f} s: sent {}, device {}, pps {} (missed {})'.format(duration - (end - pps.now()), myPmu.sent, device.stats(), pps.edges, pps.missed))
+            print(stats())
+    finally:
+        pps.stop()
+        if rate > 1:
+            r.close()
+            worker.join()
+        else:
+            pipeline.stop()
+            r.close()
+        myPmu.close()
+
+    return { 'sent': myPmu.sent, 'edges': pps.edges, 'missed': pps.missed, 'device': device.stats(), 'stages': stats() }
+
+if __name__ == "__main__":
+    print(soak())
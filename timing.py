@@ -0,0 +1,186 @@
+from collections import deque
+import time
+'''
+This file implements the timing of the PMU. The samples are timestamped by their index, not by when they are read:
+the scans are triggered by the PPS, so the first sample of a scan (or of the stream) is acquired exactly on a PPS edge
+and every following one a sampling period later.
+The PPS edges are recorded with the monotonic clock, to find out which UTC second started the scan:
+the wall clock needs to be right within half a second, the scheduler jitter doesn't matter.
+In continuous mode the sampling clock of the device drifts from UTC (tens of ppm): every edge is also recorded
+with the index of the stream sample acquired on it, and the samples are timestamped from the sample rate
+and the indexes measured on the latest edges instead of from the nominal sample rate since the start of the stream.
+'''
+
+class PPSClock:
+    '''
+    Records the PPS edges: the monotonic time of the edge and the UTC second it marks.
+    edge is meant to be the GPIO callback of the PPS pin (or to be called by it).
+    '''
+
+    def __init__(self, history=16, tolerance=0.01, rate_tolerance=200e-6):
+        '''
+        history = number of edges kept
+        tolerance = maximum deviation in seconds of the interval between two edges from 1 s, for the PPS to be locked
+        rate_tolerance = maximum relative deviation of the sample rate measured on the edges from the nominal one,
+                         beyond the uncertainty of the fit, for the stream to be locked (a crystal is within 50-100 ppm)
+        '''
+        self.edges = deque(maxlen=history) # (monotonic time, UTC second, stream index or None)
+        self.tolerance = tolerance
+        self.rate_tolerance = rate_tolerance
+        self.last_lock = None # monotonic time of the last edge a second after the previous one
+        self.follow_stream(None)
+
+    def follow_stream(self, stream, s_freq=None):
+        '''
+        Records with every edge the index of the sample of stream acquired on it (see Redlab.stream_index_at).
+        s_freq = nominal sampling frequency of every channel
+        '''
+        self.stream = stream
+        self.s_freq = s_freq
+        self.stream_restarts = None # restarts of the stream the correlation is of
+        self.stream_start = None    # UTC second of the sample 0 of the stream
+        self.stream_edges = deque(maxlen=self.edges.maxlen) # (seconds from the stream start, measured index)
+        self.stream_fit = None      # (intercept, rate) of the measured index vs the seconds from the start
+        self.stream_bias = None     # true index - measured index, from the first edges of the stream
+        self.rate_unlocked = None   # monotonic time the sample rate measured departed from the nominal one
+
+    def edge(self, arg=None):
+        '''
+        Records a PPS edge, and the stream sample acquired on it. Returns the UTC second it marks.
+        '''
+        mono = time.monotonic()
+        second = round(time.time())
+        if self.edges:
+            m, s, _ = self.edges[-1]
+            if second > s and abs(mono - m - (second - s)) < self.tolerance*(second - s):
+                self.last_lock = mono
+        index = None
+        if self.stream is not None:
+            at = self.stream.stream_index_at(mono)
+            if at is not None:
+                index, restarts = at
+                self.correlate(mono, second, index, restarts)
+        self.edges.append((mono, second, index))
+        return second
+
+    def correlate(self, mono, second, index, restarts):
+        '''
+        Adds the edge of second, on which the sample index (measured, fractional) of the stream was acquired, to the
+        correlation of the stream with UTC: fits the measured indexes of the latest edges with a line, the sample rate
+        being its slope. The measured indexes lag the true ones by the latency of the USB transfers: the sample 0 is
+        acquired exactly on the PPS, so the intercept of the fit of the first edges of the stream gives the lag.
+        The rate is judged only once history edges of the stream are fitted, against its standard error.
+        '''
+        if restarts != self.stream_restarts: # new stream, started on the next PPS
+            self.stream_restarts = restarts
+            self.stream_start = second - round(index/self.s_freq)
+            self.stream_edges.clear()
+            self.stream_fit = self.stream_bias = self.rate_unlocked = None
+        self.stream_edges.append((second - self.stream_start, index))
+        if len(self.stream_edges) < 2:
+            return
+
+        n = len(self.stream_edges)
+        mx = sum(x for x, _ in self.stream_edges)/n
+        my = sum(y for _, y in self.stream_edges)/n
+        sxx = sum((x - mx)**2 for x, _ in self.stream_edges)
+        rate = sum((x - mx)*(y - my) for x, y in self.stream_edges)/sxx
+        intercept = my - rate*mx
+        self.stream_fit = (intercept, rate)
+        if n < self.stream_edges.maxlen:
+            return # the rate of a few edges is the jitter of the chunks (about 1 ms, 1000 ppm in a second)
+        if self.stream_bias is None:
+            self.stream_bias = -intercept
+
+        # the rate departs from the nominal one if it does by more than the tolerance and 3 standard errors of the slope
+        residuals = sum((y - intercept - rate*x)**2 for x, y in self.stream_edges)
+        error = (residuals/(n - 2)/sxx)**0.5
+        if abs(rate - self.s_freq) - 3*error > self.rate_tolerance*self.s_freq:
+            if self.rate_unlocked is None:
+                print('PPSClock: sample rate {:.3f} +- {:.3f} Hz measured on the PPS, {:.0f} ppm from the nominal one.'.format(rate, error, (rate/self.s_freq - 1)*1e6))
+                self.rate_unlocked = mono
+        else:
+            self.rate_unlocked = None
+
+    def second_at(self, mono):
+        '''
+        Returns the UTC second of the PPS edge at the monotonic time mono (within half a second).
+        Without such an edge, the wall clock at mono rounded to the second.
+        '''
+        for edge_mono, second, _ in reversed(list(self.edges)):
+            if abs(mono - edge_mono) < 0.5:
+                return second
+        return round(time.time() - (time.monotonic() - mono))
+
+    def edge_time(self, second):
+        '''
+        Returns the monotonic time of the recorded PPS edge of the UTC second, None if it is not recorded.
+        '''
+        for edge_mono, s, _ in reversed(self.edges):
+            if s == second:
+                return edge_mono
+        return None
+
+    def scan_second(self, scan):
+        '''
+        Returns the UTC second of the PPS that triggered the scan just read (see Redlab.read):
+        its first sample was acquired the duration of the scan ago.
+        '''
+        return self.second_at(time.monotonic() - scan['samples']/scan['frequency'])
+
+    def stream_second(self, scan):
+        '''
+        Returns the UTC second of the PPS that started the stream of the scan read with Redlab.read_window:
+        the sample 0 of the stream was acquired scan['start'] samples before the first sample of the scan.
+        '''
+        if self.stream_start is not None and scan.get('restarts') == self.stream_restarts:
+            return self.stream_start
+        return self.second_at(scan['time'] - scan['start']/scan['frequency'])
+
+    def stream_timestamp(self, scan, index, time_base=1000000):
+        '''
+        Returns the (soc, fracsec) timestamp of the sample index of the stream of the scan (see stream_second).
+        Once the first history edges of the stream are correlated, from the sample rate and the indexes of the latest edges
+        (see correlate), so that the drift of the sampling clock doesn't add up; before, from the nominal sample rate.
+        '''
+        s_freq = scan['frequency']
+        soc = self.stream_second(scan)
+        if self.stream_bias is None or scan.get('restarts') != self.stream_restarts:
+            return sample_timestamp(index, s_freq, soc, time_base)
+
+        intercept, rate = self.stream_fit
+        seconds = (index - intercept - self.stream_bias)/rate # from the stream start
+        whole = int(seconds//1)
+        fracsec = int(round((seconds - whole)*time_base))
+        if fracsec == time_base:
+            whole, fracsec = whole + 1, 0
+        return self.stream_start + whole, fracsec
+
+    def unlocked_time(self):
+        '''
+        Returns the seconds since the PPS was last locked: 0 while an edge a second after the previous one 
+        has come within the last second, infinite if the PPS was never locked.
+        While the sample rate of the stream measured on the edges departs from the nominal one, 
+        the seconds since it departed, at least.
+        '''
+        if self.last_lock is None:
+            return float('inf')
+        unlocked = max(0, time.monotonic() - self.last_lock - (1 + self.tolerance))
+        if self.rate_unlocked is not None:
+            unlocked = max(unlocked, time.monotonic() - self.rate_unlocked, 1e-6)
+        return unlocked
+
+    def locked(self):
+        '''
+        True if the last edge is not older than a second and the last two edges are a second apart.
+        '''
+        return self.unlocked_time() == 0
+
+def sample_timestamp(index, s_freq, soc, time_base=1000000):
+    '''
+    Returns the (soc, fracsec) timestamp of the sample index of a scan whose sample 0 was acquired on the PPS of second soc.
+    s_freq = sampling frequency of the channel (integer, samples per second)
+    fracsec is in time_base units (see TIME_BASE of the configuration frame); integer arithmetic, no rounding errors.
+    '''
+    s_freq = int(s_freq)
+    return soc + index//s_freq, index % s_freq*time_base//s_freq
@@ -19,6 +19,7 @@ import libusb1
 import usb1
 import time
 import sys
+import threading
 from struct import *
 from datetime import datetime
 from mccUSB import *
@@ -468,6 +469,56 @@ class usb_20x(mccUSB):
     self.AInScanClearFIFO()
     return list(data)
 
+  def AInScanReadInto(self, buffer, nScan):
+    """
+    Zero-copy variant of AInScanRead for block transfer mode.  The
+    bulk endpoint is read straight into buffer, any writable
+    C-contiguous object (bytearray, numpy uint16 array, memoryview)
+    of at least 2*nScan*nChan bytes: no intermediate tuple or list is
+    built.  The same USB transfer is reused at every call.
+
+    Returns the number of samples read, None on error.
+    """
+    if self.options & self.IMMEDIATE_TRANSFER_MODE:
+      raise ValueError('AInScanReadInto: only block transfer mode is supported.')
+
+    nSamples = int(nScan * self.nChan)
+    view = memoryview(buffer).cast('B')
+    if len(view) < 2*nSamples:
+      raise ValueError('AInScanReadInto: buffer too small for the scan.')
+
+    if not hasattr(self, 'transfer'):
+      self.transfer = self.udev.getTransfer()
+
+    timeout = int(1000*self.nChan*nScan/self.frequency + 1000)
+    self.transfer.setBulk(libusb1.LIBUSB_ENDPOINT_IN | 1, view[:2*nSamples], timeout=timeout)
+    try:
+      self.transfer.submit()
+      while self.transfer.isSubmitted():
+        self.context.handleEvents()
+    except:
+      print('AInScanReadInto: error in bulk transfer!', nSamples)
+      return
+    if self.transfer.getStatus() != usb1.TRANSFER_COMPLETED:
+      print('AInScanReadInto: error in bulk transfer!', nSamples)
+      return
+
+    status = self.Status()
+    if status & self.AIN_SCAN_OVERRUN:
+      print('AInScanReadInto: Overrun Error')
+      return
+
+    if self.continuous_mode:
+      return self.transfer.getActualLength()//2
+
+    # if nbytes is a multiple of wMaxPacketSize the device will send a zero byte packet.
+    if ((int(nSamples*2) % self.wMaxPacketSize) == 0 and  not(status & self.AIN_SCAN_RUNNING)):
+      data2 = self.udev.bulkRead(libusb1.LIBUSB_ENDPOINT_IN | 1, 2, 100)
+
+    self.AInScanStop()
+    self.AInScanClearFIFO()
+    return self.transfer.getActualLength()//2
+
   def AInScanStop(self):
     """
     This command stops the analog input scan (if running).
@@ -747,6 +798,142 @@ class usb_20x(mccUSB):
 
 ####################################################################################
 
+class BulkInStream:
+  """
+    Asynchronous reader of the analog input bulk endpoint. Keeps
+    nTransfers bulk IN transfers of transferSize bytes queued on the
+    device, so that the host is always ready to receive and the device
+    FIFO does not overrun, and resubmits every transfer as soon as it
+    completes.  The libusb events are handled by a dedicated thread.
+
+    Completed chunks are delivered in order to callback(data, t), where
+    data is a memoryview on the transfer buffer (valid only during the
+    call: copy it if needed) and t the completion time (time.monotonic).
+    Alternatively queue() returns an asyncio queue receiving (bytes, t)
+    tuples.
+
+    On a failed transfer (overrun, stall, timeout) the pending transfers
+    are cancelled and error_callback(status) is called from the event
+    thread outside of the libusb event handling, so that it can restart
+    the scan with synchronous commands; the transfers are then
+    resubmitted.  With INHIBIT_STALL the device does not stall on an
+    overrun, the transfers keep completing with a gap in the samples:
+    the event thread reads Status after every chunk completed and fails
+    with status 'overrun' if the overrun bit is set.
+  """
+
+  def __init__(self, device, transferSize, nTransfers=4, callback=None, error_callback=None, timeout=1000):
+    if transferSize % device.wMaxPacketSize:
+      raise ValueError('BulkInStream: transferSize must be a multiple of wMaxPacketSize.')
+    self.device = device
+    self.callback = callback
+    self.error_callback = error_callback
+    self.timeout = timeout
+    self.endpoint = libusb1.LIBUSB_ENDPOINT_IN | 1
+    self.buffers = [bytearray(transferSize) for _ in range(nTransfers)]
+    self.transfers = []
+    for buffer in self.buffers:
+      transfer = device.udev.getTransfer()
+      transfer.setBulk(self.endpoint, buffer, self.completed, None, timeout)
+      self.transfers.append(transfer)
+    self.failed = None
+    self.running = False
+    self.thread = None
+    self.chunks = 0      # completed transfers
+    self.errors = 0      # failed transfers
+
+  def start(self):
+    """
+    Submits all the transfers and starts the event thread.
+    """
+    self.running = True
+    self.submit_all()
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    """
+    Cancels the pending transfers and stops the event thread.
+    """
+    self.running = False
+    self.cancel_all()
+    if self.thread:
+      self.thread.join()
+
+  def submit_all(self):
+    for transfer in self.transfers:
+      if not transfer.isSubmitted():
+        transfer.submit()
+
+  def cancel_all(self):
+    for transfer in self.transfers:
+      try:
+        transfer.cancel()
+      except usb1.USBError:
+        pass       # already completed
+
+  def completed(self, transfer):
+    """
+    Transfer callback, runs inside the libusb event handling.
+    """
+    status = transfer.getStatus()
+    if status == usb1.TRANSFER_COMPLETED:
+      if self.failed is not None:
+        return     # data after a failure are discarded
+      self.chunks += 1
+      if self.callback:
+        self.callback(memoryview(transfer.getBuffer())[:transfer.getActualLength()], time.monotonic())
+      if self.running:
+        transfer.submit()
+    elif status != usb1.TRANSFER_CANCELLED:   # cancelled by stop() or after a failure
+      self.errors += 1
+      if self.failed is None:
+        self.failed = status
+        self.cancel_all()
+
+  def run(self):
+    """
+    Event thread: handles the libusb events, checks the overrun and recovers from the failed transfers.
+    """
+    context = self.device.context
+    chunks = self.chunks
+    while self.running or any(t.isSubmitted() for t in self.transfers):
+      context.handleEventsTimeout(0.1)
+      if self.chunks != chunks and self.failed is None and self.running:
+        chunks = self.chunks
+        if self.device.Status() & self.device.AIN_SCAN_OVERRUN:
+          self.errors += 1
+          self.failed = 'overrun'
+          self.cancel_all()
+      if self.failed is not None and not any(t.isSubmitted() for t in self.transfers):
+        status, self.failed = self.failed, None
+        print('BulkInStream: transfer failed with status', status)
+        if self.error_callback:
+          self.error_callback(status)
+        if self.running:
+          self.submit_all()
+
+  def queue(self, loop, maxsize=0):
+    """
+    Returns an asyncio.Queue of the given loop receiving a (bytes, time)
+    tuple for every completed chunk.  Chunks are dropped (and counted in
+    self.dropped) if the queue is full.
+    """
+    import asyncio
+    queue = asyncio.Queue(maxsize)
+    self.dropped = 0
+
+    def put(item):
+      try:
+        queue.put_nowait(item)
+      except asyncio.QueueFull:
+        self.dropped += 1
+
+    self.callback = lambda data, t: loop.call_soon_threadsafe(put, (bytes(data), t))
+    return queue
+
+####################################################################################
+
 class usb_201(usb_20x):
 
   def __init__(self, serial=None):